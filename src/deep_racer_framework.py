@@ -6,7 +6,29 @@
 # Copyright (c) 2021 dmh23
 #
 
+import atexit
+import hashlib
+import json
 import math
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    resource_tracker = None
+    shared_memory = None
 
 
 # -------------------------------------------------------------------------------
@@ -15,6 +37,9 @@ import math
 #
 # -------------------------------------------------------------------------------
 
+FRAMEWORK_VERSION = "1.2.0"
+
+
 class ParamNames:
     ALL_WHEELS_ON_TRACK = "all_wheels_on_track"
     CLOSEST_WAYPOINTS = "closest_waypoints"
@@ -58,6 +83,8 @@ class RealWorld:
 
     SAFE_CAR_OVERHANG = min(VEHICLE_LENGTH, VEHICLE_WIDTH) / 2
 
+    EDGE_ERROR_TOLERANCE = 0.01
+
 
 # -------------------------------------------------------------------------------
 #
@@ -103,6 +130,38 @@ def is_point_between(point, start, finish):
     return abs(get_turn_between_directions(bearing_from_start, bearing_to_finish)) < 1
 
 
+def is_heading_between_points(point, heading: float, left, right):
+    relative_direction_to_left = get_turn_between_directions(heading, get_bearing_between_points(point, left))
+    relative_direction_to_right = get_turn_between_directions(heading, get_bearing_between_points(point, right))
+    return relative_direction_to_left >= 0 and relative_direction_to_right <= 0
+
+
+def get_ray_hit_distance(point, direction, start, finish):
+    # Distance along the ray from point (with unit direction) to where it crosses the line segment, or None
+    (direction_x, direction_y) = direction
+    (offset_x, offset_y) = (start[0] - point[0], start[1] - point[1])
+    (side_x, side_y) = (finish[0] - start[0], finish[1] - start[1])
+    denominator = direction_x * side_y - direction_y * side_x
+    if denominator == 0:
+        return None
+    distance = (offset_x * side_y - offset_y * side_x) / denominator
+    fraction = (offset_x * direction_y - offset_y * direction_x) / denominator
+    if distance > 0 and 0 <= fraction <= 1:
+        return distance
+    else:
+        return None
+
+
+def get_distance_from_line_segment(point, start, finish):
+    (side_x, side_y) = (finish[0] - start[0], finish[1] - start[1])
+    length_squared = side_x * side_x + side_y * side_y
+    if length_squared == 0.0:
+        return get_distance_between_points(point, start)
+    fraction = ((point[0] - start[0]) * side_x + (point[1] - start[1]) * side_y) / length_squared
+    fraction = min(max(fraction, 0.0), 1.0)
+    return get_distance_between_points(point, (start[0] + fraction * side_x, start[1] + fraction * side_y))
+
+
 def get_point_at_bearing(start_point, bearing: float, distance: float):
     (x, y) = start_point
 
@@ -184,8 +243,6 @@ def get_processed_waypoints(waypoints, track_width):
     left_safe = previous
     right_safe = previous
 
-    edge_error_tolerance = 0.01
-
     processed_waypoints = []
 
     for i, w in enumerate(waypoints):
@@ -200,11 +257,11 @@ def get_processed_waypoints(waypoints, track_width):
             previous_right = right_safe
 
             left_safe = get_edge_point(previous, w, future, 90, track_width / 2 + RealWorld.SAFE_CAR_OVERHANG)
-            if get_distance_between_points(previous_left, left_safe) < edge_error_tolerance:
+            if get_distance_between_points(previous_left, left_safe) < RealWorld.EDGE_ERROR_TOLERANCE:
                 left_safe = previous_left
 
             right_safe = get_edge_point(previous, w, future, -90, track_width / 2 + RealWorld.SAFE_CAR_OVERHANG)
-            if get_distance_between_points(previous_right, right_safe) < edge_error_tolerance:
+            if get_distance_between_points(previous_right, right_safe) < RealWorld.EDGE_ERROR_TOLERANCE:
                 right_safe = previous_right
 
             previous = w
@@ -216,25 +273,2039 @@ def get_processed_waypoints(waypoints, track_width):
 
 # -------------------------------------------------------------------------------
 #
-# REMEMBER A PREVIOUS STEP IN THIS EPISODE
+# CACHE OF PROCESSED WAYPOINTS (IN MEMORY, AND OPTIONALLY ON DISK)
+#
+# -------------------------------------------------------------------------------
+
+class TrackGeometryCache:
+    MAX_TRACKS_IN_MEMORY = 4
+
+    # Set to a directory name to also keep processed tracks on disk, e.g. to survive worker restarts
+    FILE_DIRECTORY = None
+
+    FILE_MAGIC = b"DRFT"
+    FILE_VERSION = 1
+    FILE_HEADER_FORMAT = "<4sII"
+    FILE_WAYPOINT_FORMAT = "<6d"
+
+    _tracks = OrderedDict()
+
+
+def get_track_hash(waypoints, track_width):
+    # Includes the tolerances so that any change to them automatically ignores previously cached tracks
+    track_hash = hashlib.sha1()
+    track_hash.update(struct.pack("<3d", track_width, RealWorld.SAFE_CAR_OVERHANG, RealWorld.EDGE_ERROR_TOLERANCE))
+    for (x, y) in waypoints:
+        track_hash.update(struct.pack("<2d", x, y))
+    return track_hash.hexdigest()
+
+
+def get_cached_processed_waypoints(waypoints, track_width):
+    track_hash = get_track_hash(waypoints, track_width)
+
+    processed_waypoints = TrackGeometryCache._tracks.get(track_hash)
+    if processed_waypoints is not None:
+        TrackGeometryCache._tracks.move_to_end(track_hash)
+        return processed_waypoints
+
+    if SharedTrackMemory.ENABLED:
+        data = get_shared_track_data("track-" + track_hash, _get_processed_waypoints_data_size(len(waypoints)),
+                                     lambda buffer: _pack_processed_waypoints(buffer, _load_processed_waypoints(
+                                         waypoints, track_width, track_hash)))
+        values = _get_processed_waypoint_values(data, len(waypoints)) if data is not None else None
+        if values is not None:
+            processed_waypoints = PackedRows(values, 6, lambda v: ProcessedWaypoint((v[0], v[1]), (v[2], v[3]),
+                                                                                    (v[4], v[5])), max_kept=256)
+
+    if processed_waypoints is None:
+        processed_waypoints = _load_processed_waypoints(waypoints, track_width, track_hash)
+
+    TrackGeometryCache._tracks[track_hash] = processed_waypoints
+    while len(TrackGeometryCache._tracks) > TrackGeometryCache.MAX_TRACKS_IN_MEMORY:
+        TrackGeometryCache._tracks.popitem(last=False)
+
+    return processed_waypoints
+
+
+def _load_processed_waypoints(waypoints, track_width, track_hash: str):
+    file_name = None
+    processed_waypoints = None
+    if TrackGeometryCache.FILE_DIRECTORY:
+        file_name = os.path.join(TrackGeometryCache.FILE_DIRECTORY, "drf-track-" + track_hash + ".bin")
+        processed_waypoints = _read_processed_waypoints_file(file_name, len(waypoints))
+
+    if processed_waypoints is None:
+        processed_waypoints = get_processed_waypoints(waypoints, track_width)
+        if file_name:
+            _write_processed_waypoints_file(file_name, processed_waypoints)
+    return processed_waypoints
+
+
+def _get_processed_waypoints_data_size(waypoint_count: int):
+    return (struct.calcsize(TrackGeometryCache.FILE_HEADER_FORMAT) +
+            waypoint_count * struct.calcsize(TrackGeometryCache.FILE_WAYPOINT_FORMAT))
+
+
+def _read_processed_waypoints_file(file_name, waypoint_count: int):
+    try:
+        with open(file_name, "rb") as file:
+            data = file.read()
+    except OSError:
+        return None
+    values = _get_processed_waypoint_values(data, waypoint_count)
+    if values is None:
+        return None
+    return [ProcessedWaypoint((x, y), (left_x, left_y), (right_x, right_y)) for (x, y, left_x, left_y, right_x, right_y)
+            in struct.iter_unpack(TrackGeometryCache.FILE_WAYPOINT_FORMAT, values)]
+
+
+def _get_processed_waypoint_values(data, waypoint_count: int):
+    # The same format is used on disk and in shared memory, the values are six doubles per waypoint
+    header_size = struct.calcsize(TrackGeometryCache.FILE_HEADER_FORMAT)
+    if len(data) != _get_processed_waypoints_data_size(waypoint_count):
+        return None
+    (magic, version, count) = struct.unpack_from(TrackGeometryCache.FILE_HEADER_FORMAT, data)
+    if magic != TrackGeometryCache.FILE_MAGIC or version != TrackGeometryCache.FILE_VERSION or count != waypoint_count:
+        return None
+    return memoryview(data)[header_size:].cast("d")
+
+
+def _pack_processed_waypoints(buffer, processed_waypoints):
+    struct.pack_into(TrackGeometryCache.FILE_HEADER_FORMAT, buffer, 0, TrackGeometryCache.FILE_MAGIC,
+                     TrackGeometryCache.FILE_VERSION, len(processed_waypoints))
+    offset = struct.calcsize(TrackGeometryCache.FILE_HEADER_FORMAT)
+    waypoint_size = struct.calcsize(TrackGeometryCache.FILE_WAYPOINT_FORMAT)
+    for w in processed_waypoints:
+        struct.pack_into(TrackGeometryCache.FILE_WAYPOINT_FORMAT, buffer, offset, w.x, w.y, *w.left_safe,
+                         *w.right_safe)
+        offset += waypoint_size
+
+
+def _write_processed_waypoints_file(file_name, processed_waypoints):
+    data = bytearray(_get_processed_waypoints_data_size(len(processed_waypoints)))
+    _pack_processed_waypoints(data, processed_waypoints)
+
+    # Write then rename, so other processes never see a partly written file
+    temporary_file_name = file_name + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        with open(temporary_file_name, "wb") as file:
+            file.write(data)
+        os.replace(temporary_file_name, file_name)
+    except OSError:
+        pass    # The file cache is only an optimization
+
+
+# -------------------------------------------------------------------------------
+#
+# TRACK DATA SHARED BY ALL PROCESSES ON THE SAME MACHINE (OPTIONAL)
 #
 # -------------------------------------------------------------------------------
 
-class HistoricStep:
-    def __init__(self, framework, previous_step):
-        self.x = framework.x
-        self.y = framework.y
-        self.progress = framework.progress
-        self.action_speed = framework.action_speed
-        self.action_steering_angle = framework.action_steering_angle
-        self.closest_waypoint_id = framework.closest_waypoint_id
-        self.next_waypoint_id = framework.next_waypoint_id
-        self.slide = framework.slide
+class SharedTrackMemory:
+    # Set to True so that processes on the same machine (e.g. several rollout workers) share one read-only copy of
+    # each track's data, built by whichever process needs it first, which the others simply attach to
+    ENABLED = False
+
+    NAME_PREFIX = "drf-"
+    MAGIC = b"DRFS"
+    VERSION = 2
+    HEADER_FORMAT = "<4sIQqd"   # Magic, version, data size, then the process id of the builder and when it started
+    WAIT_SECONDS = 10.0     # How long to wait for another process to finish building, before building a copy here
+    STALE_SECONDS = 600.0   # A build is abandoned if its process has gone, or it has not finished after this long
 
-        if previous_step:
-            self.distance = get_distance_between_points((previous_step.x, previous_step.y), (self.x, self.y))
+    # Kept open for the life of the process, since the data is used directly from shared memory
+    _segments = OrderedDict()
+
+    # Data that could not be had, which is not tried again, so that this process only ever waits once for each
+    _failed_names = set()
+
+
+def get_shared_track_data(key: str, size: int, build):
+    # A read-only memoryview of the shared data for the key, after calling build(buffer) to fill it in the first
+    # process that needs it, or None if it is not available (in which case the caller builds its own copy instead)
+    if shared_memory is None:
+        return None
+    name = SharedTrackMemory.NAME_PREFIX + hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
+    if name in SharedTrackMemory._failed_names:
+        return None
+    header_size = struct.calcsize(SharedTrackMemory.HEADER_FORMAT)
+
+    memory = SharedTrackMemory._segments.get(name)
+    if memory is None:
+        memory = _open_shared_track_data(name, header_size, size, build)
+        if memory is None:
+            SharedTrackMemory._failed_names.add(name)
+            return None
+        SharedTrackMemory._segments[name] = memory
+
+    (magic, version, data_size, _, _) = struct.unpack_from(SharedTrackMemory.HEADER_FORMAT, memory.buf)
+    if version != SharedTrackMemory.VERSION or data_size != size or memory.size < header_size + size:
+        return None
+    return memory.buf[header_size:header_size + size].toreadonly()
+
+
+def _open_shared_track_data(name: str, header_size: int, size: int, build):
+    # The segment once its data is built, either here or by another process, or None if that takes too long
+    deadline = time.monotonic() + SharedTrackMemory.WAIT_SECONDS
+    while True:
+        try:
+            try:
+                memory = _open_shared_memory(name, header_size + size)
+            except FileExistsError:
+                memory = _open_shared_memory(name, 0)
+            else:
+                _build_shared_track_data(memory, header_size, size, build)
+                return memory
+        except (OSError, ValueError):
+            return None
+
+        # The magic is written last, so until it appears another process is still building the data
+        while bytes(memory.buf[:4]) != SharedTrackMemory.MAGIC:
+            if _is_shared_track_data_abandoned(memory):
+                # Remove it, and then try again to build it here (unless another process gets there first)
+                try:
+                    _unlink_shared_memory(memory)
+                    memory.close()
+                except (OSError, BufferError):
+                    pass
+                break
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.01)
         else:
-            self.distance = 0.0  # Causes issues if we use: framework.progress / 100 * framework.track_length
+            return memory
+
+
+def _build_shared_track_data(memory, header_size: int, size: int, build):
+    # Says who is building it first, so that other processes can tell if this process goes before it finishes
+    struct.pack_into(SharedTrackMemory.HEADER_FORMAT, memory.buf, 0, bytes(4), SharedTrackMemory.VERSION, size,
+                     os.getpid(), time.time())
+    try:
+        build(memory.buf[header_size:header_size + size])
+    except BaseException:
+        _unlink_shared_memory(memory)
+        raise
+    memory.buf[:4] = SharedTrackMemory.MAGIC
+
+
+def _is_shared_track_data_abandoned(memory):
+    (_, _, _, process_id, started) = struct.unpack_from(SharedTrackMemory.HEADER_FORMAT, memory.buf)
+    if process_id == 0:
+        return False    # Only just created, so the builder has not said who it is yet
+    if time.time() - started > SharedTrackMemory.STALE_SECONDS:
+        return True
+    if os.name == "posix":
+        try:
+            os.kill(process_id, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass    # Still there, but owned by someone else
+    return False
+
+
+if shared_memory is not None:
+    class _SharedTrackSegment(shared_memory.SharedMemory):
+        def __del__(self):
+            pass    # Never closed, since the data is used directly right up until the process exits
+
+
+def _open_shared_memory(name: str, size: int):
+    # Opens an existing segment if the size is zero; either way it stays after this process exits, like the file cache
+    try:
+        return _SharedTrackSegment(name, create=size > 0, size=size, track=False)
+    except TypeError:
+        pass    # Before Python 3.13, so stop the resource tracker removing the segment instead
+    memory = _SharedTrackSegment(name, create=size > 0, size=size)
+    if os.name == "posix":
+        resource_tracker.unregister(memory._name, "shared_memory")
+    return memory
+
+
+def unlink_shared_track_data():
+    # Removes the shared data used by this process (e.g. at the end of training), other processes keep their copies
+    for memory in SharedTrackMemory._segments.values():
+        try:
+            _unlink_shared_memory(memory)
+        except OSError:
+            pass
+    SharedTrackMemory._segments.clear()
+    SharedTrackMemory._failed_names.clear()
+
+
+def _unlink_shared_memory(memory):
+    # Before Python 3.13, unlink() also tells the resource tracker, which expects to know about the segment
+    if getattr(memory, "_track", True) and os.name == "posix":
+        resource_tracker.register(memory._name, "shared_memory")
+    memory.unlink()
+
+
+class PackedRows:
+    # A read-only sequence over rows of values packed one after another (e.g. in shared memory), so that a process
+    # does not hold its own copy of them all: each row is only made when it is used, optionally keeping the latest
+    def __init__(self, values, width: int, make_row, max_kept: int = 0):
+        self.values = values
+        self._width = width
+        self._make_row = make_row
+        self._row_count = len(values) // width
+        self._max_kept = max_kept
+        self._kept = {}
+
+    def __len__(self):
+        return self._row_count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._row_count))]
+        if i < 0:
+            i += self._row_count
+        row = self._kept.get(i)
+        if row is None:
+            if not 0 <= i < self._row_count:
+                raise IndexError("row index out of range")
+            row = self._make_row(self.values[i * self._width:(i + 1) * self._width])
+            if self._max_kept:
+                if len(self._kept) == self._max_kept:
+                    self._kept.clear()
+                self._kept[i] = row
+        return row
+
+
+# -------------------------------------------------------------------------------
+#
+# SPATIAL INDEX OF WAYPOINTS
+#
+# -------------------------------------------------------------------------------
+
+class WaypointGrid:
+    # Each cell is about this many times the average distance between waypoints, so that it holds only a few of them
+    # however close together they are, but no wider than the track and with no more than this many cells per waypoint
+    CELL_SPACINGS = 16
+    MAX_CELLS_PER_WAYPOINT = 4
+
+    _grids = OrderedDict()
+
+    def __init__(self, waypoints, cell_size: float, values=None):
+        assert cell_size > 0.0
+        self._waypoints = waypoints
+        self._cell_size = cell_size
+        (self._min_x, self._min_y, self._columns, self._rows) = WaypointGrid._get_extent(waypoints, cell_size)
+
+        # For each cell (row by row) the index in the values where its waypoint ids start, then all the ids. The values
+        # can be given (e.g. a view of them in shared memory) rather than calculated
+        if values is None:
+            # (The same cells as _get_cell(), without a call for each waypoint)
+            (min_x, min_y, columns, floor) = (self._min_x, self._min_y, self._columns, math.floor)
+            waypoint_cells = [int(floor((y - min_y) / cell_size)) * columns + int(floor((x - min_x) / cell_size))
+                              for (x, y) in waypoints]
+            starts = [0] * (columns * self._rows + 1)
+            starts[0] = len(starts)
+            for cell in waypoint_cells:
+                starts[cell + 1] += 1
+            values = list(accumulate(starts))
+            values.extend(sorted(range(len(waypoints)), key=waypoint_cells.__getitem__))
+        self._values = values
+
+    @staticmethod
+    def _get_extent(waypoints, cell_size: float):
+        min_x = min(x for (x, y) in waypoints)
+        min_y = min(y for (x, y) in waypoints)
+        columns = int((max(x for (x, y) in waypoints) - min_x) / cell_size) + 1
+        rows = int((max(y for (x, y) in waypoints) - min_y) / cell_size) + 1
+        return min_x, min_y, columns, rows
+
+    @classmethod
+    def get_cell_size(cls, waypoints, track_length: float, track_width: float):
+        area = (max(x for (x, y) in waypoints) - min(x for (x, y) in waypoints)) * (
+                max(y for (x, y) in waypoints) - min(y for (x, y) in waypoints))
+        smallest_cell_size = math.sqrt(area / (cls.MAX_CELLS_PER_WAYPOINT * len(waypoints)))
+        cell_size = min(track_width, max(cls.CELL_SPACINGS * track_length / len(waypoints), smallest_cell_size))
+        return cell_size if cell_size > 0.0 else track_width
+
+    @staticmethod
+    def get_value_count(waypoints, cell_size: float):
+        (_, _, columns, rows) = WaypointGrid._get_extent(waypoints, cell_size)
+        return columns * rows + 1 + len(waypoints)
+
+    def pack_values(self, values):
+        values[:] = array("i", self._values)
+
+    def _get_cell(self, point):
+        (x, y) = point
+        return int(math.floor((x - self._min_x) / self._cell_size)), int(math.floor((y - self._min_y) / self._cell_size))
+
+    def get_closest_waypoint_id(self, point):
+        (column, row) = self._get_cell(point)
+        if not (0 <= column < self._columns and 0 <= row < self._rows):
+            return self._get_closest_waypoint_id_by_checking_all(point)
+
+        max_ring = max(column, row, self._columns - 1 - column, self._rows - 1 - row)
+        closest_id = None
+        closest_distance = 0.0
+        values = self._values
+
+        # How far the point is from the nearest side of its own cell
+        (x, y) = point
+        cell_x = x - self._min_x - column * self._cell_size
+        cell_y = y - self._min_y - row * self._cell_size
+        margin = min(cell_x, cell_y, self._cell_size - cell_x, self._cell_size - cell_y)
+
+        for ring in range(max_ring + 1):
+            # Anything in an unchecked cell is at least this far away, and ties go to the lowest id
+            if closest_id is not None and closest_distance < (ring - 1) * self._cell_size + margin:
+                break
+            for cell in self._get_ring_of_cells(column, row, ring):
+                for i in values[values[cell]:values[cell + 1]]:
+                    distance = get_distance_between_points(self._waypoints[i], point)
+                    if closest_id is None or distance < closest_distance or (
+                            distance == closest_distance and i < closest_id):
+                        closest_id = i
+                        closest_distance = distance
+
+        return closest_id
+
+    def _get_ring_of_cells(self, column: int, row: int, ring: int):
+        # The index of each cell in the ring that is inside the grid
+        if ring == 0:
+            return [row * self._columns + column]
+        columns = range(max(0, column - ring), min(self._columns, column + ring + 1))
+        rows = range(max(0, row - ring + 1), min(self._rows, row + ring))
+        cells = [r * self._columns + c for r in (row - ring, row + ring) if 0 <= r < self._rows for c in columns]
+        cells += [r * self._columns + c for c in (column - ring, column + ring) if 0 <= c < self._columns for r in rows]
+        return cells
+
+    def _get_closest_waypoint_id_by_checking_all(self, point):
+        distance = get_distance_between_points(self._waypoints[0], point)
+        closest_id = 0
+        for i, w in enumerate(self._waypoints[1:]):
+            new_distance = get_distance_between_points(w, point)
+            if new_distance < distance:
+                distance = new_distance
+                closest_id = i + 1
+        return closest_id
+
+
+def get_cached_waypoint_grid(track_hash: str, waypoints, track_length: float, track_width: float):
+    waypoint_grid = WaypointGrid._grids.get(track_hash)
+    if waypoint_grid is not None:
+        WaypointGrid._grids.move_to_end(track_hash)
+        return waypoint_grid
+
+    cell_size = WaypointGrid.get_cell_size(waypoints, track_length, track_width)
+    data = None
+    if SharedTrackMemory.ENABLED:
+        data = get_shared_track_data("grid-" + track_hash + "-" + repr(cell_size),
+                                     4 * WaypointGrid.get_value_count(waypoints, cell_size),
+                                     lambda buffer: WaypointGrid(waypoints, cell_size).pack_values(buffer.cast("i")))
+    waypoint_grid = WaypointGrid(waypoints, cell_size, data.cast("i") if data is not None else None)
+
+    WaypointGrid._grids[track_hash] = waypoint_grid
+    while len(WaypointGrid._grids) > TrackGeometryCache.MAX_TRACKS_IN_MEMORY:
+        WaypointGrid._grids.popitem(last=False)
+
+    return waypoint_grid
+
+
+# -------------------------------------------------------------------------------
+#
+# CUMULATIVE DISTANCES ALONG THE WAYPOINTS
+#
+# -------------------------------------------------------------------------------
+
+class TrackDistances:
+    _distances = OrderedDict()
+
+    def __init__(self, waypoints, cumulative=None):
+        # The cumulative distances can be given (e.g. a view of them in shared memory) rather than calculated
+        self._waypoints = waypoints
+        if cumulative is None:
+            cumulative = [0.0]
+            for i in range(1, len(waypoints)):
+                cumulative.append(cumulative[-1] + get_distance_between_points(waypoints[i - 1], waypoints[i]))
+        self._cumulative = cumulative
+
+        # Includes the final step back to the first waypoint (zero if the last waypoint repeats the first)
+        self.total = self._cumulative[-1] + get_distance_between_points(waypoints[-1], waypoints[0])
+
+    def get_position_of_waypoint(self, waypoint_id: int):
+        return self._cumulative[waypoint_id]
+
+    def get_distance_between_waypoints(self, start: int, finish: int):
+        return self.get_distance_between_positions(self._cumulative[start], self._cumulative[finish])
+
+    def get_distance_between_positions(self, start: float, finish: float):
+        if finish >= start:
+            return finish - start
+        else:
+            return self.total - start + finish
+
+    def get_position_of_point(self, point, before_waypoint_id: int, after_waypoint_id: int):
+        (x, y) = point
+        (before_x, before_y) = self._waypoints[before_waypoint_id]
+        (after_x, after_y) = self._waypoints[after_waypoint_id]
+
+        segment_x = after_x - before_x
+        segment_y = after_y - before_y
+        segment_length_squared = segment_x * segment_x + segment_y * segment_y
+        if segment_length_squared == 0.0:
+            return self._cumulative[before_waypoint_id]
+
+        fraction = ((x - before_x) * segment_x + (y - before_y) * segment_y) / segment_length_squared
+        fraction = min(1.0, max(0.0, fraction))
+        return self.get_wrapped_position(self._cumulative[before_waypoint_id] +
+                                         fraction * math.sqrt(segment_length_squared))
+
+    def get_waypoint_id_at_position(self, position: float):
+        # The waypoint at the start of the segment that contains the position
+        return max(0, bisect_right(self._cumulative, position) - 1)
+
+    def get_point_at_position(self, position: float):
+        i = self.get_waypoint_id_at_position(position)
+        next_i = i + 1 if i < len(self._waypoints) - 1 else 0
+        segment_length = self.get_distance_between_waypoints(i, next_i)
+        if segment_length == 0.0:
+            return self._waypoints[i]
+
+        fraction = (position - self._cumulative[i]) / segment_length
+        (before_x, before_y) = self._waypoints[i]
+        (after_x, after_y) = self._waypoints[next_i]
+        return before_x + fraction * (after_x - before_x), before_y + fraction * (after_y - before_y)
+
+    def get_points_at_positions(self, positions):
+        # The same as get_point_at_position() for an array of positions, as arrays of x and y (needs NumPy)
+        cumulative = np.asarray(self._cumulative, dtype=float)
+        waypoints = np.asarray(self._waypoints, dtype=float)
+        ids = np.maximum(np.searchsorted(cumulative, positions, side="right") - 1, 0)
+        next_ids = np.where(ids < len(waypoints) - 1, ids + 1, 0)
+        segment_lengths = np.where(cumulative[next_ids] >= cumulative[ids], cumulative[next_ids] - cumulative[ids],
+                                   self.total - cumulative[ids] + cumulative[next_ids])
+        is_empty = segment_lengths == 0.0
+        fractions = np.where(is_empty, 0.0, (positions - cumulative[ids]) / np.where(is_empty, 1.0, segment_lengths))
+        (before_x, before_y) = (waypoints[ids, 0], waypoints[ids, 1])
+        (after_x, after_y) = (waypoints[next_ids, 0], waypoints[next_ids, 1])
+        return before_x + fractions * (after_x - before_x), before_y + fractions * (after_y - before_y)
+
+    def get_wrapped_position(self, position: float):
+        return position % self.total
+
+    def pack_values(self, values):
+        values[:] = array("d", self._cumulative)
+
+
+def get_cached_track_distances(track_hash: str, waypoints):
+    track_distances = TrackDistances._distances.get(track_hash)
+    if track_distances is not None:
+        TrackDistances._distances.move_to_end(track_hash)
+        return track_distances
+
+    data = None
+    if SharedTrackMemory.ENABLED:
+        data = get_shared_track_data("distances-" + track_hash, 8 * len(waypoints),
+                                     lambda buffer: TrackDistances(waypoints).pack_values(buffer.cast("d")))
+    track_distances = TrackDistances(waypoints, data.cast("d") if data is not None else None)
+
+    TrackDistances._distances[track_hash] = track_distances
+    while len(TrackDistances._distances) > TrackGeometryCache.MAX_TRACKS_IN_MEMORY:
+        TrackDistances._distances.popitem(last=False)
+
+    return track_distances
+
+
+# -------------------------------------------------------------------------------
+#
+# CURVATURE AND CORNERS, CALCULATED ONCE PER TRACK
+#
+# -------------------------------------------------------------------------------
+
+class TrackCorners:
+    _corners = OrderedDict()
+
+    def __init__(self, track_distances: TrackDistances, waypoint_count: int, look_ahead_distances,
+                 smoothing_distance: float, min_corner_curvature: float, values=None):
+        self._track_distances = track_distances
+        self.look_ahead_distances = tuple(look_ahead_distances)
+        if values is not None:
+            self._unpack_values(values, waypoint_count)
+            return
+
+        positions = [track_distances.get_position_of_waypoint(i) for i in range(waypoint_count)]
+        if np is not None:
+            self._calculate_curves_with_arrays(np.array(positions), smoothing_distance)
+        else:
+            self.curvature = [self._get_curvature_at_position(p, smoothing_distance) for p in positions]
+            bearings = [self._get_bearing_at_position(p, smoothing_distance) for p in positions]
+            self.turns_ahead = [tuple(get_turn_between_directions(bearing, self._get_bearing_at_position(
+                position + distance, smoothing_distance)) for distance in self.look_ahead_distances)
+                                for position, bearing in zip(positions, bearings)]
+
+        # A corner is a run of waypoints curving the same way more sharply than the minimum, and its apex is
+        # the sharpest point; the total turn is measured across the whole run
+        corners = []
+        i = 0
+        while i < waypoint_count:
+            if abs(self.curvature[i]) < min_corner_curvature:
+                i += 1
+                continue
+            run_start = i
+            is_left = self.curvature[i] > 0
+            while (i < waypoint_count and abs(self.curvature[i]) >= min_corner_curvature and
+                   (self.curvature[i] > 0) == is_left):
+                i += 1
+            apex = max(range(run_start, i), key=lambda w: abs(self.curvature[w]))
+            turn = get_turn_between_directions(
+                self._get_bearing_at_position(positions[run_start] - smoothing_distance, smoothing_distance),
+                self._get_bearing_at_position(positions[i - 1] + smoothing_distance, smoothing_distance))
+            corners.append((apex, is_left, turn))
+
+        # Then each waypoint simply remembers which corner is next
+        self.next_corner = [None] * waypoint_count
+        if corners:
+            corner_index = 0
+            for w in range(waypoint_count):
+                while corner_index < len(corners) and corners[corner_index][0] < w:
+                    corner_index += 1
+                self.next_corner[w] = corners[corner_index % len(corners)]
+
+    @staticmethod
+    def get_value_count(waypoint_count: int, look_ahead_distances):
+        # For each waypoint, the curvature, turns ahead, then the next corner's apex (or -1), is_left and turn
+        return waypoint_count * (len(look_ahead_distances) + 4)
+
+    def pack_values(self, values):
+        width = len(self.look_ahead_distances) + 4
+        for w, (curvature, turns, next_corner) in enumerate(zip(self.curvature, self.turns_ahead, self.next_corner)):
+            (apex, is_left, turn) = next_corner if next_corner is not None else (-1, False, 0.0)
+            values[w * width:(w + 1) * width] = array("d", (curvature, *turns, apex, is_left, turn))
+
+    def _unpack_values(self, values, waypoint_count: int):
+        # Views of the values (e.g. in shared memory) rather than copies, with each row only made when it is used
+        width = len(self.look_ahead_distances) + 4
+        self.curvature = values[0::width]
+        self.turns_ahead = PackedRows(values, width, lambda row: tuple(row[1:-3]))
+        self.next_corner = PackedRows(values, width, lambda row: None if row[-3] < 0 else (int(row[-3]),
+                                                                                           row[-2] == 1.0, row[-1]))
+
+    def _calculate_curves_with_arrays(self, positions, smoothing_distance: float):
+        # The same as _get_curvature_at_position() and _get_bearing_at_position() for every waypoint at once, with the
+        # points either side of each waypoint, then either side of each look ahead distance, all found together
+        track_distances = self._track_distances
+        windows = [positions - smoothing_distance, positions, positions + smoothing_distance]
+        for distance in self.look_ahead_distances:
+            windows += [positions + distance - smoothing_distance, positions + distance + smoothing_distance]
+        (x, y) = track_distances.get_points_at_positions(track_distances.get_wrapped_position(np.stack(windows)))
+
+        turns = get_angles_in_proper_range(self._get_bearings(x[1], y[1], x[2], y[2]) -
+                                           self._get_bearings(x[0], y[0], x[1], y[1]))
+        self.curvature = (np.radians(turns) / smoothing_distance).tolist()
+
+        bearings = self._get_bearings(x[0], y[0], x[2], y[2])
+        turns_ahead = [get_angles_in_proper_range(self._get_bearings(x[i], y[i], x[i + 1], y[i + 1]) - bearings)
+                       for i in range(3, len(windows), 2)]
+        self.turns_ahead = [tuple(turns) for turns in
+                            np.reshape(turns_ahead, (len(turns_ahead), len(positions))).T.tolist()]
+
+    @staticmethod
+    def _get_bearings(start_x, start_y, finish_x, finish_y):
+        # Uses math.atan2() since np.arctan2() can differ in the last digit, and the corners should be exactly the
+        # same with or without NumPy
+        return np.degrees(list(map(math.atan2, (finish_y - start_y).tolist(), (finish_x - start_x).tolist())))
+
+    def _get_bearing_at_position(self, position: float, smoothing_distance: float):
+        return get_bearing_between_points(self._track_distances.get_point_at_position(
+            self._track_distances.get_wrapped_position(position - smoothing_distance)),
+            self._track_distances.get_point_at_position(
+                self._track_distances.get_wrapped_position(position + smoothing_distance)))
+
+    def _get_curvature_at_position(self, position: float, smoothing_distance: float):
+        before = self._track_distances.get_point_at_position(
+            self._track_distances.get_wrapped_position(position - smoothing_distance))
+        here = self._track_distances.get_point_at_position(position)
+        after = self._track_distances.get_point_at_position(
+            self._track_distances.get_wrapped_position(position + smoothing_distance))
+        turn = get_turn_between_directions(get_bearing_between_points(before, here),
+                                           get_bearing_between_points(here, after))
+        return math.radians(turn) / smoothing_distance
+
+
+def get_cached_track_corners(track_hash: str, track_distances: TrackDistances, waypoint_count: int,
+                             look_ahead_distances, smoothing_distance: float, min_corner_curvature: float):
+    arguments = (track_distances, waypoint_count, look_ahead_distances, smoothing_distance, min_corner_curvature)
+    key = track_hash + "-" + repr(arguments[2:])
+
+    track_corners = TrackCorners._corners.get(key)
+    if track_corners is not None:
+        TrackCorners._corners.move_to_end(key)
+        return track_corners
+
+    data = None
+    if SharedTrackMemory.ENABLED:
+        data = get_shared_track_data("corners-" + key,
+                                     8 * TrackCorners.get_value_count(waypoint_count, look_ahead_distances),
+                                     lambda buffer: TrackCorners(*arguments).pack_values(buffer.cast("d")))
+    track_corners = TrackCorners(*arguments, values=data.cast("d") if data is not None else None)
+
+    TrackCorners._corners[key] = track_corners
+    while len(TrackCorners._corners) > TrackGeometryCache.MAX_TRACKS_IN_MEMORY:
+        TrackCorners._corners.popitem(last=False)
+
+    return track_corners
+
+
+# -------------------------------------------------------------------------------
+#
+# BOX OBSTACLES, CALCULATED ONCE PER EPISODE (OR WHENEVER AN OBJECT MOVES)
+#
+# -------------------------------------------------------------------------------
+
+class BoxObstacle:
+    def __init__(self, location, track_bearing: float, before_waypoint_id: int, after_waypoint_id: int,
+                 track_position: float):
+        (self.x, self.y) = location
+        self.track_bearing = track_bearing
+        self.before_waypoint_id = before_waypoint_id
+        self.after_waypoint_id = after_waypoint_id
+        self.track_position = track_position
+
+        safe_border = min(RealWorld.VEHICLE_WIDTH, RealWorld.VEHICLE_LENGTH) / 3  # Effectively enlarge the box
+
+        front_middle = get_point_at_bearing(location, track_bearing, RealWorld.BOX_OBSTACLE_LENGTH / 2 + safe_border)
+        front_left = get_point_at_bearing(front_middle, track_bearing + 90,
+                                          RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
+        front_right = get_point_at_bearing(front_middle, track_bearing - 90,
+                                           RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
+
+        rear_middle = get_point_at_bearing(location, track_bearing, -RealWorld.BOX_OBSTACLE_LENGTH / 2 - safe_border)
+        rear_left = get_point_at_bearing(rear_middle, track_bearing + 90,
+                                         RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
+        rear_right = get_point_at_bearing(rear_middle, track_bearing - 90,
+                                          RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
+
+        self.sides = ((front_left, front_right), (rear_left, rear_right),
+                      (front_left, rear_left), (front_right, rear_right))
+
+    def is_at(self, location):
+        return self.x == location[0] and self.y == location[1]
+
+    def get_hit_distance(self, point, heading: float, point2):
+        # The line from point to point2 must follow the heading, so it can be shared when testing several obstacles
+        hit_distance = None
+        for (box_point1, box_point2) in self.sides:
+            hit_point = get_intersection_of_two_lines(point, point2, box_point1, box_point2)
+            if hit_point is not None and is_point_between(hit_point, box_point1, box_point2):
+                # Make sure it's in front of us!
+                bearing_to_hit_point = get_bearing_between_points(point, hit_point)
+                if abs(get_turn_between_directions(bearing_to_hit_point, heading)) < 1:
+                    distance = get_distance_between_points(point, hit_point)
+                    if hit_distance is None or distance < hit_distance:
+                        hit_distance = distance
+        return hit_distance
+
+
+# -------------------------------------------------------------------------------
+#
+# CIRCULAR ARC FOLLOWING THE STEERING ANGLE
+#
+# -------------------------------------------------------------------------------
+
+class ArcPath:
+    # The circle that a car drives around from a point, setting off along the bearing and turning left for a positive
+    # curvature (1 / radius in meters), or a straight ray for a curvature of zero.  Hit distances are measured along
+    # the arc, within one full circle.
+    def __init__(self, point, bearing: float, curvature: float):
+        (self.x, self.y) = point
+        self.curvature = curvature
+        radians = math.radians(bearing)
+        self.direction = (math.cos(radians), math.sin(radians))
+        if curvature != 0.0:
+            self.radius = 1 / abs(curvature)
+            self.turn = 1.0 if curvature > 0 else -1.0
+            self.centre_x = self.x - self.turn * self.radius * self.direction[1]
+            self.centre_y = self.y + self.turn * self.radius * self.direction[0]
+            self.start_angle = math.atan2(self.y - self.centre_y, self.x - self.centre_x)
+
+    def get_full_circle_distance(self):
+        return 2 * math.pi * self.radius if self.curvature != 0.0 else math.inf
+
+    def get_hit_distance(self, start, finish):
+        # Distance along the arc to where it first crosses the line segment, or None
+        if self.curvature == 0.0:
+            return get_ray_hit_distance((self.x, self.y), self.direction, start, finish)
+
+        # Where the line crosses the circle, as fractions along the segment
+        (offset_x, offset_y) = (start[0] - self.centre_x, start[1] - self.centre_y)
+        (side_x, side_y) = (finish[0] - start[0], finish[1] - start[1])
+        a = side_x * side_x + side_y * side_y
+        half_b = offset_x * side_x + offset_y * side_y
+        discriminant = half_b * half_b - a * (offset_x * offset_x + offset_y * offset_y - self.radius * self.radius)
+        if a == 0.0 or discriminant < 0.0:
+            return None
+
+        hit_distance = None
+        root = math.sqrt(discriminant)
+        for fraction in ((-half_b - root) / a, (-half_b + root) / a):
+            if 0.0 <= fraction <= 1.0:
+                angle = (self.turn * (math.atan2(offset_y + fraction * side_y, offset_x + fraction * side_x) -
+                                      self.start_angle)) % (2 * math.pi)
+                if angle > 0.0 and (hit_distance is None or self.radius * angle < hit_distance):
+                    hit_distance = self.radius * angle
+        return hit_distance
+
+    def get_edge_hit_distance(self, processed_waypoint, next_processed_waypoint):
+        # The shorter distance to where the arc crosses either safe edge between the two waypoints, or None
+        left_distance = self.get_hit_distance(processed_waypoint.left_safe, next_processed_waypoint.left_safe)
+        right_distance = self.get_hit_distance(processed_waypoint.right_safe, next_processed_waypoint.right_safe)
+        if left_distance is None or (right_distance is not None and right_distance < left_distance):
+            return right_distance
+        return left_distance
+
+    def may_cross_circle(self, x: float, y: float, radius: float):
+        # False only if the arc (or ray) cannot come within the radius of the point
+        (offset_x, offset_y) = (x - self.x, y - self.y)
+        if self.curvature == 0.0:
+            along = offset_x * self.direction[0] + offset_y * self.direction[1]
+            return along >= -radius and abs(offset_x * self.direction[1] - offset_y * self.direction[0]) <= radius
+        centre_distance = math.hypot(x - self.centre_x, y - self.centre_y)
+        return abs(centre_distance - self.radius) <= radius
+
+
+class TrackEdgeBounds:
+    # Circles around each safe edge of every run of BRANCHING segments (from one waypoint to the next), then around
+    # every run of BRANCHING of those, and so on, so that an arc only has to check the segments of edge that it comes
+    # anywhere near.  The work depends on how far the arc goes and how close it passes to the edges, not on how close
+    # together the waypoints are
+    BRANCHING = 4
+    SLACK = 1e-9
+
+    _bounds = OrderedDict()
+
+    def __init__(self, processed_waypoints, values=None):
+        self._processed_waypoints = processed_waypoints
+        self._level_sizes = self.get_level_sizes(len(processed_waypoints))
+        if values is None:
+            values = self._get_values()
+        self._values = values
+        self._level_offsets = [0]
+        for size in self._level_sizes[:-1]:
+            self._level_offsets.append(self._level_offsets[-1] + 6 * size)
+
+    @classmethod
+    def get_level_sizes(cls, segment_count: int):
+        # Nodes in each level from the bottom, which has a node for each run of BRANCHING segments, up to the top,
+        # which has no more than BRANCHING nodes
+        sizes = [(segment_count + cls.BRANCHING - 1) // cls.BRANCHING]
+        while sizes[-1] > cls.BRANCHING:
+            sizes.append((sizes[-1] + cls.BRANCHING - 1) // cls.BRANCHING)
+        return sizes
+
+    @classmethod
+    def get_value_count(cls, segment_count: int):
+        return 6 * sum(cls.get_level_sizes(segment_count))
+
+    def pack_values(self, values):
+        values[:] = array("d", self._values)
+
+    def _get_values(self):
+        # Each node is the centre and radius of a circle around the left safe edge, then the same for the right
+        waypoint_count = len(self._processed_waypoints)
+        left_points = [w.left_safe for w in self._processed_waypoints]
+        right_points = [w.right_safe for w in self._processed_waypoints]
+        values = []
+        for first in range(0, waypoint_count, self.BRANCHING):
+            last = min(first + self.BRANCHING, waypoint_count)
+            for points in (left_points, right_points):
+                run_points = points[first:last] + [points[last % waypoint_count]]
+                values.extend(self._get_enclosing_circle_of_points(run_points))
+
+        level_first = 0
+        for size in self._level_sizes[:-1]:
+            children = values[level_first:level_first + 6 * size]
+            level_first += 6 * size
+            for first in range(0, size, self.BRANCHING):
+                for side in (0, 3):
+                    run_circles = [tuple(children[6 * i + side:6 * i + side + 3])
+                                   for i in range(first, min(first + self.BRANCHING, size))]
+                    values.extend(self._get_enclosing_circle(run_circles))
+        return values
+
+    @classmethod
+    def _get_enclosing_circle_of_points(cls, points):
+        # The circle around their bounding box
+        (xs, ys) = zip(*points)
+        (min_x, max_x, min_y, max_y) = (min(xs), max(xs), min(ys), max(ys))
+        return (min_x + max_x) / 2, (min_y + max_y) / 2, math.hypot(max_x - min_x, max_y - min_y) / 2 + cls.SLACK
+
+    @classmethod
+    def _get_enclosing_circle(cls, circles):
+        # A circle around all the given circles (each x, y, radius), not necessarily the smallest
+        min_x = min(x - r for (x, _, r) in circles)
+        max_x = max(x + r for (x, _, r) in circles)
+        min_y = min(y - r for (_, y, r) in circles)
+        max_y = max(y + r for (_, y, r) in circles)
+        (x, y) = ((min_x + max_x) / 2, (min_y + max_y) / 2)
+        return x, y, max(math.hypot(cx - x, cy - y) + r for (cx, cy, r) in circles) + cls.SLACK
+
+    def get_arc_edge_distance(self, arc: ArcPath, start_id: int):
+        # Distance along the arc to where it crosses a safe edge between the first waypoint it does not stay between
+        # and the waypoint after (starting from start_id), or infinity if it never leaves the track
+        segment_count = len(self._processed_waypoints)
+        top_level = len(self._level_sizes)
+        for (first, last) in ((start_id, segment_count), (0, start_id)):
+            distance = self._get_first_hit(arc, top_level, first, last, 0, self._level_sizes[-1])
+            if distance is not None:
+                return distance
+        return math.inf
+
+    def _get_first_hit(self, arc: ArcPath, level: int, first: int, last: int, first_node: int, last_node: int):
+        # The first hit on the segments from first up to last, within the nodes from first_node up to last_node at the
+        # level (where level 0 is the segments themselves)
+        if level == 0:
+            waypoint_count = len(self._processed_waypoints)
+            for i in range(max(first, first_node), min(last, last_node)):
+                distance = arc.get_edge_hit_distance(self._processed_waypoints[i],
+                                                     self._processed_waypoints[(i + 1) % waypoint_count])
+                if distance is not None:
+                    return distance
+            return None
+
+        values = self._values
+        offset = self._level_offsets[level - 1]
+        span = self.BRANCHING ** level
+        for node in range(max(first_node, first // span), min(last_node, (last + span - 1) // span)):
+            i = offset + 6 * node
+            if (arc.may_cross_circle(values[i], values[i + 1], values[i + 2]) or
+                    arc.may_cross_circle(values[i + 3], values[i + 4], values[i + 5])):
+                distance = self._get_first_hit(arc, level - 1, first, last, node * self.BRANCHING,
+                                               (node + 1) * self.BRANCHING)
+                if distance is not None:
+                    return distance
+        return None
+
+
+def get_cached_track_edge_bounds(track_hash: str, processed_waypoints):
+    edge_bounds = TrackEdgeBounds._bounds.get(track_hash)
+    if edge_bounds is not None:
+        TrackEdgeBounds._bounds.move_to_end(track_hash)
+        return edge_bounds
+
+    data = None
+    if SharedTrackMemory.ENABLED:
+        data = get_shared_track_data("bounds-" + track_hash,
+                                     8 * TrackEdgeBounds.get_value_count(len(processed_waypoints)),
+                                     lambda buffer: TrackEdgeBounds(processed_waypoints).pack_values(buffer.cast("d")))
+    edge_bounds = TrackEdgeBounds(processed_waypoints, data.cast("d") if data is not None else None)
+
+    TrackEdgeBounds._bounds[track_hash] = edge_bounds
+    while len(TrackEdgeBounds._bounds) > TrackGeometryCache.MAX_TRACKS_IN_MEMORY:
+        TrackEdgeBounds._bounds.popitem(last=False)
+
+    return edge_bounds
+
+
+# -------------------------------------------------------------------------------
+#
+# VECTORIZED EDGE ARRAYS (ONLY USED IF NUMPY IS AVAILABLE)
+#
+# -------------------------------------------------------------------------------
+
+def get_angles_in_proper_range(angles):
+    return angles + np.where(angles >= 180, -360, 0) + np.where(angles <= -180, 360, 0)
+
+
+def get_bearings_between_points(start_x, start_y, finish_x, finish_y):
+    return np.degrees(np.arctan2(finish_y - start_y, finish_x - start_x))
+
+
+def get_distances_between_points(first_x, first_y, second_x, second_y):
+    x_diff = second_x - first_x
+    y_diff = second_y - first_y
+    return np.sqrt(x_diff * x_diff + y_diff * y_diff)
+
+
+def get_intersections_of_two_lines(line_a_x1, line_a_y1, line_a_x2, line_a_y2,
+                                   line_b_x1, line_b_y1, line_b_x2, line_b_y2):
+    # Same as get_intersection_of_two_lines() except parallel lines give NaN rather than None
+    (x1, y1, x2, y2) = (line_a_x1, line_a_y1, line_a_x2, line_a_y2)
+    (x3, y3, x4, y4) = (line_b_x1, line_b_y1, line_b_x2, line_b_y2)
+
+    denominator = ((x1 - x2) * (y3 - y4)) - ((y1 - y2) * (x3 - x4))
+    z1 = (x1 * y2) - (y1 * x2)
+    z2 = (x3 * y4) - (y3 * x4)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = ((z1 * (x3 - x4)) - ((x1 - x2) * z2)) / denominator
+        y = ((z1 * (y3 - y4)) - ((y1 - y2) * z2)) / denominator
+    return x, y
+
+
+def are_points_between(x, y, start_x, start_y, finish_x, finish_y):
+    bearing_from_start = get_bearings_between_points(start_x, start_y, x, y)
+    bearing_to_finish = get_bearings_between_points(x, y, finish_x, finish_y)
+    return np.abs(get_angles_in_proper_range(bearing_to_finish - bearing_from_start)) < 1
+
+
+def get_ray_hit_distances(x, y, direction_x, direction_y, start_x, start_y, side_x, side_y):
+    # Distance along each ray (with unit direction) to the nearest line segment it crosses, or infinity if none,
+    # where each segment goes from (start_x, start_y) to (start_x + side_x, start_y + side_y)
+    (offset_x, offset_y) = (start_x - x, start_y - y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denominator = direction_x * side_y - direction_y * side_x
+        distance = (offset_x * side_y - offset_y * side_x) / denominator
+        fraction = (offset_x * direction_y - offset_y * direction_x) / denominator
+        distance[~((distance > 0) & (fraction >= 0) & (fraction <= 1))] = np.inf
+    return distance.min(axis=-1)
+
+
+class TrackEdgeArrays:
+    EXIT_SEARCH_WINDOW = 16
+    MAX_BATCH_ROWS = 1024
+
+    _arrays = OrderedDict()
+
+    # For a single step, the first few waypoints are quicker to check one at a time than with NumPy
+    SCALAR_EXIT_SEARCH_LENGTH = 16
+
+    def __init__(self, processed_waypoints, repeated_values=None):
+        self._processed_waypoints = processed_waypoints
+        if isinstance(processed_waypoints, PackedRows):
+            values = np.frombuffer(processed_waypoints.values, dtype=float).reshape(-1, 6).T    # Views, not copies
+        else:
+            # One list per row is much quicker to convert than a tuple per waypoint
+            values = np.array([[w.x for w in processed_waypoints], [w.y for w in processed_waypoints],
+                               [w.left_safe[0] for w in processed_waypoints],
+                               [w.left_safe[1] for w in processed_waypoints],
+                               [w.right_safe[0] for w in processed_waypoints],
+                               [w.right_safe[1] for w in processed_waypoints]], dtype=float)
+        (self.mid_x, self.mid_y, self.left_x, self.left_y, self.right_x, self.right_y) = values
+
+        # The edges repeated, so that a run of waypoints across the start line is a simple slice, then both safe edges
+        # as line segments from each waypoint to the next, also repeated. These can be given (e.g. a view of them in
+        # shared memory) rather than calculated
+        if repeated_values is None:
+            repeated_values = self.get_repeated_values()
+        size = 2 * len(processed_waypoints)
+        self._doubled_edges = tuple(repeated_values[i * size:(i + 1) * size] for i in range(4))
+        self._edge_sides = tuple(repeated_values[(4 + 2 * i) * size:(6 + 2 * i) * size].reshape(2, size)
+                                 for i in range(4))
+
+        # Working space for a single step, so that searching along the track allocates nothing
+        self._scratch_bearings = np.empty((3, len(processed_waypoints)))
+        self._scratch_flags = np.empty((3, len(processed_waypoints)), dtype=bool)
+
+    @staticmethod
+    def get_repeated_value_count(waypoint_count: int):
+        return 24 * waypoint_count
+
+    def get_repeated_values(self):
+        starts_x = np.array([self.left_x, self.right_x])
+        starts_y = np.array([self.left_y, self.right_y])
+        sides = (starts_x, starts_y, np.roll(starts_x, -1, axis=1) - starts_x, np.roll(starts_y, -1, axis=1) - starts_y)
+        return np.concatenate([np.concatenate((a, a)) for a in (self.left_x, self.left_y, self.right_x, self.right_y)] +
+                              [np.concatenate((a, a), axis=1).ravel() for a in sides])
+
+    def get_first_exit_index(self, point, heading: float, start_id: int):
+        waypoint_count = len(self._processed_waypoints)
+        checked = min(self.SCALAR_EXIT_SEARCH_LENGTH, waypoint_count)
+        for i in range(start_id, start_id + checked):
+            w = self._processed_waypoints[i % waypoint_count]
+            if not is_heading_between_points(point, heading, w.left_safe, w.right_safe):
+                return i % waypoint_count
+
+        # Then check ever larger runs of waypoints at once, since the ray could go a long way down a straight
+        (x, y) = point
+        while checked < waypoint_count:
+            size = min(checked * 4, waypoint_count - checked)
+            exits = self._get_exits_from_point(x, y, heading, start_id + checked, size)
+            first_exit = int(exits.argmax())
+            if exits[first_exit]:
+                return (start_id + checked + first_exit) % waypoint_count
+            checked += size
+
+        return None
+
+    def _get_exits_from_point(self, x: float, y: float, heading: float, first_id: int, size: int):
+        # Exactly the same as _get_exits() for one point and a run of waypoints, but in the working space
+        (left_x, left_y, right_x, right_y) = self._doubled_edges
+        (relative_left, relative_right, differences) = self._scratch_bearings[:, :size]
+        (exits, is_over, is_under) = self._scratch_flags[:, :size]
+        for (relative, edge_x, edge_y) in [(relative_left, left_x, left_y), (relative_right, right_x, right_y)]:
+            np.subtract(edge_y[first_id:first_id + size], y, out=differences)
+            np.subtract(edge_x[first_id:first_id + size], x, out=relative)
+            np.arctan2(differences, relative, out=relative)
+            np.degrees(relative, out=relative)
+            np.subtract(relative, heading, out=relative)
+            np.greater_equal(relative, 180.0, out=is_over)
+            np.less_equal(relative, -180.0, out=is_under)
+            for (is_outside, turn) in [(is_over, -360.0), (is_under, 360.0)]:
+                np.copyto(differences, is_outside)
+                np.multiply(differences, turn, out=differences)
+                np.add(relative, differences, out=relative)
+        np.less(relative_left, 0.0, out=exits)
+        np.greater(relative_right, 0.0, out=is_over)
+        return np.logical_or(exits, is_over, out=exits)
+
+    def get_first_exit_indexes(self, x, y, heading, start_ids):
+        # The ray nearly always leaves the track within a few waypoints, so check those first and only check
+        # the whole track for any rows that get further
+        waypoint_count = len(self.left_x)
+        window_ids = (start_ids[:, None] + np.arange(min(self.EXIT_SEARCH_WINDOW, waypoint_count))) % waypoint_count
+        exits = self._get_exits(x[:, None], y[:, None], heading[:, None], window_ids)
+
+        exit_ids = window_ids[np.arange(len(x)), exits.argmax(axis=1)]
+        has_exit = exits.any(axis=1)
+
+        remaining_rows = np.flatnonzero(~has_exit)
+        all_ids = np.arange(waypoint_count)
+        for first in range(0, len(remaining_rows), self.MAX_BATCH_ROWS):
+            rows = remaining_rows[first:first + self.MAX_BATCH_ROWS]
+            exits = self._get_exits(x[rows, None], y[rows, None], heading[rows, None], all_ids)
+            exits_after_start = exits & (all_ids >= start_ids[rows, None])
+            exit_ids[rows] = np.where(exits_after_start.any(axis=1), exits_after_start.argmax(axis=1),
+                                      exits.argmax(axis=1))
+            has_exit[rows] = exits.any(axis=1)
+
+        return exit_ids, has_exit
+
+    def get_edge_distances(self, point, headings, start_id: int):
+        # Distance along each ray from the point to where it first crosses a safe edge (starting from the segments
+        # after start_id), checking ever larger runs of waypoints until every ray has crossed an edge
+        (x, y) = point
+        radians = np.radians(headings)
+        (direction_x, direction_y) = (np.cos(radians)[:, None], np.sin(radians)[:, None])
+
+        waypoint_count = len(self.left_x)
+        distances = np.full(len(headings), np.inf)
+        checked = 0
+        size = min(self.EXIT_SEARCH_WINDOW, waypoint_count)
+        while checked < waypoint_count:
+            waypoint_ids = slice(start_id + checked, start_id + checked + size)
+            sides = [a[:, waypoint_ids].reshape(-1) for a in self._edge_sides]
+            distances = np.where(np.isfinite(distances), distances,
+                                 get_ray_hit_distances(x, y, direction_x, direction_y, *sides))
+            if np.isfinite(distances).all():
+                break
+            checked += size
+            size = min(checked * 4, waypoint_count - checked)
+
+        return np.where(np.isfinite(distances), distances, 0.0)
+
+    def _get_exits(self, x, y, heading, waypoint_ids, edges=None):
+        (left_x, left_y, right_x, right_y) = edges or (self.left_x, self.left_y, self.right_x, self.right_y)
+        relative_left = get_angles_in_proper_range(
+            get_bearings_between_points(x, y, left_x[waypoint_ids], left_y[waypoint_ids]) - heading)
+        relative_right = get_angles_in_proper_range(
+            get_bearings_between_points(x, y, right_x[waypoint_ids], right_y[waypoint_ids]) - heading)
+        return (relative_left < 0) | (relative_right > 0)
+
+
+def get_cached_track_edge_arrays(track_hash: str, processed_waypoints):
+    edge_arrays = TrackEdgeArrays._arrays.get(track_hash)
+    if edge_arrays is not None:
+        TrackEdgeArrays._arrays.move_to_end(track_hash)
+        return edge_arrays
+
+    data = None
+    if SharedTrackMemory.ENABLED:
+        data = get_shared_track_data("edges-" + track_hash,
+                                     8 * TrackEdgeArrays.get_repeated_value_count(len(processed_waypoints)),
+                                     lambda buffer: np.copyto(np.frombuffer(buffer, dtype=float), TrackEdgeArrays(
+                                         processed_waypoints).get_repeated_values()))
+    edge_arrays = TrackEdgeArrays(processed_waypoints, np.frombuffer(data, dtype=float) if data is not None else None)
+
+    TrackEdgeArrays._arrays[track_hash] = edge_arrays
+    while len(TrackEdgeArrays._arrays) > TrackGeometryCache.MAX_TRACKS_IN_MEMORY:
+        TrackEdgeArrays._arrays.popitem(last=False)
+
+    return edge_arrays
+
+
+# -------------------------------------------------------------------------------
+#
+# OPTIONAL DISTANCE FIELD OF THE TRACK (ONLY USED IF NUMPY IS AVAILABLE)
+#
+# -------------------------------------------------------------------------------
+
+class TrackDistanceField:
+    MARGIN = 1.0            # Meters of grid beyond the safe edges, all around the track
+    BUILD_CHUNK_SIZE = 4096     # Grid points measured at once when building
+
+    _fields = OrderedDict()
+
+    def __init__(self, waypoints, track_width: float, resolution: float):
+        self.resolution = resolution
+        self.safe_half_width = track_width / 2 + RealWorld.SAFE_CAR_OVERHANG
+        points = np.array(waypoints, dtype=float).reshape(-1, 2)
+        border = self.safe_half_width + self.MARGIN
+        (self.min_x, self.min_y) = points.min(axis=0) - border
+        (max_x, max_y) = points.max(axis=0) + border
+        self.columns = int(math.ceil((max_x - self.min_x) / resolution)) + 1
+        self.rows = int(math.ceil((max_y - self.min_y) / resolution)) + 1
+        self._segments = (points, np.roll(points, -1, axis=0) - points)
+
+        # Distance to the nearest safe edge at each grid point (row for y, column for x), positive on the track
+        self.values = None
+
+    def build_values(self):
+        # The safe edges are measured from the center line, the same as distance_from_center
+        (starts, sides) = self._segments
+        lengths_squared = (sides * sides).sum(axis=1)
+        lengths_squared[lengths_squared == 0.0] = 1.0   # Zero length segments just measure to their start point
+
+        grid_x = self.min_x + np.arange(self.columns) * self.resolution
+        grid_y = self.min_y + np.arange(self.rows) * self.resolution
+        (all_x, all_y) = (np.tile(grid_x, self.rows), np.repeat(grid_y, self.columns))
+
+        values = np.empty(self.rows * self.columns)
+        for first in range(0, len(values), self.BUILD_CHUNK_SIZE):
+            x = all_x[first:first + self.BUILD_CHUNK_SIZE, None]
+            y = all_y[first:first + self.BUILD_CHUNK_SIZE, None]
+            fractions = np.clip(((x - starts[:, 0]) * sides[:, 0] + (y - starts[:, 1]) * sides[:, 1]) /
+                                lengths_squared, 0.0, 1.0)
+            distances = get_distances_between_points(x, y, starts[:, 0] + fractions * sides[:, 0],
+                                                     starts[:, 1] + fractions * sides[:, 1])
+            values[first:first + self.BUILD_CHUNK_SIZE] = self.safe_half_width - distances.min(axis=1)
+        return values.reshape(self.rows, self.columns)
+
+    def get_edge_distance(self, point):
+        # Bilinear interpolation, so within about the resolution of the exact distance; points beyond the grid are
+        # measured from the nearest grid point, which is always well off the track
+        column = (point[0] - self.min_x) / self.resolution
+        row = (point[1] - self.min_y) / self.resolution
+        clamped_column = min(max(column, 0.0), self.columns - 1.000001)
+        clamped_row = min(max(row, 0.0), self.rows - 1.000001)
+        (i, j) = (int(clamped_row), int(clamped_column))
+        (row_fraction, column_fraction) = (clamped_row - i, clamped_column - j)
+
+        values = self.values
+        lower = values.item(i, j) + (values.item(i, j + 1) - values.item(i, j)) * column_fraction
+        upper = values.item(i + 1, j) + (values.item(i + 1, j + 1) - values.item(i + 1, j)) * column_fraction
+        distance = lower + (upper - lower) * row_fraction
+
+        if clamped_column != column or clamped_row != row:
+            distance -= math.hypot(column - clamped_column, row - clamped_row) * self.resolution
+        return distance
+
+    def get_edge_distances(self, x, y):
+        # Same as get_edge_distance() for many points at once
+        column = (np.asarray(x, dtype=float) - self.min_x) / self.resolution
+        row = (np.asarray(y, dtype=float) - self.min_y) / self.resolution
+        clamped_column = np.clip(column, 0.0, self.columns - 1.000001)
+        clamped_row = np.clip(row, 0.0, self.rows - 1.000001)
+        (i, j) = (clamped_row.astype(int), clamped_column.astype(int))
+        (row_fraction, column_fraction) = (clamped_row - i, clamped_column - j)
+
+        values = self.values
+        lower = values[i, j] + (values[i, j + 1] - values[i, j]) * column_fraction
+        upper = values[i + 1, j] + (values[i + 1, j + 1] - values[i + 1, j]) * column_fraction
+        distance = lower + (upper - lower) * row_fraction
+        return distance - np.hypot(column - clamped_column, row - clamped_row) * self.resolution
+
+
+def get_cached_distance_field(waypoints, track_width: float, resolution: float):
+    key = get_track_hash(waypoints, track_width) + "-" + repr(resolution)
+
+    distance_field = TrackDistanceField._fields.get(key)
+    if distance_field is not None:
+        TrackDistanceField._fields.move_to_end(key)
+        return distance_field
+
+    distance_field = TrackDistanceField(waypoints, track_width, resolution)
+    shape = (distance_field.rows, distance_field.columns)
+    values = None
+    if SharedTrackMemory.ENABLED:
+        data = get_shared_track_data("field-" + key, 8 * distance_field.rows * distance_field.columns,
+                                     lambda buffer: np.copyto(np.frombuffer(buffer, dtype=float).reshape(shape),
+                                                              _load_distance_field_values(distance_field, key)))
+        if data is not None:
+            values = np.frombuffer(data, dtype=float).reshape(shape)
+
+    if values is None:
+        values = _load_distance_field_values(distance_field, key)
+    distance_field.values = values
+
+    TrackDistanceField._fields[key] = distance_field
+    while len(TrackDistanceField._fields) > TrackGeometryCache.MAX_TRACKS_IN_MEMORY:
+        TrackDistanceField._fields.popitem(last=False)
+
+    return distance_field
+
+
+def _load_distance_field_values(distance_field: TrackDistanceField, key: str):
+    values = None
+    file_name = None
+    if TrackGeometryCache.FILE_DIRECTORY:
+        file_name = os.path.join(TrackGeometryCache.FILE_DIRECTORY, "drf-field-" + key + ".npy")
+        try:
+            values = np.load(file_name, mmap_mode="r")
+        except (OSError, ValueError):
+            values = None
+        if values is not None and values.shape != (distance_field.rows, distance_field.columns):
+            values = None
+
+    if values is None:
+        values = distance_field.build_values()
+        if file_name:
+            _write_array_file(file_name, values)
+    return values
+
+
+def _write_array_file(file_name, values):
+    temporary_file_name = file_name + "." + str(os.getpid()) + ".tmp.npy"
+    try:
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        np.save(temporary_file_name, values)
+        os.replace(temporary_file_name, file_name)
+    except OSError:
+        pass    # The file cache is only an optimization
+
+
+# -------------------------------------------------------------------------------
+#
+# OPTIONAL RACING LINE, SOLVED ONCE PER TRACK (ONLY IF NUMPY IS AVAILABLE)
+#
+# -------------------------------------------------------------------------------
+
+class RacingLine:
+    MAX_ITERATIONS = 10000
+    TOLERANCE = 0.00001     # Meters, the solver stops once no point moves further than this in one iteration
+
+    # For each waypoint, the point on the racing line level with it, the end of the run of the racing line from there
+    # to the next point (skipping repeated waypoints), and the bearing of that run
+    VALUE_COUNT = 5
+
+    _lines = OrderedDict()
+
+    def __init__(self, values):
+        # The values are used where they are (e.g. in shared memory), rather than copied
+        self._values = values
+
+    @staticmethod
+    def get_values(points):
+        values = array("d")
+        for i, start in enumerate(points):
+            finish = start
+            for j in range(i + 1, i + len(points)):
+                finish = points[j % len(points)]
+                if finish != start:
+                    break
+            values.extend((*start, *finish, get_bearing_between_points(start, finish)))
+        return values
+
+    def get_distance_and_bearing(self, point, waypoint_id: int):
+        (v, i) = (self._values, waypoint_id * RacingLine.VALUE_COUNT)
+        return get_distance_from_line_segment(point, (v[i], v[i + 1]), (v[i + 2], v[i + 3])), v[i + 4]
+
+
+def solve_racing_line(processed_waypoints, margin: float):
+    # Minimum curvature line, where each waypoint slides across the track between its safe edges (less the margin).
+    # The curvature at each point is the second derivative along the center line, and the sum of its squares
+    # (weighted by length) is minimized by accelerated projected gradient descent, with the step for each point
+    # scaled by a bound on its row of the Hessian, so unevenly spaced waypoints still converge quickly
+    repeats = [i > 0 and (w.x, w.y) == (processed_waypoints[i - 1].x, processed_waypoints[i - 1].y)
+               for i, w in enumerate(processed_waypoints)]
+    first = processed_waypoints[0]
+    last = processed_waypoints[-1]
+    is_closed = len(processed_waypoints) > 1 and (last.x, last.y) == (first.x, first.y)
+    ids = [i for i, is_repeat in enumerate(repeats) if not is_repeat and not (is_closed and i == len(repeats) - 1)]
+    if len(ids) < 3:
+        return np.array([(w.x, w.y) for w in processed_waypoints], dtype=float)
+
+    centre = np.array([(processed_waypoints[i].x, processed_waypoints[i].y) for i in ids], dtype=float)
+    right = np.array([processed_waypoints[i].right_safe for i in ids], dtype=float)
+    across = np.array([processed_waypoints[i].left_safe for i in ids], dtype=float) - right
+    widths = np.sqrt((across * across).sum(axis=1))
+    low = np.minimum(margin / np.maximum(widths, 1e-9), 0.5)
+    high = 1.0 - low
+
+    steps = np.roll(centre, -1, axis=0) - centre
+    next_lengths = np.sqrt((steps * steps).sum(axis=1))
+    previous_lengths = np.roll(next_lengths, 1)
+    before = 2 / (previous_lengths * (previous_lengths + next_lengths))
+    after = 2 / (next_lengths * (previous_lengths + next_lengths))
+    here = -(before + after)
+    weights = (previous_lengths + next_lengths) / 2
+
+    bounds = before * np.roll(widths, 1) - here * widths + after * np.roll(widths, -1)
+    rates = 1 / (2 * widths * (np.roll(before * weights * bounds, -1) - here * weights * bounds +
+                               np.roll(after * weights * bounds, 1)))
+
+    def get_gradient(fractions):
+        points = right + fractions[:, None] * across
+        curvatures = (before[:, None] * np.roll(points, 1, axis=0) + here[:, None] * points +
+                      after[:, None] * np.roll(points, -1, axis=0)) * weights[:, None]
+        return 2 * ((np.roll(before[:, None] * curvatures, -1, axis=0) + here[:, None] * curvatures +
+                     np.roll(after[:, None] * curvatures, 1, axis=0)) * across).sum(axis=1)
+
+    fractions = np.full(len(ids), 0.5)
+    momentum_point = fractions
+    momentum = 1.0
+    for _ in range(RacingLine.MAX_ITERATIONS):
+        new_fractions = np.clip(momentum_point - get_gradient(momentum_point) * rates, low, high)
+        if ((momentum_point - new_fractions) * (new_fractions - fractions)).sum() > 0:
+            momentum = 1.0  # Going uphill, so start the momentum again
+        next_momentum = (1 + math.sqrt(1 + 4 * momentum * momentum)) / 2
+        momentum_point = new_fractions + (momentum - 1) / next_momentum * (new_fractions - fractions)
+        momentum = next_momentum
+        largest_move = (np.abs(new_fractions - fractions) * widths).max()
+        fractions = new_fractions
+        if largest_move < RacingLine.TOLERANCE:
+            break
+
+    # Repeated waypoints share the point of the waypoint they repeat
+    solved = right + fractions[:, None] * across
+    points = np.empty((len(processed_waypoints), 2))
+    solved_id = -1
+    for i, is_repeat in enumerate(repeats):
+        if not is_repeat:
+            solved_id += 1
+        points[i] = solved[min(solved_id, len(ids) - 1)]
+    if is_closed:
+        points[-1] = solved[0]
+    return points
+
+
+def get_cached_racing_line(waypoints, track_width: float, processed_waypoints, margin: float):
+    key = get_track_hash(waypoints, track_width) + "-" + repr(margin)
+
+    racing_line = RacingLine._lines.get(key)
+    if racing_line is not None:
+        RacingLine._lines.move_to_end(key)
+        return racing_line
+
+    def get_values():
+        points = _load_racing_line_points(processed_waypoints, margin, key)
+        return RacingLine.get_values([tuple(p) for p in points.tolist()])
+
+    def build(buffer):
+        buffer.cast("d")[:] = get_values()
+
+    data = None
+    if SharedTrackMemory.ENABLED:
+        data = get_shared_track_data("line-" + key, 8 * RacingLine.VALUE_COUNT * len(waypoints), build)
+    racing_line = RacingLine(data.cast("d") if data is not None else get_values())
+
+    RacingLine._lines[key] = racing_line
+    while len(RacingLine._lines) > TrackGeometryCache.MAX_TRACKS_IN_MEMORY:
+        RacingLine._lines.popitem(last=False)
+
+    return racing_line
+
+
+def _load_racing_line_points(processed_waypoints, margin: float, key: str):
+    points = None
+    file_name = None
+    if TrackGeometryCache.FILE_DIRECTORY:
+        file_name = os.path.join(TrackGeometryCache.FILE_DIRECTORY, "drf-line-" + key + ".npy")
+        try:
+            points = np.load(file_name)
+        except (OSError, ValueError):
+            points = None
+        if points is not None and points.shape != (len(processed_waypoints), 2):
+            points = None
+
+    if points is None:
+        points = solve_racing_line(processed_waypoints, margin)
+        if file_name:
+            _write_array_file(file_name, points)
+    return points
+
+
+# -------------------------------------------------------------------------------
+#
+# OPTIONAL TABLE OF PROJECTIONS, BUILT OFFLINE (ONLY USED IF NUMPY IS AVAILABLE)
+#
+# -------------------------------------------------------------------------------
+
+class ProjectionTable:
+    FILE_MAGIC = b"DRFP"
+    FILE_VERSION = 2
+    FILE_HEADER_FORMAT = "<4sI40s3I3d"
+
+    # Values for each position along the track, offset from center (left is positive) and heading relative to the
+    # track bearing (left is positive): the projected distance, projected progress distance, finish left (0 or 1) and
+    # the estimated interpolation error of the cell that starts at this sample (infinity if unusable)
+    #
+    # The estimated error is the largest difference from the interpolation at the middle of each edge and face of the
+    # cell and at its middle, so it is not a strict bound: the error could be larger somewhere in between, e.g. near
+    # the corner of a wall. Cells that cross a waypoint are never used, since the track bearing (and so the meaning of
+    # the relative heading) changes there
+    VALUE_COUNT = 4
+
+    def __init__(self, track_hash: str, track_length: float, max_offset: float, max_heading: float, values):
+        self.track_hash = track_hash
+        self.max_offset = max_offset
+        self.max_heading = max_heading
+        self.values = values
+        (self.position_count, self.offset_count, self.heading_count) = values.shape[:3]
+        self.position_step = track_length / self.position_count
+        self.offset_step = 2 * max_offset / (self.offset_count - 1)
+        self.heading_step = 2 * max_heading / (self.heading_count - 1)
+
+    def get_axes(self):
+        positions = [i * self.position_step for i in range(self.position_count)]
+        offsets = [j * self.offset_step - self.max_offset for j in range(self.offset_count)]
+        headings = [k * self.heading_step - self.max_heading for k in range(self.heading_count)]
+        return positions, offsets, headings
+
+    def look_up(self, position: float, offset: float, relative_heading: float, max_error: float,
+                max_relative_error: float):
+        # Interpolates between the eight surrounding samples, but only if the interpolation error estimated when the
+        # table was built is well within max_error plus max_relative_error of the distance, otherwise returns None
+        # (doubled for safety, since the error is only an estimate)
+        j = (offset + self.max_offset) / self.offset_step
+        k = (relative_heading + self.max_heading) / self.heading_step
+        if not (0.0 <= j <= self.offset_count - 1 and 0.0 <= k <= self.heading_count - 1):
+            return None
+        i = position / self.position_step
+        i0 = int(i)
+        j0 = min(int(j), self.offset_count - 2)
+        k0 = min(int(k), self.heading_count - 2)
+        (i_fraction, j_fraction, k_fraction) = (i - i0, j - j0, k - k0)
+        i0 %= self.position_count
+        i1 = i0 + 1 if i0 + 1 < self.position_count else 0
+
+        cell_error = self.values.item(i0, j0, k0, 3)
+        if 2 * cell_error > max_error + max_relative_error * self.values.item(i0, j0, k0, 0):
+            return None
+
+        distance = 0.0
+        progress_distance = 0.0
+        for (row, i_weight) in [(i0, 1 - i_fraction), (i1, i_fraction)]:
+            ((first, second), (third, fourth)) = self.values[row, j0:j0 + 2, k0:k0 + 2].tolist()
+            for (sample, weight) in [(first, (1 - j_fraction) * (1 - k_fraction)),
+                                     (second, (1 - j_fraction) * k_fraction),
+                                     (third, j_fraction * (1 - k_fraction)),
+                                     (fourth, j_fraction * k_fraction)]:
+                distance += i_weight * weight * sample[0]
+                progress_distance += i_weight * weight * sample[1]
+        return distance, progress_distance, self.values.item(i0, j0, k0, 2) == 1.0
+
+    def write(self, file_name):
+        header = struct.pack(ProjectionTable.FILE_HEADER_FORMAT, ProjectionTable.FILE_MAGIC,
+                             ProjectionTable.FILE_VERSION, self.track_hash.encode("ascii"), self.position_count,
+                             self.offset_count, self.heading_count, self.position_step * self.position_count,
+                             self.max_offset, self.max_heading)
+
+        # Write then rename, so other processes never see a partly written file
+        temporary_file_name = file_name + "." + str(os.getpid()) + ".tmp"
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        with open(temporary_file_name, "wb") as file:
+            file.write(header)
+            file.write(np.ascontiguousarray(self.values, dtype="<f4").tobytes())
+        os.replace(temporary_file_name, file_name)
+
+
+def read_projection_table(file_name):
+    # The values are memory-mapped, so every process using the same file shares one copy
+    header_size = struct.calcsize(ProjectionTable.FILE_HEADER_FORMAT)
+    try:
+        with open(file_name, "rb") as file:
+            header = file.read(header_size)
+    except OSError:
+        return None
+    if len(header) != header_size:
+        return None
+
+    (magic, version, track_hash, position_count, offset_count, heading_count, track_length, max_offset,
+     max_heading) = struct.unpack(ProjectionTable.FILE_HEADER_FORMAT, header)
+    if magic != ProjectionTable.FILE_MAGIC or version != ProjectionTable.FILE_VERSION:
+        return None
+
+    shape = (position_count, offset_count, heading_count, ProjectionTable.VALUE_COUNT)
+    try:
+        values = np.memmap(file_name, dtype="<f4", mode="r", offset=header_size, shape=shape).view(np.ndarray)
+    except (OSError, ValueError):
+        return None
+    return ProjectionTable(track_hash.decode("ascii"), track_length, max_offset, max_heading, values)
+
+
+# -------------------------------------------------------------------------------
+#
+# COLLISION PREDICTION, ASSUMING EVERYTHING CONTINUES AT CONSTANT VELOCITY
+#
+# -------------------------------------------------------------------------------
+
+# Relative position (rx, ry) and relative velocity (vx, vy) of an object, as seen from the car
+# Returns the time until the object is within collision_distance (or None), and the closest it gets within time_horizon
+
+def get_collision_prediction(rx: float, ry: float, vx: float, vy: float, collision_distance: float,
+                             time_horizon: float):
+    a = vx * vx + vy * vy
+    b = rx * vx + ry * vy
+    c = rx * rx + ry * ry - collision_distance * collision_distance
+
+    if a > 0:
+        closest_time = min(max(-b / a, 0.0), time_horizon)
+    else:
+        closest_time = 0.0
+    closest_distance = math.sqrt((rx + vx * closest_time) ** 2 + (ry + vy * closest_time) ** 2)
+
+    if c <= 0:
+        return 0.0, closest_distance
+    discriminant = b * b - a * c
+    if b < 0 and discriminant >= 0:
+        collision_time = (-b - math.sqrt(discriminant)) / a
+        if collision_time <= time_horizon:
+            return collision_time, closest_distance
+    return None, closest_distance
+
+
+# Same for all objects at once, except that no collision is shown as infinity rather than None
+
+def get_collision_predictions(rx, ry, vx, vy, collision_distance: float, time_horizon: float):
+    a = vx * vx + vy * vy
+    b = rx * vx + ry * vy
+    c = rx * rx + ry * ry - collision_distance * collision_distance
+
+    a = np.where(a > 0, a, 1.0)     # No relative movement means b is zero too, so no collision unless already close
+    closest_time = np.minimum(np.maximum(-b / a, 0.0), time_horizon)
+    discriminant = b * b - a * c
+    collision_time = (-b - np.sqrt(np.maximum(discriminant, 0.0))) / a
+    collision_time[(b >= 0) | (discriminant < 0) | (collision_time > time_horizon)] = np.inf
+    collision_time[c <= 0] = 0.0
+    closest_distance = np.hypot(rx + vx * closest_time, ry + vy * closest_time)
+    return collision_time, closest_distance
+
+
+# -------------------------------------------------------------------------------
+#
+# REMEMBER RECENT STEPS IN THIS EPISODE
+#
+# -------------------------------------------------------------------------------
+
+class StepHistory:
+    __slots__ = ("capacity", "speed_window", "slide_window", "count",
+                 "x", "y", "progress", "action_speed", "action_steering_angle", "next_waypoint_id", "slide", "distance",
+                 "_latest", "_speed_window_distance", "_recent_slide_steps", "_recent_slide_values",
+                 "_recent_slides_first", "_recent_slides_length")
+
+    def __init__(self, capacity: int, speed_window: int, slide_window: int):
+        assert 2 <= speed_window <= capacity
+        assert 1 <= slide_window <= capacity
+
+        self.capacity = capacity
+        self.speed_window = speed_window
+        self.slide_window = slide_window
+
+        self.x = array("d", bytes(8 * capacity))
+        self.y = array("d", bytes(8 * capacity))
+        self.progress = array("d", bytes(8 * capacity))
+        self.action_speed = array("d", bytes(8 * capacity))
+        self.action_steering_angle = array("d", bytes(8 * capacity))
+        self.next_waypoint_id = array("q", bytes(8 * capacity))
+        self.slide = array("d", bytes(8 * capacity))
+        self.distance = array("d", bytes(8 * capacity))
+
+        # Step numbers and slides, in order, such that no slide is smaller than any later one (so the first is the max),
+        # in a ring buffer since there are never more than the window size of them
+        self._recent_slide_steps = array("q", bytes(8 * slide_window))
+        self._recent_slide_values = array("d", bytes(8 * slide_window))
+
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self._latest = -1
+        self._speed_window_distance = 0.0
+        self._recent_slides_first = 0
+        self._recent_slides_length = 0
+
+    def get_index(self, steps_back: int):
+        assert 0 <= steps_back < min(self.count, self.capacity)
+        return (self._latest - steps_back) % self.capacity
+
+    def add_step(self, x: float, y: float, progress: float, action_speed: float, action_steering_angle: float,
+                 next_waypoint_id: int, slide: float):
+        if self.count > 0:
+            distance = get_distance_between_points((self.x[self._latest], self.y[self._latest]), (x, y))
+        else:
+            distance = 0.0  # Causes issues if we use: framework.progress / 100 * framework.track_length
+
+        if self.count >= self.speed_window:
+            self._speed_window_distance -= self.distance[self.get_index(self.speed_window - 1)]
+
+        self._latest = (self._latest + 1) % self.capacity
+        self.count += 1
+
+        i = self._latest
+        self.x[i] = x
+        self.y[i] = y
+        self.progress[i] = progress
+        self.action_speed[i] = action_speed
+        self.action_steering_angle[i] = action_steering_angle
+        self.next_waypoint_id[i] = next_waypoint_id
+        self.slide[i] = slide
+        self.distance[i] = distance
+
+        if i == 0:
+            # Avoid any drift in the running total by occasionally adding it up again from scratch
+            self._speed_window_distance = sum(self.distance[self.get_index(s)]
+                                              for s in range(min(self.count, self.speed_window)))
+        else:
+            self._speed_window_distance += distance
+
+        # The oldest one leaves the window first, to make room
+        window = self.slide_window
+        first = self._recent_slides_first
+        length = self._recent_slides_length
+        if length > 0 and self._recent_slide_steps[first] <= self.count - window:
+            first = (first + 1) % window
+            length -= 1
+        while length > 0 and abs(self._recent_slide_values[(first + length - 1) % window]) < abs(slide):
+            length -= 1
+        self._recent_slide_steps[(first + length) % window] = self.count
+        self._recent_slide_values[(first + length) % window] = slide
+        self._recent_slides_first = first
+        self._recent_slides_length = length + 1
+
+        return distance
+
+    def get_track_speed(self):
+        steps_in_window = min(self.count, self.speed_window)
+        return self._speed_window_distance / (steps_in_window / RealWorld.STEPS_PER_SECOND)
+
+    def get_progress_speed(self, steps: int, track_length: float):
+        if steps >= min(self.count, self.capacity):
+            return None
+
+        progress_speed_distance = (self.progress[self._latest] - self.progress[self.get_index(steps)]) / 100 * track_length
+        progress_speed_calculate_time = steps / RealWorld.STEPS_PER_SECOND
+        return max(0.0, progress_speed_distance / progress_speed_calculate_time)
+
+    def get_recent_max_slide(self):
+        recent_max_slide = self._recent_slide_values[self._recent_slides_first]
+        if recent_max_slide == 0.0:
+            return 0.0
+        else:
+            return recent_max_slide
+
+
+# -------------------------------------------------------------------------------
+#
+# OPTIONAL TIMINGS AND COUNTS FOR EACH STAGE OF EACH STEP
+#
+# -------------------------------------------------------------------------------
+
+class StepInstrumentation:
+    def __init__(self):
+        self.current_stage = None
+        self.last_step_timings = {}  # Nanoseconds per stage, for the most recent step only
+        self._stage_started = 0
+        self._episode_steps = 0
+        self._episode_timings = {}
+        self._episode_max_timings = {}
+        self._episode_counts = {}
+
+    def start_step(self, is_new_episode: bool):
+        if self.current_stage is not None:
+            self.end_step()
+        if is_new_episode:
+            self.reset_episode()
+        self._episode_steps += 1
+        self.last_step_timings = {}
+
+    def start_stage(self, stage: str):
+        # Returns the stage that was running, so a nested calculation can resume it afterwards
+        now = time.perf_counter_ns()
+        previous_stage = self.current_stage
+        if previous_stage is not None:
+            self.last_step_timings[previous_stage] = (self.last_step_timings.get(previous_stage, 0) +
+                                                      now - self._stage_started)
+        self.current_stage = stage
+        self._stage_started = now
+        return previous_stage
+
+    def end_step(self):
+        self.start_stage(None)
+        self.last_step_timings["total"] = sum(self.last_step_timings.values())
+        for stage, nanoseconds in self.last_step_timings.items():
+            self._episode_timings[stage] = self._episode_timings.get(stage, 0) + nanoseconds
+            self._episode_max_timings[stage] = max(self._episode_max_timings.get(stage, 0), nanoseconds)
+
+    def count(self, name: str, amount: int = 1):
+        self._episode_counts[name] = self._episode_counts.get(name, 0) + amount
+
+    def reset_episode(self):
+        self._episode_steps = 0
+        self._episode_timings = {}
+        self._episode_max_timings = {}
+        self._episode_counts = {}
+
+    def get_episode_summary(self):
+        steps = max(1, self._episode_steps)
+        return {
+            "steps": self._episode_steps,
+            "mean_us": {stage: round(total / steps / 1000, 1) for stage, total in self._episode_timings.items()},
+            "max_us": {stage: round(value / 1000, 1) for stage, value in self._episode_max_timings.items()},
+            "counts": dict(self._episode_counts)
+        }
+
+    def print_episode_summary(self):
+        print(*self.get_episode_summary_line())
+
+    def get_episode_summary_line(self):
+        return "DRG-TIMINGS:", json.dumps(self.get_episode_summary(), separators=(",", ":"))
+
+
+# -------------------------------------------------------------------------------
+#
+# TELEMETRY, OPTIONALLY BUFFERED AND WRITTEN ONCE PER EPISODE
+#
+# -------------------------------------------------------------------------------
+
+class StepTelemetry:
+    # Each line is kept as the values that would have been printed, and only turned into text when it is written.
+    # All kinds of line share one buffer in the order they were written, so the output of each step stays together,
+    # and a full buffer is written straight away rather than dropping anything.  The limit on lines of each kind only
+    # counts; a group of lines (e.g. one call of print_debug()) is always kept or dropped as a whole
+    UNBUFFERED_KINDS = ("objects", "warning")   # Always printed immediately, never sampled or limited
+
+    def __init__(self, capacity: int, sample_steps: int, max_lines_per_kind: int, is_buffered: bool):
+        self._capacity = max(1, capacity)
+        self._lines = [None] * self._capacity
+        self._line_count = 0
+        self._sample_steps = max(1, sample_steps)
+        self._max_lines_per_kind = max_lines_per_kind
+        self._is_buffered = is_buffered
+        self._kind_counts = {}
+        self._dropped_count = 0
+        self._last_step = 0
+        if is_buffered:
+            # For callers of process_params() that never reach the flush in reward_function()
+            atexit.register(self.flush)
+
+    def write(self, kind: str, step: int, values: tuple, is_sampled: bool = False):
+        # Returns False if the line was dropped because of sampling or the limit on lines of each kind
+        self._last_step = step
+        if kind in self.UNBUFFERED_KINDS:
+            print(*values)
+            return True
+        if is_sampled and step % self._sample_steps != 0:
+            return False
+        if not self._count_lines(kind, 1):
+            return False
+        if self._is_buffered:
+            self._keep_line(values)
+        else:
+            print(*values)
+        return True
+
+    def write_group(self, kind: str, step: int, lines: list, is_sampled: bool = False):
+        # Like write() for several lines that belong together (e.g. one call of print_debug()), which are all kept or
+        # all dropped
+        self._last_step = step
+        is_unbuffered = kind in self.UNBUFFERED_KINDS
+        if not is_unbuffered:
+            if is_sampled and step % self._sample_steps != 0:
+                return False
+            if not self._count_lines(kind, len(lines)):
+                return False
+        for values in lines:
+            if self._is_buffered and not is_unbuffered:
+                self._keep_line(values)
+            else:
+                print(*values)
+        return True
+
+    def _count_lines(self, kind: str, line_count: int):
+        kind_count = self._kind_counts.get(kind, 0) + line_count
+        self._kind_counts[kind] = kind_count
+        if self._max_lines_per_kind is not None and kind_count > self._max_lines_per_kind:
+            self._dropped_count += line_count
+            return False
+        return True
+
+    def _keep_line(self, values: tuple):
+        line_count = self._line_count
+        self._lines[line_count] = values
+        self._line_count = line_count + 1
+        if line_count + 1 == self._capacity:
+            print(self._take_text())
+
+    def flush(self):
+        # The lines of the episode in one write, in the order they were written, plus a DRG-TELEMETRY line if any
+        # were dropped
+        texts = [self._take_text()] if self._line_count > 0 else []
+        if self._dropped_count > 0:
+            summary = {"steps": self._last_step, "lines": sum(self._kind_counts.values()) - self._dropped_count,
+                       "dropped": self._dropped_count, "kinds": self._kind_counts}
+            texts.append("DRG-TELEMETRY: " + json.dumps(summary, separators=(",", ":")))
+        if texts:
+            print("\n".join(texts))
+        self._kind_counts = {}
+        self._dropped_count = 0
+        self._last_step = 0
+
+    def _take_text(self):
+        lines = self._lines
+        line_count = self._line_count
+        text = "\n".join([" ".join([str(v) for v in values]) for values in lines[:line_count]])
+        for i in range(line_count):
+            lines[i] = None
+        self._line_count = 0
+        return text
+
+    def start_step(self, step: int):
+        # Anything left over from an episode that ended without a final step is written when the next one starts
+        if step < self._last_step:
+            self.flush()
+
+
+# -------------------------------------------------------------------------------
+#
+# PER-STEP ATTRIBUTES, WRITTEN AS TYPED COLUMNS ONCE PER EPISODE (FOR OFFLINE ANALYSIS)
+#
+# -------------------------------------------------------------------------------
+
+class StepFeatureColumns:
+    # Each column is a separate file of raw little-endian values, so every column can be memory-mapped on its own by
+    # read_step_features(), and the schema file lists the attributes with their types.  A list attribute (type ending
+    # "[]") has a flat column of all its values, plus a "_count" column of how many values there were in each step.
+    # Missing values (None) are written as NaN, -1 or False, and the "episode" column numbers the episodes.
+    SCHEMA_FILE_NAME = "schema.json"
+    SCHEMA_VERSION = 1
+    COLUMN_FILE_SUFFIX = ".bin"
+    TYPECODES = {"float64": "d", "int32": "i", "bool": "b"}
+    DTYPES = {"float64": "<f8", "int32": "<i4", "bool": "?"}
+    MISSING_VALUES = {"float64": math.nan, "int32": -1, "bool": False}
+
+    def __init__(self, directory: str, fields):
+        # The fields are (attribute name, type) pairs, in column order
+        self.directory = directory
+        self.fields = [("episode", "int32")] + list(fields)
+        self._episode_column = array("i")
+        self._scalar_columns = []
+        self._list_columns = []
+        self._files = [("episode", self._episode_column)]
+        for (name, kind) in self.fields[1:]:
+            value_kind = kind[:-2] if kind.endswith("[]") else kind
+            values = array(StepFeatureColumns.TYPECODES[value_kind])
+            missing_value = StepFeatureColumns.MISSING_VALUES[value_kind]
+            if kind.endswith("[]"):
+                counts = array("i")
+                self._list_columns.append((name, values, counts, missing_value))
+                self._files += [(name, values), (name + "_count", counts)]
+            else:
+                self._scalar_columns.append((name, values.append, missing_value))
+                self._files.append((name, values))
+        self._episode = 0
+        self._last_step = 0
+        self.is_usable = self._open_directory()
+
+    def _open_directory(self):
+        # Continues any columns already in the directory, but only if they have exactly the same schema
+        schema = {"version": StepFeatureColumns.SCHEMA_VERSION, "fields": [list(field) for field in self.fields]}
+        schema_file_name = os.path.join(self.directory, StepFeatureColumns.SCHEMA_FILE_NAME)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if os.path.exists(schema_file_name):
+                with open(schema_file_name) as file:
+                    if json.load(file) != schema:
+                        return False
+                with open(os.path.join(self.directory, "episode" + StepFeatureColumns.COLUMN_FILE_SUFFIX), "rb") as file:
+                    file.seek(0, os.SEEK_END)
+                    if file.tell() >= 4:
+                        file.seek(file.tell() // 4 * 4 - 4)
+                        self._episode = struct.unpack("<i", file.read(4))[0] + 1
+            else:
+                with open(schema_file_name, "w") as file:
+                    json.dump(schema, file)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def add_step(self, framework):
+        if framework.steps < self._last_step:
+            self.flush()
+        self._last_step = framework.steps
+        self._episode_column.append(self._episode)
+        for (name, append, missing_value) in self._scalar_columns:
+            value = getattr(framework, name)
+            append(missing_value if value is None else value)
+        for (name, values, counts, missing_value) in self._list_columns:
+            step_values = getattr(framework, name)
+            values.extend([missing_value if value is None else value for value in step_values])
+            counts.append(len(step_values))
+        if framework.is_final_step:
+            self.flush()
+
+    def flush(self):
+        # Appends the whole episode to the end of every column, one write per column
+        if len(self._episode_column) == 0:
+            return
+        for (name, values) in self._files:
+            if sys.byteorder != "little":
+                values.byteswap()
+            with open(os.path.join(self.directory, name + StepFeatureColumns.COLUMN_FILE_SUFFIX), "ab") as file:
+                values.tofile(file)
+            del values[:]
+        self._episode += 1
+        self._last_step = 0
+
+
+def read_step_features(directory: str):
+    # A dict of every column as a read-only NumPy array, memory-mapped so that only the parts actually used are read
+    # from disk, or None if the directory does not contain step features.  For a list attribute there is also a
+    # "_offsets" array, so that the values for step i are values[offsets[i]:offsets[i + 1]].
+    try:
+        with open(os.path.join(directory, StepFeatureColumns.SCHEMA_FILE_NAME)) as file:
+            schema = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if schema.get("version") != StepFeatureColumns.SCHEMA_VERSION:
+        return None
+
+    def read_column(name, kind, count=None):
+        dtype = np.dtype(StepFeatureColumns.DTYPES[kind])
+        file_name = os.path.join(directory, name + StepFeatureColumns.COLUMN_FILE_SUFFIX)
+        size = os.path.getsize(file_name) // dtype.itemsize if os.path.exists(file_name) else 0
+        count = size if count is None else min(count, size)
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_name, dtype=dtype, mode="r", shape=(count,)).view(np.ndarray)
+
+    # An episode that was only partly written (e.g. the process was stopped) is cut off where the shortest column ends
+    step_columns = {}
+    for (name, kind) in schema["fields"]:
+        if kind.endswith("[]"):
+            step_columns[name + "_count"] = read_column(name + "_count", "int32")
+        else:
+            step_columns[name] = read_column(name, kind)
+    step_count = min(len(column) for column in step_columns.values())
+    columns = {name: column[:step_count] for (name, column) in step_columns.items()}
+    for (name, kind) in schema["fields"]:
+        if kind.endswith("[]"):
+            offsets = np.zeros(step_count + 1, dtype=np.int64)
+            np.cumsum(columns[name + "_count"], out=offsets[1:])
+            columns[name + "_offsets"] = offsets
+            columns[name] = read_column(name, kind[:-2], int(offsets[-1]))
+    return columns
+
+
+# -------------------------------------------------------------------------------
+#
+# ATTRIBUTES THAT CAN BE CALCULATED ON FIRST USE IN EACH STEP
+#
+# -------------------------------------------------------------------------------
+
+class LazyStepAttribute:
+    def __init__(self, calculation_method_name: str):
+        self._calculation_method_name = calculation_method_name
+        self._value_name = None
+
+    def __set_name__(self, owner, name):
+        self._value_name = "_value_of_" + name
+
+    def __get__(self, framework, owner=None):
+        if framework is None:
+            return self
+        if self._calculation_method_name in framework._pending_calculations:
+            framework._pending_calculations.discard(self._calculation_method_name)
+            getattr(framework, self._calculation_method_name)()
+        return framework.__dict__[self._value_name]
+
+    def __set__(self, framework, value):
+        framework.__dict__[self._value_name] = value
 
 
 # -------------------------------------------------------------------------------
@@ -244,12 +2315,184 @@ class HistoricStep:
 # -------------------------------------------------------------------------------
 
 class Framework:
+    # How many recent steps are remembered, and how many are used to calculate track_speed and recent_max_slide
+    HISTORY_CAPACITY = 150
+    TRACK_SPEED_WINDOW = 6
+    RECENT_SLIDE_WINDOW = 4
+
+    # Distances ahead (in meters) for turns_ahead, and what counts as a corner (curvature is 1 / radius in meters)
+    CORNER_LOOK_AHEAD_DISTANCES = (1.0, 2.0, 4.0)
+    CORNER_SMOOTHING_DISTANCE = 0.5
+    CORNER_MIN_CURVATURE = 0.3
+
+    # Objects within this distance (in meters, center to center) count as a collision, predicted this far ahead (seconds)
+    COLLISION_DISTANCE = (RealWorld.VEHICLE_LENGTH + RealWorld.BOX_OBSTACLE_WIDTH) / 2
+    COLLISION_TIME_HORIZON = 3.0
+    SCALAR_COLLISION_MAX_OBJECTS = 16   # With more objects than this (and NumPy), they are all predicted at once
+
+    # Angles (relative to true_bearing) of the rays for lidar_distances, e.g. tuple(range(-30, 31, 5)), or none at all
+    LIDAR_ANGLES = ()
+
+    # Set to a grid size in meters (e.g. 0.05) to build a distance field of the track when NumPy is available, which
+    # makes get_edge_distance_at_point() etc. approximate but quicker (see README)
+    DISTANCE_FIELD_RESOLUTION = None
+    RAY_MARCHING_MIN_STEP = 0.01    # Meters, only used without a distance field
+
+    # Set to the name of a file made by the build_projection_table tool to look up the projections rather than
+    # calculate them (when NumPy is available), wherever the table's estimated error is within the max error in meters
+    # plus the max relative error (a fraction of the projected distance)
+    PROJECTION_TABLE_FILE = None
+    PROJECTION_TABLE_MAX_ERROR = 0.02
+    PROJECTION_TABLE_MAX_RELATIVE_ERROR = 0.05
+
+    # Set to True to solve a minimum curvature racing line once for the track (needs NumPy) for distance_from_racing_line
+    # and racing_line_bearing, kept this far inside the safe edges (meters, by default so all wheels stay on the track)
+    RACING_LINE = False
+    RACING_LINE_MARGIN = 2 * RealWorld.SAFE_CAR_OVERHANG
+
+    # Set to True to only calculate the more expensive attributes if your reward function actually uses them
+    LAZY_CALCULATIONS = False
+
+    # Set to True to time each stage of each step, with a summary printed at the end of each episode
+    INSTRUMENTATION = False
+
+    # Set to True to keep output from the framework (and from log() in your reward function) and write it all at once
+    # at the end of each episode, or whenever this many lines are kept. Either way, log() and print_debug() are only
+    # kept every so many steps, and there can be a limit on the lines of each kind per episode (None for all)
+    TELEMETRY_BUFFERED = False
+    TELEMETRY_CAPACITY = 1000
+    TELEMETRY_SAMPLE_STEPS = 1
+    TELEMETRY_MAX_LINES_PER_KIND = None
+
+    # Set to a directory name to also write the attributes in STEP_FEATURE_FIELDS for every step, as typed columns
+    # that read_step_features() can memory-map (written once per episode, so for offline use such as replay_episodes)
+    STEP_FEATURES_DIRECTORY = None
+
+    # The attributes shown by print_debug() and written for STEP_FEATURES_DIRECTORY, as (label, field, ...) for each
+    # line that print_debug() shows, where each field is (name, column type, digits to round to when shown).  The label
+    # is None for attributes that are written but not shown, the column type is None for ones that are shown but not
+    # written, and the digits are None to show the value as it is (or len to show its length)
+    STEP_FEATURE_FIELDS = (
+        ("x, y", ("x", "float64", 3), ("y", "float64", 3)),
+        ("all_wheels_on_track", ("all_wheels_on_track", "bool", None)),
+        (None, ("start_waypoint_id", "int32", None)),
+        ("previous_waypoint_id", ("previous_waypoint_id", "int32", None)),
+        ("previous_waypoint_x, y", ("previous_waypoint_x", "float64", 3), ("previous_waypoint_y", "float64", 3)),
+        ("next_waypoint_id", ("next_waypoint_id", "int32", None)),
+        ("next_waypoint_x, y", ("next_waypoint_x", "float64", 3), ("next_waypoint_y", "float64", 3)),
+        ("closest_waypoint_id", ("closest_waypoint_id", "int32", None)),
+        ("closest_waypoint_x, y", ("closest_waypoint_x", "float64", 3), ("closest_waypoint_y", "float64", 3)),
+        ("distance_from_closest_waypoint", ("distance_from_closest_waypoint", "float64", 2)),
+        ("distance_from_center", ("distance_from_center", "float64", 2)),
+        ("distance_from_edge", ("distance_from_edge", "float64", 2)),
+        ("distance_from_extreme_edge", ("distance_from_extreme_edge", "float64", 2)),
+        ("is_left/right_of_center", ("is_left_of_center", "bool", None), ("is_right_of_center", "bool", None)),
+        ("is_crashed / reversed", ("is_crashed", "bool", None), ("is_reversed", "bool", None)),
+        ("is_off_track", ("is_off_track", "bool", None)),
+        ("is_complete_lap", ("is_complete_lap", "bool", None)),
+        ("steps, is_final_step", ("steps", "int32", None), ("is_final_step", "bool", None)),
+        ("time", ("time", "float64", 2)),
+        ("predicted_lap_time", ("predicted_lap_time", "float64", 2)),
+        ("progress", ("progress", "float64", 2)),
+        ("waypoints  (SIZE)", ("waypoints", None, len)),
+        ("track_length, width", ("track_length", "float64", 2), ("track_width", "float64", 2)),
+        ("action_speed", ("action_speed", "float64", 2)),
+        ("action_steering_angle", ("action_steering_angle", "float64", 1)),
+        ("action_sequence_length", ("action_sequence_length", "int32", None)),
+        ("is_steering_left/right", ("is_steering_left", "bool", None), ("is_steering_right", "bool", None)),
+        ("is_steering_straight", ("is_steering_straight", "bool", None)),
+        ("heading", ("heading", "float64", 2)),
+        ("track_bearing", ("track_bearing", "float64", 2)),
+        ("true_bearing", ("true_bearing", "float64", 2)),
+        ("slide  / max / recent",
+         ("slide", "float64", 2), ("max_slide", "float64", 2), ("recent_max_slide", "float64", 2)),
+        ("skew / max_skew", ("skew", "float64", 2), ("max_skew", "float64", 2)),
+        ("total_distance", ("total_distance", "float64", 2)),
+        ("track_speed", ("track_speed", "float64", 2)),
+        ("progress_speed", ("progress_speed", "float64", 2)),
+        (None, ("max_possible_track_speed", "float64", None)),
+        (None, ("corner_cutting", "float64", None)),
+        ("just_passed_waypoint_ids", ("just_passed_waypoint_ids", "int32[]", None)),
+        ("time_at_waypoint", ("time_at_waypoint", None, None)),
+        ("projected_distance", ("projected_distance", "float64", None)),
+        (None, ("projected_progress_distance", "float64", None)),
+        (None, ("projected_finish_left", "bool", None), ("projected_hit_object", "bool", None)),
+        (None, ("projected_arc_distance", "float64", None), ("projected_arc_hit_object", "bool", None)),
+        (None, ("track_curvature", "float64", None)),
+        (None, ("turns_ahead", "float64[]", None)),
+        (None, ("next_corner_waypoint_id", "int32", None), ("next_corner_is_left", "bool", None)),
+        (None, ("next_corner_turn", "float64", None), ("distance_to_next_corner", "float64", None)),
+        (None, ("distance_from_racing_line", "float64", None), ("racing_line_bearing", "float64", None)),
+        (None, ("has_objects", "bool", None)),
+        (None, ("front_object_id", "int32", None), ("rear_object_id", "int32", None)),
+        (None, ("distance_to_front_object", "float64", None), ("distance_to_rear_object", "float64", None)),
+        (None, ("front_object_is_left_of_centre", "bool", None), ("rear_object_is_left_of_centre", "bool", None)),
+        (None, ("time_to_collision", "float64", None), ("collision_object_id", "int32", None)),
+        (None, ("closest_approach_distance", "float64", None)),
+        (None, ("lidar_distances", "float64[]", None))
+    )
+
+    projected_distance = LazyStepAttribute("_calculate_projections")
+    projected_progress_distance = LazyStepAttribute("_calculate_projections")
+    projected_finish_left = LazyStepAttribute("_calculate_projections")
+    projected_hit_object = LazyStepAttribute("_calculate_projections")
+    time_to_collision = LazyStepAttribute("_calculate_collision_prediction")
+    collision_object_id = LazyStepAttribute("_calculate_collision_prediction")
+    closest_approach_distance = LazyStepAttribute("_calculate_collision_prediction")
+    lidar_distances = LazyStepAttribute("_calculate_lidar")
+    projected_arc_distance = LazyStepAttribute("_calculate_arc_projection")
+    projected_arc_hit_object = LazyStepAttribute("_calculate_arc_projection")
+
     def __init__(self, params):
+        self._pending_calculations = set()
+        self.instrumentation = StepInstrumentation() if self.INSTRUMENTATION else None
+        self.telemetry = StepTelemetry(self.TELEMETRY_CAPACITY, self.TELEMETRY_SAMPLE_STEPS,
+                                       self.TELEMETRY_MAX_LINES_PER_KIND, self.TELEMETRY_BUFFERED)
+        self.step_features = None
+        if self.STEP_FEATURES_DIRECTORY:
+            self.step_features = StepFeatureColumns(self.STEP_FEATURES_DIRECTORY, self.get_step_feature_columns())
+            if not self.step_features.is_usable:
+                print("WARNING - Unable to write step features to " + str(self.STEP_FEATURES_DIRECTORY) +
+                      " (or it already has different columns)")
+                self.step_features = None
         # Real PRIVATE variables set here
-        self._processed_waypoints = get_processed_waypoints(params[ParamNames.WAYPOINTS],
-                                                            params[ParamNames.TRACK_WIDTH])
-        self._history = []
+        track_hash = get_track_hash(params[ParamNames.WAYPOINTS], params[ParamNames.TRACK_WIDTH])
+        self._processed_waypoints = get_cached_processed_waypoints(params[ParamNames.WAYPOINTS],
+                                                                   params[ParamNames.TRACK_WIDTH])
+        self._edge_bounds = get_cached_track_edge_bounds(track_hash, self._processed_waypoints)
+        if np is not None:
+            self._edge_arrays = get_cached_track_edge_arrays(track_hash, self._processed_waypoints)
+        else:
+            self._edge_arrays = None
+        if np is not None and self.DISTANCE_FIELD_RESOLUTION:
+            self._distance_field = get_cached_distance_field(params[ParamNames.WAYPOINTS],
+                                                             params[ParamNames.TRACK_WIDTH],
+                                                             self.DISTANCE_FIELD_RESOLUTION)
+        else:
+            self._distance_field = None
+        self._projection_table = None
+        if np is not None and self.PROJECTION_TABLE_FILE:
+            self._projection_table = read_projection_table(self.PROJECTION_TABLE_FILE)
+            if self._projection_table is None:
+                print("WARNING - Unable to read projection table " + str(self.PROJECTION_TABLE_FILE))
+            elif self._projection_table.track_hash != get_track_hash(params[ParamNames.WAYPOINTS],
+                                                                     params[ParamNames.TRACK_WIDTH]):
+                print("WARNING - Projection table " + str(self.PROJECTION_TABLE_FILE) + " is for a different track")
+                self._projection_table = None
+        if np is not None and self.RACING_LINE:
+            self._racing_line = get_cached_racing_line(params[ParamNames.WAYPOINTS], params[ParamNames.TRACK_WIDTH],
+                                                       self._processed_waypoints, self.RACING_LINE_MARGIN)
+        else:
+            self._racing_line = None
+        self._track_distances = get_cached_track_distances(track_hash, params[ParamNames.WAYPOINTS])
+        self._start_track_position = 0.0
+        self._track_hash = track_hash
+        self._track_corners = None   # Only found when first used, since it is the slowest part of a new track
+        self._waypoint_grid = get_cached_waypoint_grid(track_hash, params[ParamNames.WAYPOINTS],
+                                                       self._track_distances.total, params[ParamNames.TRACK_WIDTH])
+        self._history = StepHistory(self.HISTORY_CAPACITY, self.TRACK_SPEED_WINDOW, self.RECENT_SLIDE_WINDOW)
         self._previous_front_object = -1
+        self._obstacles = []
 
         # Definitions only of variables to use in your reward method, real values are set during process_params()
         self.x = 0.0
@@ -280,9 +2523,9 @@ class Framework:
         self.is_final_step = False
         self.progress = 0.0
         self.predicted_lap_time = 0.0
-        self.waypoints = []
-        self.track_length = 0.0
-        self.track_width = 0.0
+        self.waypoints = params[ParamNames.WAYPOINTS]
+        self.track_length = params[ParamNames.TRACK_LENGTH]
+        self.track_width = params[ParamNames.TRACK_WIDTH]
         self.track_speed = 0.0
         self.progress_speed = 0.0
         # self.progress_speeds = []
@@ -309,6 +2552,14 @@ class Framework:
         self.projected_finish_left = False
         self.max_possible_track_speed = 0.0
         self.corner_cutting = 0.0
+        self.track_curvature = 0.0
+        self.turns_ahead = ()
+        self.distance_from_racing_line = None
+        self.racing_line_bearing = None
+        self.next_corner_waypoint_id = None
+        self.next_corner_is_left = False
+        self.next_corner_turn = 0.0
+        self.distance_to_next_corner = None
 
         # New stuff for OA ################################
         self.has_objects = False
@@ -320,8 +2571,21 @@ class Framework:
         self.front_object_is_left_of_centre = False
         self.rear_object_is_left_of_centre = False
         self.projected_hit_object = False
+        self.objects_speed = []
+        self.objects_heading = []
+        self.time_to_collision = None
+        self.collision_object_id = None
+        self.closest_approach_distance = None
+        self.lidar_distances = ()
+        self.projected_arc_distance = 0.0
+        self.projected_arc_hit_object = False
 
     def process_params(self, params):
+        instrumentation = self.instrumentation
+        if instrumentation:
+            instrumentation.start_step(params[ParamNames.STEPS] <= 2)
+            instrumentation.start_stage("waypoints")
+
         self.x = float(params[ParamNames.X])
         self.y = float(params[ParamNames.Y])
 
@@ -360,6 +2624,7 @@ class Framework:
         self.is_reversed = bool(params[ParamNames.IS_REVERSED])
 
         self.steps = int(round(params[ParamNames.STEPS]))
+        self.telemetry.start_step(self.steps)
         self.time = self.steps / RealWorld.STEPS_PER_SECOND
         self.progress = float(params[ParamNames.PROGRESS])
         self.is_complete_lap = self.progress == 100.0
@@ -385,9 +2650,31 @@ class Framework:
             (self.previous_waypoint_x, self.previous_waypoint_y),
             (self.next_waypoint_x, self.next_waypoint_y))
 
+        if self._racing_line is not None:
+            (self.distance_from_racing_line, self.racing_line_bearing) = self._racing_line.get_distance_and_bearing(
+                (self.x, self.y), self.previous_waypoint_id)
+
+        corners = self._get_track_corners()
+        self.track_curvature = corners.curvature[self.next_waypoint_id]
+        self.turns_ahead = corners.turns_ahead[self.next_waypoint_id]
+        next_corner = corners.next_corner[self.next_waypoint_id]
+        if next_corner:
+            (self.next_corner_waypoint_id, self.next_corner_is_left, self.next_corner_turn) = next_corner
+            self.distance_to_next_corner = self._track_distances.get_distance_between_positions(
+                self._track_distances.get_position_of_point((self.x, self.y), self.previous_waypoint_id,
+                                                            self.next_waypoint_id),
+                self._track_distances.get_position_of_waypoint(self.next_corner_waypoint_id))
+        else:
+            self.next_corner_waypoint_id = None
+            self.next_corner_is_left = False
+            self.next_corner_turn = 0.0
+            self.distance_to_next_corner = None
+
         self.max_possible_track_speed = RealWorld.MAX_SPEEDS[min(self.steps, len(RealWorld.MAX_SPEEDS) - 1)]
 
         self.objects_location = params[ParamNames.OBJECTS_LOCATION]
+        self.objects_speed = params[ParamNames.OBJECTS_SPEED]
+        self.objects_heading = params[ParamNames.OBJECTS_HEADING]
 
         #
         # Print object info for use by DRG
@@ -395,65 +2682,65 @@ class Framework:
 
         # Not step 1 because there's still a bug (?!) that means the reward function is not called until step 2!!!
         if self.steps == 2 and len(self.objects_location) > 0:
-            print("DRG-OBJECTS:", self.objects_location)
+            self.telemetry.write("objects", self.steps, ("DRG-OBJECTS:", self.objects_location))
 
         #
         # Record history
         #
 
+        if instrumentation:
+            instrumentation.start_stage("history")
+
         if self.steps <= 2:
-            self._history = []
-            self.time_at_waypoint = [None] * len(self.waypoints)
-            self.step_when_passed_object = [-1] * 20
+            self._history.reset()
+            self._reset_episode_buffers()
             self._previous_front_object = -1
 
-        if self._history:
-            previous_step = self._history[-1]
-        else:
-            previous_step = None
+        history = self._history
+        has_previous_step = history.count > 0
+        if has_previous_step:
+            p = history.get_index(0)
+            previous_x = history.x[p]
+            previous_y = history.y[p]
+            previous_progress = history.progress[p]
+            previous_action_speed = history.action_speed[p]
+            previous_action_steering_angle = history.action_steering_angle[p]
+            previous_next_waypoint_id = history.next_waypoint_id[p]
 
-        this_step = HistoricStep(self, previous_step)
-        self._history.append(this_step)
+        step_distance = history.add_step(self.x, self.y, self.progress, self.action_speed, self.action_steering_angle,
+                                         self.next_waypoint_id, self.slide)
 
         #
         # Calculations that use the history
         #
 
-        if previous_step:
-            if previous_step.x != self.x or previous_step.y != self.y:  # Otherwise keep existing true_bearing
-                if self.progress - previous_step.progress >= 0.05:
-                    self.true_bearing = get_bearing_between_points((previous_step.x, previous_step.y), (self.x, self.y))
-            if (previous_step.action_speed == self.action_speed and
-                    previous_step.action_steering_angle == self.action_steering_angle):
+        if has_previous_step:
+            if previous_x != self.x or previous_y != self.y:  # Otherwise keep existing true_bearing
+                if self.progress - previous_progress >= 0.05:
+                    self.true_bearing = get_bearing_between_points((previous_x, previous_y), (self.x, self.y))
+            if (previous_action_speed == self.action_speed and
+                    previous_action_steering_angle == self.action_steering_angle):
                 self.action_sequence_length += 1
             else:
                 self.action_sequence_length = 1
 
-            speed_calculate_steps = self._history[-6:]
-            speed_calculate_distance = sum(s.distance for s in speed_calculate_steps)
-            speed_calculate_time = len(speed_calculate_steps) / RealWorld.STEPS_PER_SECOND
-            self.track_speed = speed_calculate_distance / speed_calculate_time
-
-            progress_speed_distance = (self.progress - speed_calculate_steps[0].progress) / 100 * self.track_length
-            progress_speed_calculate_time = (len(speed_calculate_steps) - 1) / RealWorld.STEPS_PER_SECOND
-            self.progress_speed = max(0.0, progress_speed_distance / progress_speed_calculate_time)
+            self.track_speed = history.get_track_speed()
+            self.progress_speed = history.get_progress_speed(min(history.count, history.speed_window) - 1,
+                                                             self._track_distances.total)
 
             self.just_passed_waypoint_ids = self._get_just_passed_waypoint_ids(
-                previous_step.next_waypoint_id, self.next_waypoint_id)
+                previous_next_waypoint_id, self.next_waypoint_id)
 
-            progress_gain = self.progress - previous_step.progress
+            progress_gain = self.progress - previous_progress
             if progress_gain < 0:
                 self.corner_cutting = 0
-            elif this_step.distance == 0:
+            elif step_distance == 0:
                 self.corner_cutting = 1
             else:
-                progress_distance = progress_gain / 100 * self.track_length
-                self.corner_cutting = progress_distance / this_step.distance
+                progress_distance = self.get_track_distance_from_progress(progress_gain)
+                self.corner_cutting = progress_distance / step_distance
 
-            self.recent_max_slide = 0.0
-            for h in self._history[-4:]:
-                if abs(h.slide) > abs(self.recent_max_slide):
-                    self.recent_max_slide = h.slide
+            self.recent_max_slide = history.get_recent_max_slide()
 
         else:
             self.action_sequence_length = 1
@@ -466,13 +2753,17 @@ class Framework:
             self.recent_max_slide = 0.0
             self.just_passed_waypoint_ids = []
             self.start_waypoint_id = self.closest_waypoint_id
+            self._start_track_position = self._track_distances.get_wrapped_position(
+                self._track_distances.get_position_of_point((self.x, self.y), self.previous_waypoint_id,
+                                                            self.next_waypoint_id) -
+                self.progress / 100 * self._track_distances.total)
             if len(self.time_at_waypoint) > self.start_waypoint_id:    # FUDGE TO PASS VALIDATION IN CONSOLE
                 self.time_at_waypoint[self.start_waypoint_id] = self.time
             self.corner_cutting = 1
 
         self.slide = get_turn_between_directions(self.heading, self.true_bearing)
         self.skew = get_turn_between_directions(self.track_bearing, self.true_bearing)
-        self.total_distance += this_step.distance
+        self.total_distance += step_distance
 
         if abs(self.slide) > abs(self.max_slide):
             self.max_slide = self.slide
@@ -483,6 +2774,9 @@ class Framework:
         # Object Avoidance Calculations
         #
 
+        if instrumentation:
+            instrumentation.start_stage("objects")
+
         object_locations = params[ParamNames.OBJECTS_LOCATION]
         objects_left_of_center = params[ParamNames.OBJECTS_LEFT_OF_CENTER]
         closest_objects = params[ParamNames.CLOSEST_OBJECTS]
@@ -517,22 +2811,541 @@ class Framework:
         # Projected distance calculation
         #
 
-        self.projected_hit_object = False
-        self.projected_distance, self.projected_progress_distance, self.projected_finish_left = self._calculate_projected_distance_on_track()
+        if self.LAZY_CALCULATIONS:
+            self._pending_calculations.add(self._calculate_projections.__name__)
+            self._pending_calculations.add(self._calculate_collision_prediction.__name__)
+            self._pending_calculations.add(self._calculate_lidar.__name__)
+        else:
+            self._calculate_projections()
+            self._calculate_collision_prediction()
+            self._calculate_lidar()
+        # Always on first use, since following the arc costs about as much as the rest of the step put together
+        self._pending_calculations.add(self._calculate_arc_projection.__name__)
+
+        if self.step_features:
+            if instrumentation:
+                instrumentation.start_stage("step_features")
+            self.step_features.add_step(self)
+
+    def _calculate_projections(self):
+        if self.instrumentation:
+            resume_stage = self.instrumentation.start_stage("projection")
+
+        projections = None
+        if self._projection_table is not None:
+            projections = self._look_up_projected_distance_on_track()
+        if projections is None:
+            projections = self._calculate_projected_distance_on_track()
+        self.projected_distance, self.projected_progress_distance, self.projected_finish_left = projections
         if self.has_objects:
-            object_hit_distance = self._calculate_object_hit_distance(object_locations[self.front_object_id])
-            if object_hit_distance is not None and object_hit_distance < self.projected_distance:
-                self.projected_distance = object_hit_distance
-                self.projected_hit_object = True
-            elif len(object_locations) > 1:
-                second_object_id = self.front_object_id + 1
-                if second_object_id == len(object_locations):
-                    second_object_id = 0
-                second_object_hit_distance = self._calculate_object_hit_distance(object_locations[second_object_id])
-                if second_object_hit_distance is not None and second_object_hit_distance < self.projected_distance:
-                    self.projected_distance = second_object_hit_distance
+            self.projected_distance, self.projected_hit_object = self._get_projected_distance_allowing_for_objects(
+                (self.x, self.y), self.true_bearing, self.projected_distance, self.objects_location,
+                self.front_object_id)
+        else:
+            self.projected_hit_object = False
+
+        if self.instrumentation:
+            self.instrumentation.start_stage(resume_stage)
+
+    def _calculate_collision_prediction(self):
+        if not self.has_objects:
+            self.time_to_collision = None
+            self.collision_object_id = None
+            self.closest_approach_distance = None
+            return
+
+        if self.instrumentation:
+            resume_stage = self.instrumentation.start_stage("collisions")
+            self.instrumentation.count("collision_predictions", len(self.objects_location))
+
+        car_radians = math.radians(self.true_bearing)
+        car_vx = self.track_speed * math.cos(car_radians)
+        car_vy = self.track_speed * math.sin(car_radians)
+
+        # Boxes don't report a speed or heading, so objects with neither are assumed to be stationary
+        has_velocities = len(self.objects_speed) == len(self.objects_location) == len(self.objects_heading)
+
+        if np is not None and len(self.objects_location) > self.SCALAR_COLLISION_MAX_OBJECTS:
+            locations = np.asarray(self.objects_location, dtype=float).reshape(-1, 2)
+            if has_velocities:
+                object_speeds = np.asarray(self.objects_speed, dtype=float)
+                object_radians = np.radians(np.asarray(self.objects_heading, dtype=float))
+                vx = object_speeds * np.cos(object_radians) - car_vx
+                vy = object_speeds * np.sin(object_radians) - car_vy
+            else:
+                vx = np.full(len(locations), -car_vx)
+                vy = np.full(len(locations), -car_vy)
+            (collision_times, closest_distances) = get_collision_predictions(
+                locations[:, 0] - self.x, locations[:, 1] - self.y, vx, vy,
+                self.COLLISION_DISTANCE, self.COLLISION_TIME_HORIZON)
+            collision_object_id = int(np.argmin(collision_times))
+            if collision_times[collision_object_id] == np.inf:
+                self.time_to_collision = None
+                self.collision_object_id = None
+            else:
+                self.time_to_collision = float(collision_times[collision_object_id])
+                self.collision_object_id = collision_object_id
+            self.closest_approach_distance = float(closest_distances.min())
+        else:
+            self.time_to_collision = None
+            self.collision_object_id = None
+            self.closest_approach_distance = None
+            for i, (object_x, object_y) in enumerate(self.objects_location):
+                if has_velocities:
+                    object_radians = math.radians(self.objects_heading[i])
+                    vx = self.objects_speed[i] * math.cos(object_radians) - car_vx
+                    vy = self.objects_speed[i] * math.sin(object_radians) - car_vy
+                else:
+                    (vx, vy) = (-car_vx, -car_vy)
+                (collision_time, closest_distance) = get_collision_prediction(
+                    object_x - self.x, object_y - self.y, vx, vy, self.COLLISION_DISTANCE, self.COLLISION_TIME_HORIZON)
+                if collision_time is not None and (self.time_to_collision is None or
+                                                   collision_time < self.time_to_collision):
+                    self.time_to_collision = collision_time
+                    self.collision_object_id = i
+                if self.closest_approach_distance is None or closest_distance < self.closest_approach_distance:
+                    self.closest_approach_distance = closest_distance
+
+        if self.instrumentation:
+            self.instrumentation.start_stage(resume_stage)
+
+    def _calculate_lidar(self):
+        if not self.LIDAR_ANGLES:
+            self.lidar_distances = ()
+            return
+
+        if self.instrumentation:
+            resume_stage = self.instrumentation.start_stage("lidar")
+            self.instrumentation.count("lidar_rays", len(self.LIDAR_ANGLES))
+
+        if self.distance_from_center > self.track_width / 2 + RealWorld.SAFE_CAR_OVERHANG:
+            self.lidar_distances = (0.0,) * len(self.LIDAR_ANGLES)
+        else:
+            headings = [get_angle_in_proper_range(self.true_bearing + angle) for angle in self.LIDAR_ANGLES]
+            if self._edge_arrays is None:
+                self.lidar_distances = tuple(self._get_lidar_distances_one_ray_at_a_time(headings))
+            else:
+                self.lidar_distances = tuple(self._get_lidar_distances_in_batch(headings))
+
+        if self.instrumentation:
+            self.instrumentation.start_stage(resume_stage)
+
+    def _get_lidar_distances_in_batch(self, headings):
+        # Every ray against every side of the track and then every side of every object, all at once
+        point = (self.x, self.y)
+        distances = self._edge_arrays.get_edge_distances(point, headings, self.previous_waypoint_id)
+
+        if len(self.objects_location) > 0:
+            sides = [(box_point1, box_point2) for object_id, location in enumerate(self.objects_location)
+                     for (box_point1, box_point2) in self._get_obstacle(object_id, location).sides]
+            sides = np.array(sides, dtype=float)    # Side, end, x/y
+            radians = np.radians(headings)
+            distances = np.minimum(distances, get_ray_hit_distances(
+                self.x, self.y, np.cos(radians)[:, None], np.sin(radians)[:, None], sides[:, 0, 0], sides[:, 0, 1],
+                sides[:, 1, 0] - sides[:, 0, 0], sides[:, 1, 1] - sides[:, 0, 1]))
+
+        return distances.tolist()
+
+    def _get_lidar_distances_one_ray_at_a_time(self, headings):
+        # Same as _get_lidar_distances_in_batch(), including which runs of waypoints are checked
+        point = (self.x, self.y)
+        waypoint_count = len(self._processed_waypoints)
+        box_sides = [side for object_id, location in enumerate(self.objects_location)
+                     for side in self._get_obstacle(object_id, location).sides]
+        distances = []
+        for heading in headings:
+            direction = (math.cos(math.radians(heading)), math.sin(math.radians(heading)))
+            distance = None
+            checked = 0
+            size = min(TrackEdgeArrays.EXIT_SEARCH_WINDOW, waypoint_count)
+            while distance is None and checked < waypoint_count:
+                for i in range(self.previous_waypoint_id + checked, self.previous_waypoint_id + checked + size):
+                    w = self._processed_waypoints[i % waypoint_count]
+                    next_w = self._processed_waypoints[(i + 1) % waypoint_count]
+                    for (start, finish) in [(w.left_safe, next_w.left_safe), (w.right_safe, next_w.right_safe)]:
+                        hit_distance = get_ray_hit_distance(point, direction, start, finish)
+                        if hit_distance is not None and (distance is None or hit_distance < distance):
+                            distance = hit_distance
+                checked += size
+                size = min(checked * 4, waypoint_count - checked)
+            if distance is None:
+                distance = 0.0
+
+            for (start, finish) in box_sides:
+                hit_distance = get_ray_hit_distance(point, direction, start, finish)
+                if hit_distance is not None and hit_distance < distance:
+                    distance = hit_distance
+            distances.append(distance)
+        return distances
+
+    def _calculate_arc_projection(self):
+        # Follows the circle that the chosen steering angle drives around (a kinematic bicycle model, where the radius
+        # depends only on the steering angle and the vehicle length), setting off along the true_bearing
+        if self.instrumentation:
+            resume_stage = self.instrumentation.start_stage("arc_projection")
+
+        if self.distance_from_center > self.track_width / 2 + RealWorld.SAFE_CAR_OVERHANG:
+            (self.projected_arc_distance, self.projected_arc_hit_object) = (0.0, False)
+        else:
+            if self.is_steering_straight:
+                curvature = 0.0
+            else:
+                curvature = math.tan(math.radians(self.action_steering_angle)) / RealWorld.VEHICLE_LENGTH
+            arc = ArcPath((self.x, self.y), self.true_bearing, curvature)
+            distance = self._edge_bounds.get_arc_edge_distance(arc, self.previous_waypoint_id)
+            if distance == math.inf:
+                # Round and round without ever leaving the track (or no edge found at all for a straight line)
+                distance = arc.get_full_circle_distance() if curvature != 0.0 else 0.0
+
+            hit_object = False
+            for object_id, location in enumerate(self.objects_location):
+                for (start, finish) in self._get_obstacle(object_id, location).sides:
+                    hit_distance = arc.get_hit_distance(start, finish)
+                    if hit_distance is not None and hit_distance < distance:
+                        (distance, hit_object) = (hit_distance, True)
+            (self.projected_arc_distance, self.projected_arc_hit_object) = (distance, hit_object)
+
+        if self.instrumentation:
+            self.instrumentation.start_stage(resume_stage)
+
+    def process_batch(self, columns):
+        # Calculates some attributes for many steps at once, e.g. for a whole recorded episode.
+        # The columns are a dict of the usual params, where each per-step param is a sequence with one value per
+        # step (e.g. "x", "heading", "closest_waypoints") while waypoints, track_width and track_length (if present)
+        # are single values as usual.  The first step is treated as the start of an episode, and the current state
+        # of this framework is not affected.  Returns a dict of the attributes, with one value per step.
+
+        if self._edge_arrays is None:
+            return self._process_batch_one_step_at_a_time(columns)
+
+        x = np.asarray(columns[ParamNames.X], dtype=float)
+        y = np.asarray(columns[ParamNames.Y], dtype=float)
+        heading = np.asarray(columns[ParamNames.HEADING], dtype=float)
+        progress = np.asarray(columns[ParamNames.PROGRESS], dtype=float)
+        steps = np.round(np.asarray(columns[ParamNames.STEPS], dtype=float)).astype(int)
+        closest_waypoints = np.asarray(columns[ParamNames.CLOSEST_WAYPOINTS], dtype=int).reshape(-1, 2)
+        previous_ids = closest_waypoints[:, 0]
+        next_ids = closest_waypoints[:, 1]
+        distance_from_center = np.asarray(columns[ParamNames.DISTANCE_FROM_CENTER], dtype=float)
+        is_left_of_center = np.asarray(columns[ParamNames.IS_LEFT_OF_CENTER], dtype=bool)
+        track_width = columns.get(ParamNames.TRACK_WIDTH, self.track_width)
+        track_length = self._track_distances.total
+        edges = self._edge_arrays
+
+        row_count = len(x)
+        rows = np.arange(row_count)
+
+        # Episodes start again whenever steps <= 2, just like process_params()
+        is_episode_start = steps <= 2
+        is_episode_start[:1] = True
+        episode_start = np.maximum.accumulate(np.where(is_episode_start, rows, 0))
+        steps_in_episode = rows - episode_start + 1
+        previous_rows = np.maximum(rows - 1, 0)
+
+        step_distance = np.where(is_episode_start, 0.0, get_distances_between_points(
+            x[previous_rows], y[previous_rows], x, y))
+        progress_gain = progress - progress[previous_rows]
+
+        track_bearing = get_bearings_between_points(edges.mid_x[previous_ids], edges.mid_y[previous_ids],
+                                                    edges.mid_x[next_ids], edges.mid_y[next_ids])
+
+        has_moved = ((x != x[previous_rows]) | (y != y[previous_rows])) & (progress_gain >= 0.05)
+        has_true_bearing = is_episode_start | has_moved
+        true_bearing = np.where(is_episode_start, heading, get_bearings_between_points(
+            x[previous_rows], y[previous_rows], x, y))
+        true_bearing = true_bearing[np.maximum.accumulate(np.where(has_true_bearing, rows, 0))]
+
+        slide = get_angles_in_proper_range(true_bearing - heading)
+        skew = get_angles_in_proper_range(true_bearing - track_bearing)
+
+        window_steps = np.minimum(steps_in_episode, self.TRACK_SPEED_WINDOW)
+        cumulative_distance = np.concatenate(([0.0], np.cumsum(step_distance)))
+        window_distance = cumulative_distance[rows + 1] - cumulative_distance[rows + 1 - window_steps]
+        track_speed = np.where(is_episode_start, 0.0, window_distance / (window_steps / RealWorld.STEPS_PER_SECOND))
+
+        window_start_rows = rows + 1 - window_steps
+        with np.errstate(divide="ignore", invalid="ignore"):
+            progress_speed = np.maximum(0.0, (progress - progress[window_start_rows]) / 100 * track_length /
+                                        ((window_steps - 1) / RealWorld.STEPS_PER_SECOND))
+            corner_cutting = progress_gain / 100 * track_length / step_distance
+        progress_speed = np.where(is_episode_start, 0.0, progress_speed)
+        corner_cutting = np.where(progress_gain < 0, 0.0, np.where(step_distance == 0, 1.0, corner_cutting))
+        corner_cutting = np.where(is_episode_start, 1.0, corner_cutting)
+
+        (projected_distance, projected_progress_distance, projected_finish_left) = \
+            self._calculate_projected_distances_on_track_in_batch(
+                x, y, get_angles_in_proper_range(true_bearing), previous_ids, next_ids, is_left_of_center,
+                distance_from_center, track_width)
+
+        objects_location = columns.get(ParamNames.OBJECTS_LOCATION)
+        if objects_location is not None:
+            (projected_distance, projected_hit_object) = self._get_projected_distances_allowing_for_objects_in_batch(
+                x, y, true_bearing, projected_distance, objects_location, columns[ParamNames.CLOSEST_OBJECTS])
+        else:
+            projected_hit_object = np.zeros(row_count, dtype=bool)
+
+        return {
+            "track_bearing": track_bearing,
+            "true_bearing": true_bearing,
+            "slide": slide,
+            "skew": skew,
+            "track_speed": track_speed,
+            "progress_speed": progress_speed,
+            "corner_cutting": corner_cutting,
+            "projected_distance": projected_distance,
+            "projected_progress_distance": projected_progress_distance,
+            "projected_finish_left": projected_finish_left,
+            "projected_hit_object": projected_hit_object
+        }
+
+    def _process_batch_one_step_at_a_time(self, columns):
+        names = ["track_bearing", "true_bearing", "slide", "skew", "track_speed", "progress_speed", "corner_cutting",
+                 "projected_distance", "projected_progress_distance", "projected_finish_left", "projected_hit_object"]
+        results = {name: [] for name in names}
+
+        track_values = {ParamNames.WAYPOINTS: self.waypoints, ParamNames.TRACK_WIDTH: self.track_width,
+                        ParamNames.TRACK_LENGTH: self.track_length}
+        track_values.update({name: columns[name] for name in track_values if name in columns})
+        step_defaults = {ParamNames.ALL_WHEELS_ON_TRACK: True, ParamNames.IS_CRASHED: False,
+                         ParamNames.IS_OFFTRACK: False, ParamNames.IS_REVERSED: False, ParamNames.SPEED: 0.0,
+                         ParamNames.STEERING_ANGLE: 0.0, ParamNames.OBJECTS_LOCATION: [],
+                         ParamNames.OBJECTS_LEFT_OF_CENTER: [], ParamNames.OBJECTS_SPEED: [],
+                         ParamNames.OBJECTS_HEADING: [], ParamNames.CLOSEST_OBJECTS: [0, 0]}
+
+        framework = None
+        for i in range(len(columns[ParamNames.X])):
+            params = dict(track_values)
+            for name, default in step_defaults.items():
+                params[name] = columns[name][i] if name in columns else default
+            for name in [ParamNames.X, ParamNames.Y, ParamNames.HEADING, ParamNames.PROGRESS, ParamNames.STEPS,
+                         ParamNames.CLOSEST_WAYPOINTS, ParamNames.DISTANCE_FROM_CENTER, ParamNames.IS_LEFT_OF_CENTER]:
+                params[name] = columns[name][i]
+            if framework is None:
+                framework = Framework(params)
+                params[ParamNames.STEPS] = min(params[ParamNames.STEPS], 2)  # First step always starts an episode
+            framework.process_params(params)
+            for name in names:
+                results[name].append(getattr(framework, name))
+
+        return results
+
+    def _get_projected_distance_allowing_for_objects(self, point, true_bearing: float, projected_distance: float,
+                                                     object_locations, front_object_id: int):
+        if len(object_locations) == 0:
+            return projected_distance, False
+
+        heading = get_angle_in_proper_range(true_bearing)
+        point2 = get_point_at_bearing(point, heading, 1)  # Just some random distance (1m) to define line
+
+        object_hit_distance = self._get_obstacle(front_object_id, object_locations[front_object_id]).get_hit_distance(
+            point, heading, point2)
+        if object_hit_distance is not None and object_hit_distance < projected_distance:
+            return object_hit_distance, True
+        elif len(object_locations) > 1:
+            second_object_id = front_object_id + 1
+            if second_object_id == len(object_locations):
+                second_object_id = 0
+            second_object_hit_distance = self._get_obstacle(
+                second_object_id, object_locations[second_object_id]).get_hit_distance(point, heading, point2)
+            if second_object_hit_distance is not None and second_object_hit_distance < projected_distance:
+                return second_object_hit_distance, False
+
+        return projected_distance, False
+
+    def _get_projected_distances_allowing_for_objects_in_batch(self, x, y, true_bearing, projected_distance,
+                                                               objects_location, closest_objects):
+        # Same as _get_projected_distance_allowing_for_objects() for every step at once
+        row_count = len(x)
+        object_columns = np.full((2, 3, row_count), np.nan)   # Front and second object: x, y, track bearing
+        obstacles = {}
+
+        for i in range(row_count):
+            object_locations = objects_location[i]
+            if len(object_locations) == 0:
+                continue
+            front_object_id = int(closest_objects[i][1])
+            object_ids = [front_object_id]
+            if len(object_locations) > 1:
+                object_ids.append(front_object_id + 1 if front_object_id + 1 < len(object_locations) else 0)
+            for column, object_id in enumerate(object_ids):
+                obj_middle = tuple(object_locations[object_id])
+                if obj_middle not in obstacles:
+                    obstacles[obj_middle] = self._create_obstacle(obj_middle)
+                object_columns[column, :, i] = (obj_middle[0], obj_middle[1], obstacles[obj_middle].track_bearing)
+
+        front_hit_distance = self._get_object_hit_distances_in_batch(x, y, true_bearing, *object_columns[0])
+        second_hit_distance = self._get_object_hit_distances_in_batch(x, y, true_bearing, *object_columns[1])
+
+        projected_hit_object = front_hit_distance < projected_distance
+        hit_second_object = ~projected_hit_object & (second_hit_distance < projected_distance)
+        projected_distance = np.where(projected_hit_object, front_hit_distance,
+                                      np.where(hit_second_object, second_hit_distance, projected_distance))
+        return projected_distance, projected_hit_object
+
+    @staticmethod
+    def _get_object_hit_distances_in_batch(x, y, true_bearing, object_x, object_y, track_bearing):
+        # Same as BoxObstacle.get_hit_distance() for every step at once, with NaN meaning no hit (or no object)
+        heading = get_angles_in_proper_range(true_bearing)
+        radians = np.radians(heading)
+        x2 = x + np.cos(radians) * 1
+        y2 = y + np.sin(radians) * 1
+        safe_border = min(RealWorld.VEHICLE_WIDTH, RealWorld.VEHICLE_LENGTH) / 3
+
+        def get_points_at_bearing(start_x, start_y, bearing, distance):
+            radians_to_target = np.radians(bearing)
+            return start_x + np.cos(radians_to_target) * distance, start_y + np.sin(radians_to_target) * distance
+
+        front_middle = get_points_at_bearing(object_x, object_y, track_bearing,
+                                             RealWorld.BOX_OBSTACLE_LENGTH / 2 + safe_border)
+        front_left = get_points_at_bearing(*front_middle, track_bearing + 90,
+                                           RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
+        front_right = get_points_at_bearing(*front_middle, track_bearing - 90,
+                                            RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
+
+        rear_middle = get_points_at_bearing(object_x, object_y, track_bearing,
+                                            -RealWorld.BOX_OBSTACLE_LENGTH / 2 - safe_border)
+        rear_left = get_points_at_bearing(*rear_middle, track_bearing + 90,
+                                          RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
+        rear_right = get_points_at_bearing(*rear_middle, track_bearing - 90,
+                                           RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
+
+        hit_distance = np.full(len(x), np.inf)
+        for (box_point1, box_point2) in [(front_left, front_right), (rear_left, rear_right),
+                                         (front_left, rear_left), (front_right, rear_right)]:
+            (hit_x, hit_y) = get_intersections_of_two_lines(x, y, x2, y2, *box_point1, *box_point2)
+            is_hit = are_points_between(hit_x, hit_y, *box_point1, *box_point2)
+            is_hit &= np.abs(get_angles_in_proper_range(heading - get_bearings_between_points(x, y, hit_x, hit_y))) < 1
+            hit_distance = np.where(is_hit, np.minimum(hit_distance, get_distances_between_points(x, y, hit_x, hit_y)),
+                                    hit_distance)
+
+        return np.where(np.isfinite(hit_distance), hit_distance, np.nan)
+
+    def _calculate_projected_distances_on_track_in_batch(self, x, y, heading, previous_ids, next_ids,
+                                                         is_left_of_center, distance_from_center, track_width: float):
+        # Same calculation as _calculate_projected_distance_on_track() for every step at once
+        edges = self._edge_arrays
+        waypoint_count = len(edges.mid_x)
+
+        (exit_ids, has_exit) = edges.get_first_exit_indexes(x, y, heading, next_ids)
+        waypoints_passed = (exit_ids - next_ids) % waypoint_count
+        before_exit_ids = np.where(waypoints_passed == 0, previous_ids, (exit_ids - 1) % waypoint_count)
+
+        radians = np.radians(heading)
+        x2 = x + np.cos(radians)
+        y2 = y + np.sin(radians)
+
+        hits = []
+        for (edge_x, edge_y) in [(edges.left_x, edges.left_y), (edges.right_x, edges.right_y)]:
+            (safe_x, safe_y) = (edge_x[exit_ids], edge_y[exit_ids])
+            (previous_safe_x, previous_safe_y) = (edge_x[before_exit_ids], edge_y[before_exit_ids])
+            (hit_x, hit_y) = get_intersections_of_two_lines(x, y, x2, y2, safe_x, safe_y,
+                                                            previous_safe_x, previous_safe_y)
+            is_same_edge_point = (safe_x == previous_safe_x) & (safe_y == previous_safe_y)
+            hit_x = np.where(is_same_edge_point, previous_safe_x, hit_x)
+            hit_y = np.where(is_same_edge_point, previous_safe_y, hit_y)
+
+            is_ahead = np.abs(get_angles_in_proper_range(heading - get_bearings_between_points(x, y, hit_x, hit_y))) < 1
+            is_valid = is_ahead & are_points_between(hit_x, hit_y, safe_x, safe_y, previous_safe_x, previous_safe_y)
+            hits.append((hit_x, hit_y, get_distances_between_points(x, y, hit_x, hit_y), is_valid))
+
+        ((left_x, left_y, left_distance, is_left_valid), (right_x, right_y, right_distance, is_right_valid)) = hits
+        finish_right = is_right_valid & (~is_left_valid | (right_distance > left_distance))
+        is_on_track = (is_left_valid | is_right_valid) & has_exit
+
+        off_track_distance = np.where(finish_right, right_distance, left_distance)
+        off_track_x = np.where(finish_right, right_x, left_x)
+        off_track_y = np.where(finish_right, right_y, left_y)
+
+        next_progress_distance = self._calculate_progress_distances_in_batch(
+            x, y, previous_ids, next_ids, is_left_of_center, distance_from_center)[1]
+        (final_previous_progress_distance, final_next_progress_distance) = self._calculate_progress_distances_in_batch(
+            off_track_x, off_track_y, before_exit_ids, exit_ids, ~finish_right,
+            track_width / 2 + RealWorld.SAFE_CAR_OVERHANG)
+
+        positions = np.array([self._track_distances.get_position_of_waypoint(i) for i in range(waypoint_count)])
+        (start, finish) = (positions[next_ids], positions[before_exit_ids])
+        distance_along_waypoints = np.where(finish >= start, finish - start, self._track_distances.total - start + finish)
+
+        progress_distance = np.where(waypoints_passed == 0, next_progress_distance - final_next_progress_distance,
+                                     next_progress_distance + final_previous_progress_distance + distance_along_waypoints)
+
+        return (np.where(is_on_track, off_track_distance, 0.0), np.where(is_on_track, progress_distance, 0.0),
+                is_on_track & ~finish_right)
+
+    def _calculate_progress_distances_in_batch(self, x, y, previous_ids, next_ids, is_left, distance_from_centre):
+        edges = self._edge_arrays
+        (previous_x, previous_y) = (edges.mid_x[previous_ids], edges.mid_y[previous_ids])
+        (next_x, next_y) = (edges.mid_x[next_ids], edges.mid_y[next_ids])
+
+        track_bearing = get_bearings_between_points(previous_x, previous_y, next_x, next_y)
+        radians_to_centre_point = np.radians(track_bearing + np.where(is_left, -90, 90))
+
+        centre_x = x + np.cos(radians_to_centre_point) * distance_from_centre
+        centre_y = y + np.sin(radians_to_centre_point) * distance_from_centre
+
+        return (get_distances_between_points(centre_x, centre_y, previous_x, previous_y),
+                get_distances_between_points(centre_x, centre_y, next_x, next_y))
+
+    def _look_up_projected_distance_on_track(self):
+        position = self._track_distances.get_position_of_point((self.x, self.y), self.previous_waypoint_id,
+                                                               self.next_waypoint_id)
+        offset = self.distance_from_center if self.is_left_of_center else -self.distance_from_center
+        projections = self._projection_table.look_up(position, offset, self.skew, self.PROJECTION_TABLE_MAX_ERROR,
+                                                     self.PROJECTION_TABLE_MAX_RELATIVE_ERROR)
+        if self.instrumentation:
+            self.instrumentation.count("projection_table_misses" if projections is None else "projection_table_hits")
+        return projections
 
     def _calculate_projected_distance_on_track(self):
+        if self._edge_arrays is None:
+            return self._calculate_projected_distance_on_track_by_walking_waypoints()
+
+        # Find the first waypoint the ray does not pass between in a single batched pass, then only
+        # do the detailed intersection and progress calculations for that one waypoint
+        heading = get_angle_in_proper_range(self.true_bearing)
+        point = (self.x, self.y)
+
+        exit_id = self._edge_arrays.get_first_exit_index(point, heading, self.next_waypoint_id)
+        if exit_id is None:
+            return self._calculate_projected_distance_on_track_by_walking_waypoints()
+
+        waypoints_passed = (exit_id - self.next_waypoint_id) % len(self._processed_waypoints)
+        if self.instrumentation:
+            self.instrumentation.count("projection_waypoints", waypoints_passed + 1)
+            self.instrumentation.count("projection_batched_waypoints", len(self._processed_waypoints))
+            self.instrumentation.count("intersection_tests", 2)
+        if waypoints_passed == 0:
+            previous_id = self.previous_waypoint_id
+        else:
+            previous_id = exit_id - 1 if exit_id > 0 else len(self._processed_waypoints) - 1
+        previous = self._processed_waypoints[previous_id]
+        w = self._processed_waypoints[exit_id]
+
+        off_track_distance, off_track_point, off_left = self._get_off_track_distance_and_point(
+            point, heading, previous.left_safe, previous.right_safe, w)
+
+        if off_track_distance is None:
+            # Rounding differences between NumPy and math, so trust the original calculation instead
+            return self._calculate_projected_distance_on_track_by_walking_waypoints()
+        elif off_track_distance == 0.0:
+            return 0.0, 0.0, False
+
+        (previous_progress_distance, next_progress_distance) = self._calculate_progress_distances(
+            point, self.waypoints[self.previous_waypoint_id], self.waypoints[self.next_waypoint_id],
+            self.is_left_of_center, self.distance_from_center)
+        (final_previous_progress_distance, final_next_progress_distance) = self._calculate_progress_distances(
+            off_track_point, (previous.x, previous.y), (w.x, w.y), off_left,
+            self.track_width / 2 + RealWorld.SAFE_CAR_OVERHANG)
+
+        if waypoints_passed == 0:
+            progress_distance = next_progress_distance - final_next_progress_distance
+        else:
+            progress_distance = (next_progress_distance + final_previous_progress_distance +
+                                 self._track_distances.get_distance_between_waypoints(
+                                     self.next_waypoint_id, previous_id))
+        return off_track_distance, progress_distance, off_left
+
+    def _calculate_projected_distance_on_track_by_walking_waypoints(self):
         heading = get_angle_in_proper_range(self.true_bearing)
         point = (self.x, self.y)
 
@@ -546,10 +3359,16 @@ class Framework:
         is_first_step = True
 
         previous_waypoint = self.waypoints[self.previous_waypoint_id]
-        for w in self._processed_waypoints[self.next_waypoint_id:] + self._processed_waypoints[:self.next_waypoint_id]:
+        waypoint_count = len(self._processed_waypoints)
+        for i in range(self.next_waypoint_id, self.next_waypoint_id + waypoint_count):
+            w = self._processed_waypoints[i % waypoint_count]
             off_track_distance, off_track_point, off_left = self._get_off_track_distance_and_point(point, heading,
                                                                                                    previous_left,
                                                                                                    previous_right, w)
+            if self.instrumentation:
+                self.instrumentation.count("projection_waypoints")
+                if off_track_distance is not None:
+                    self.instrumentation.count("intersection_tests", 2)
 
             if off_track_distance is None:
                 previous_left = w.left_safe
@@ -578,13 +3397,7 @@ class Framework:
         left_safe = processed_waypoint.left_safe
         right_safe = processed_waypoint.right_safe
 
-        direction_to_left_target = get_bearing_between_points(point, left_safe)
-        direction_to_right_target = get_bearing_between_points(point, right_safe)
-
-        relative_direction_to_left_target = get_turn_between_directions(heading, direction_to_left_target)
-        relative_direction_to_right_target = get_turn_between_directions(heading, direction_to_right_target)
-
-        if relative_direction_to_left_target >= 0 and relative_direction_to_right_target <= 0:
+        if is_heading_between_points(point, heading, left_safe, right_safe):
             return None, None, None
         else:
             point2 = get_point_at_bearing(point, heading, 1)  # Just some random distance (1m)
@@ -600,24 +3413,19 @@ class Framework:
             left_bearing = get_bearing_between_points(point, off_track_left)
             right_bearing = get_bearing_between_points(point, off_track_right)
 
-            distances = []
-            end_points = []
-            off_left = []
+            # The further of the two edges that the ray actually crosses (the left one if it's a tie)
+            left_distance = None
             if abs(get_turn_between_directions(left_bearing, heading)) < 1:
                 if is_point_between(off_track_left, left_safe, previous_left):
-                    distances += [get_distance_between_points(point, off_track_left)]
-                    end_points += [off_track_left]
-                    off_left += [True]
+                    left_distance = get_distance_between_points(point, off_track_left)
             if abs(get_turn_between_directions(right_bearing, heading)) < 1:
                 if is_point_between(off_track_right, right_safe, previous_right):
-                    distances += [get_distance_between_points(point, off_track_right)]
-                    end_points += [off_track_right]
-                    off_left += [False]
-
-            if len(distances) == 2 and distances[1] > distances[0]:
-                return distances[1], end_points[1], off_left[1]
-            elif len(distances) > 0:
-                return distances[0], end_points[0], off_left[0]
+                    right_distance = get_distance_between_points(point, off_track_right)
+                    if left_distance is None or right_distance > left_distance:
+                        return right_distance, off_track_right, False
+
+            if left_distance is not None:
+                return left_distance, off_track_left, True
             else:
                 return 0.0, None, None
 
@@ -640,59 +3448,44 @@ class Framework:
         return get_distance_between_points(centre_point, previous_waypoint), get_distance_between_points(centre_point,
                                                                                                          next_waypoint)
 
-    def _calculate_object_hit_distance(self, obj_middle):
-        heading = get_angle_in_proper_range(self.true_bearing)
-        point = (self.x, self.y)
-
-        point2 = get_point_at_bearing(point, heading, 1)  # Just some random distance (1m) to define line
-        track_bearing = self._get_track_bearing_at_point(obj_middle)
-        safe_border = min(RealWorld.VEHICLE_WIDTH, RealWorld.VEHICLE_LENGTH) / 3  # Effectively enlarge the box
-
-        front_middle = get_point_at_bearing(obj_middle, track_bearing, RealWorld.BOX_OBSTACLE_LENGTH / 2 + safe_border)
-        front_left = get_point_at_bearing(front_middle, track_bearing + 90,
-                                          RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
-        front_right = get_point_at_bearing(front_middle, track_bearing - 90,
-                                           RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
-
-        rear_middle = get_point_at_bearing(obj_middle, track_bearing, -RealWorld.BOX_OBSTACLE_LENGTH / 2 - safe_border)
-        rear_left = get_point_at_bearing(rear_middle, track_bearing + 90,
-                                         RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
-        rear_right = get_point_at_bearing(rear_middle, track_bearing - 90,
-                                          RealWorld.BOX_OBSTACLE_WIDTH / 2 + safe_border)
-
-        distances = []
-        for box_side in [(front_left, front_right), (rear_left, rear_right),
-                         (front_left, rear_left), (front_right, rear_right)]:
-            (box_point1, box_point2) = box_side
-            hit_point = get_intersection_of_two_lines(point, point2, box_point1, box_point2)
-            if hit_point is not None and is_point_between(hit_point, box_point1, box_point2):
-                # Make sure it's in front of us!
-                bearing_to_hit_point = get_bearing_between_points(point, hit_point)
-                if abs(get_turn_between_directions(bearing_to_hit_point, heading)) < 1:
-                    distances.append(get_distance_between_points(point, hit_point))
-
-        if not distances:
-            return None
-        else:
-            return min(distances)
-
-    def _get_track_bearing_at_point(self, point):
-        closest_waypoint = self._get_closest_waypoint_id(point)
-        (before_waypoint, after_waypoint) = self.get_waypoint_ids_before_and_after(point, closest_waypoint)
-        return get_bearing_between_points(self.waypoints[before_waypoint],
-                                          self.waypoints[after_waypoint])
-
-    def _get_closest_waypoint_id(self, point):
-        distance = get_distance_between_points(self.waypoints[0], point)
-        closest_id = 0
-        for i, w in enumerate(self.waypoints[1:]):
-            new_distance = get_distance_between_points(w, point)
-            if new_distance < distance:
-                distance = new_distance
-                closest_id = i + 1
-        return closest_id
-
-    def get_waypoint_ids_before_and_after(self, point, closest_waypoint_id: int, prefer_forwards=False):
+    def _get_obstacle(self, object_id: int, location):
+        # Only rebuilt when the object has moved, and only for objects that are actually tested
+        obstacles = self._obstacles
+        while len(obstacles) <= object_id:
+            obstacles.append(None)
+        obstacle = obstacles[object_id]
+        if obstacle is None or not obstacle.is_at(location):
+            obstacle = self._create_obstacle(location)
+            obstacles[object_id] = obstacle
+        if self.instrumentation:
+            self.instrumentation.count("object_hit_tests")
+            self.instrumentation.count("intersection_tests", 4)
+        return obstacle
+
+    def _create_obstacle(self, location):
+        if self.instrumentation:
+            self.instrumentation.count("obstacles_created")
+        (before_waypoint, after_waypoint) = self.get_waypoint_ids_before_and_after(location)
+        return BoxObstacle(location,
+                           get_bearing_between_points(self.waypoints[before_waypoint], self.waypoints[after_waypoint]),
+                           before_waypoint, after_waypoint,
+                           self._track_distances.get_position_of_point(location, before_waypoint, after_waypoint))
+
+    def _get_track_corners(self):
+        if self._track_corners is None:
+            self._track_corners = get_cached_track_corners(self._track_hash, self._track_distances,
+                                                           len(self.waypoints), self.CORNER_LOOK_AHEAD_DISTANCES,
+                                                           self.CORNER_SMOOTHING_DISTANCE, self.CORNER_MIN_CURVATURE)
+        return self._track_corners
+
+    def get_closest_waypoint_id(self, point):
+        if self.instrumentation:
+            self.instrumentation.count("closest_waypoint_lookups")
+        return self._waypoint_grid.get_closest_waypoint_id(point)
+
+    def get_waypoint_ids_before_and_after(self, point, closest_waypoint_id: int = None, prefer_forwards=False):
+        if closest_waypoint_id is None:
+            closest_waypoint_id = self.get_closest_waypoint_id(point)
         assert 0 <= closest_waypoint_id < len(self.waypoints)
 
         previous_id = self._get_previous_waypoint_id(closest_waypoint_id)
@@ -734,6 +3527,16 @@ class Framework:
         else:
             return waypoint_id - 1
 
+    def _reset_episode_buffers(self):
+        # Reused for every episode, and only replaced if the track changes size
+        if len(self.time_at_waypoint) == len(self.waypoints):
+            for i in range(len(self.time_at_waypoint)):
+                self.time_at_waypoint[i] = None
+        else:
+            self.time_at_waypoint = [None] * len(self.waypoints)
+        for i in range(len(self.step_when_passed_object)):
+            self.step_when_passed_object[i] = -1
+
     def _get_just_passed_waypoint_ids(self, previous_next_waypoint_id, current_next_waypoint_id):
         if previous_next_waypoint_id == current_next_waypoint_id:
             return []
@@ -756,66 +3559,107 @@ class Framework:
             return []
 
     def get_track_distance_between_waypoints(self, start: int, finish: int):
-        distance = 0
         assert 0 <= start < len(self.waypoints)
         assert 0 <= finish < len(self.waypoints)
-
-        while start != finish:
-            next_wp = self._get_next_waypoint_id(start)
-            distance += get_distance_between_points(self.waypoints[start], self.waypoints[next_wp])
-            start = next_wp
-
+        return self._track_distances.get_distance_between_waypoints(start, finish)
+
+    def get_track_distance_between_points(self, start, finish):
+        return self._track_distances.get_distance_between_positions(self._get_track_position_of_point(start),
+                                                                     self._get_track_position_of_point(finish))
+
+    def get_track_distance_from_progress(self, progress: float):
+        return progress / 100 * self._track_distances.total
+
+    def get_progress_from_track_distance(self, distance: float):
+        return distance / self._track_distances.total * 100
+
+    def get_progress_at_point(self, point):
+        return self.get_progress_from_track_distance(self._track_distances.get_distance_between_positions(
+            self._start_track_position, self._get_track_position_of_point(point)))
+
+    def get_point_at_progress(self, progress: float):
+        position = self._track_distances.get_wrapped_position(self._start_track_position +
+                                                              self.get_track_distance_from_progress(progress))
+        return self._track_distances.get_point_at_position(position)
+
+    def _get_track_position_of_point(self, point):
+        (before_waypoint, after_waypoint) = self.get_waypoint_ids_before_and_after(point)
+        return self._track_distances.get_position_of_point(point, before_waypoint, after_waypoint)
+
+    def get_edge_distance_at_point(self, point):
+        # Distance from any (x, y) point to the nearest safe edge of the track, positive when on the track
+        if self._distance_field is not None:
+            return self._distance_field.get_edge_distance(point)
+
+        # Otherwise exactly, from the center line either side of the closest waypoint
+        closest_id = self.get_closest_waypoint_id(point)
+        closest_waypoint = self.waypoints[closest_id]
+        distance_from_center = min(
+            get_distance_from_line_segment(point, self.waypoints[self._get_previous_waypoint_id(closest_id)],
+                                           closest_waypoint),
+            get_distance_from_line_segment(point, closest_waypoint,
+                                           self.waypoints[self._get_next_waypoint_id(closest_id)]))
+        return self.track_width / 2 + RealWorld.SAFE_CAR_OVERHANG - distance_from_center
+
+    def is_point_on_track(self, point):
+        return self.get_edge_distance_at_point(point) >= 0.0
+
+    def get_edge_distance_along_bearing(self, point, bearing: float):
+        # Ray marching: it is always safe to move as far as the nearest edge, until the edge is reached
+        if self._distance_field is not None:
+            min_step = self._distance_field.resolution / 2
+        else:
+            min_step = self.RAY_MARCHING_MIN_STEP
+        radians = math.radians(bearing)
+        (direction_x, direction_y) = (math.cos(radians), math.sin(radians))
+        max_distance = self._track_distances.total
+        distance = 0.0
+        edge_distance = self.get_edge_distance_at_point(point)
+        while edge_distance > 0.0 and distance < max_distance:
+            distance += max(edge_distance, min_step)
+            edge_distance = self.get_edge_distance_at_point((point[0] + direction_x * distance,
+                                                             point[1] + direction_y * distance))
         return distance
 
     def get_progress_speed(self, steps: int):
         assert steps >= 1
-        if steps >= len(self._history):
-            return None
+        return self._history.get_progress_speed(steps, self._track_distances.total)
 
-        progress_speed_distance = (self.progress - self._history[-steps - 1].progress) / 100 * self.track_length
-        progress_speed_calculate_time = steps / RealWorld.STEPS_PER_SECOND
-        return max(0.0, progress_speed_distance / progress_speed_calculate_time)
+    def log(self, *values):
+        # Like print(), but optionally buffered and sampled (see TELEMETRY_... above)
+        self.telemetry.write("log", self.steps, values, True)
 
     def print_debug(self):
-        print("x, y                      ", round(self.x, 3), round(self.y, 3))
-        print("all_wheels_on_track       ", self.all_wheels_on_track)
-        print("previous_waypoint_id      ", self.previous_waypoint_id)
-        print("previous_waypoint_x, y    ", round(self.previous_waypoint_x, 3), round(self.previous_waypoint_y, 3))
-        print("next_waypoint_id          ", self.next_waypoint_id)
-        print("next_waypoint_x, y        ", round(self.next_waypoint_x, 3), round(self.next_waypoint_y, 3))
-        print("closest_waypoint_id       ", self.closest_waypoint_id)
-        print("closest_waypoint_x, y     ", round(self.closest_waypoint_x, 3), round(self.closest_waypoint_y, 3))
-        print("distance_from_closest_waypoint ", round(self.distance_from_closest_waypoint, 2))
-        print("distance_from_center      ", round(self.distance_from_center, 2))
-        print("distance_from_edge        ", round(self.distance_from_edge, 2))
-        print("distance_from_extreme_edge     ", round(self.distance_from_extreme_edge, 2))
-        print("is_left/right_of_center   ", self.is_left_of_center, self.is_right_of_center)
-        print("is_crashed / reversed     ", self.is_crashed, self.is_reversed)
-        print("is_off_track              ", self.is_off_track)
-        print("is_complete_lap           ", self.is_complete_lap)
-        print("steps, is_final_step      ", self.steps, self.is_final_step)
-        print("time                      ", round(self.time, 2))
-        print("predicted_lap_time        ", round(self.predicted_lap_time, 2))
-        print("progress                  ", round(self.progress, 2))
-        print("waypoints  (SIZE)         ", len(self.waypoints))
-        print("track_length, width       ", round(self.track_length, 2), round(self.track_width, 2))
-        print("action_speed              ", round(self.action_speed, 2))
-        print("action_steering_angle     ", round(self.action_steering_angle, 1))
-        print("action_sequence_length    ", self.action_sequence_length)
-        print("is_steering_left/right    ", self.is_steering_left, self.is_steering_right)
-        print("is_steering_straight      ", self.is_steering_straight)
-        print("heading                   ", round(self.heading, 2))
-        print("track_bearing             ", round(self.track_bearing, 2))
-        print("true_bearing              ", round(self.true_bearing, 2))
-        print("slide  / max / recent     ",
-              round(self.slide, 2), round(self.max_slide, 2), round(self.recent_max_slide, 2))
-        print("skew / max_skew           ", round(self.skew, 2), round(self.max_skew, 2))
-        print("total_distance            ", round(self.total_distance, 2))
-        print("track_speed               ", round(self.track_speed, 2))
-        print("progress_speed            ", round(self.progress_speed, 2))
-        print("just_passed_waypoint_ids  ", self.just_passed_waypoint_ids)
-        print("time_at_waypoint          ", self.time_at_waypoint)
-        print("projected_distance        ", self.projected_distance)
+        lines = []
+        for (label, fields) in self._get_debug_lines():
+            values = [label]
+            for (name, kind, digits) in fields:
+                value = getattr(self, name)
+                if digits is len:
+                    value = len(value)
+                elif digits is not None:
+                    value = round(value, digits)
+                values.append(value)
+            lines.append(values)
+        self.telemetry.write_group("debug", self.steps, lines, True)
+
+    @classmethod
+    def _get_debug_lines(cls):
+        # The padded label and fields of each line shown by print_debug(), worked out once for each class (and again
+        # if STEP_FEATURE_FIELDS is changed)
+        debug_lines = cls.__dict__.get("_debug_lines")
+        if debug_lines is None or debug_lines[0] is not cls.STEP_FEATURE_FIELDS:
+            debug_lines = (cls.STEP_FEATURE_FIELDS,
+                           [((label + " ").ljust(26), fields)
+                            for (label, *fields) in cls.STEP_FEATURE_FIELDS if label is not None])
+            cls._debug_lines = debug_lines
+        return debug_lines[1]
+
+    @classmethod
+    def get_step_feature_columns(cls):
+        # The (name, column type) of each attribute in STEP_FEATURE_FIELDS that is written for STEP_FEATURES_DIRECTORY
+        return [(name, kind) for (label, *fields) in cls.STEP_FEATURE_FIELDS
+                for (name, kind, digits) in fields if kind is not None]
 
 
 # -------------------------------------------------------------------------------
@@ -829,13 +3673,24 @@ def reward_function(params):
     if not framework_global:
         framework_global = Framework(params)
     framework_global.process_params(params)
+    instrumentation = framework_global.instrumentation
+    if instrumentation:
+        instrumentation.start_stage("get_reward")
     raw_reward = float(get_reward(framework_global))
-    if raw_reward > 0:
-        return raw_reward
-    else:
+    if not raw_reward > 0:
         tiny_reward = 0.0001
-        print("WARNING - Invalid reward " + str(raw_reward) + " replaced with " + str(tiny_reward))
-        return tiny_reward
+        framework_global.telemetry.write("warning", framework_global.steps,
+                                         ("WARNING - Invalid reward " + str(raw_reward) + " replaced with " +
+                                          str(tiny_reward),))
+        raw_reward = tiny_reward
+    if instrumentation:
+        instrumentation.end_step()
+        if framework_global.is_final_step:
+            framework_global.telemetry.write("timings", framework_global.steps,
+                                             instrumentation.get_episode_summary_line())
+    if framework_global.is_final_step:
+        framework_global.telemetry.flush()
+    return raw_reward
 
 
 framework_global = None
@@ -848,5 +3703,5 @@ framework_global = None
 # -------------------------------------------------------------------------------
 
 def get_reward(f: Framework):
-    print(f.max_possible_track_speed, round(f.projected_distance, 1))
+    f.log(f.max_possible_track_speed, round(f.projected_distance, 1))
     return f.progress_speed / f.max_possible_track_speed * f.projected_distance + f.steps / 10
@@ -0,0 +1,210 @@
+#
+# DeepRacer Framework - Calculate framework attributes offline for every episode in DeepRacer simulation trace logs
+#
+# Usage:  python -m src.tools.analyze_sim_trace TRACK_FILE LOG_FILE [LOG_FILE ...] [--workers N] [--output FILE]
+#
+# The track file is either a DeepRacer track .npy file (centre, inside and outside points on each row, needs NumPy)
+# or a JSON file containing {"waypoints": [[x, y], ...], "track_width": width}
+#
+# Each log file is a simulation trace CSV (episode, steps, X, Y, yaw, steer, throttle, action, reward, done,
+# all_wheels_on_track, progress, closest_waypoint, track_len, tstamp, episode_status, ...), and is read one line at
+# a time, so logs of any size can be analyzed. Results are written as JSON lines, one line per episode.
+#
+
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from src.deep_racer_framework import Framework, ParamNames, get_distance_between_points
+
+
+def load_track(file_name):
+    if file_name.endswith(".npy"):
+        import numpy as np
+        points = np.load(file_name)
+        waypoints = [(float(row[0]), float(row[1])) for row in points]
+        track_width = float(np.mean(np.hypot(points[:, 2] - points[:, 4], points[:, 3] - points[:, 5])))
+        return waypoints, track_width
+
+    with open(file_name) as file:
+        track = json.load(file)
+    return [(float(x), float(y)) for (x, y) in track["waypoints"]], float(track["track_width"])
+
+
+def read_episodes(file_names):
+    for file_name in file_names:
+        with open(file_name, newline="") as file:
+            rows = []
+            for row in csv.DictReader(file):
+                if rows and row["episode"] != rows[-1]["episode"]:
+                    yield file_name, rows
+                    rows = []
+                rows.append(row)
+            if rows:
+                yield file_name, rows
+
+
+def get_closest_waypoints_and_centre_offset(waypoints, point, closest_id: int):
+    previous_id = closest_id - 1 if closest_id > 0 else len(waypoints) - 1
+    next_id = closest_id + 1 if closest_id < len(waypoints) - 1 else 0
+
+    (x, y) = point
+    (closest_x, closest_y) = waypoints[closest_id]
+    (next_x, next_y) = waypoints[next_id]
+    if (x - closest_x) * (next_x - closest_x) + (y - closest_y) * (next_y - closest_y) > 0:
+        (before, after) = (closest_id, next_id)
+    else:
+        (before, after) = (previous_id, closest_id)
+
+    (before_x, before_y) = waypoints[before]
+    (after_x, after_y) = waypoints[after]
+    segment_length = get_distance_between_points(waypoints[before], waypoints[after])
+    if segment_length == 0.0:
+        return (before, after), get_distance_between_points(waypoints[before], point), True
+
+    cross = (after_x - before_x) * (y - before_y) - (after_y - before_y) * (x - before_x)
+    return (before, after), abs(cross) / segment_length, cross > 0
+
+
+def get_params_from_trace_row(row, waypoints, track_width: float):
+    x = float(row["X"])
+    y = float(row["Y"])
+    status = row.get("episode_status", "")
+    (closest_waypoints, distance_from_center, is_left_of_center) = get_closest_waypoints_and_centre_offset(
+        waypoints, (x, y), int(row["closest_waypoint"]))
+
+    return {
+        ParamNames.ALL_WHEELS_ON_TRACK: row["all_wheels_on_track"] in ("True", "true", "1"),
+        ParamNames.X: x,
+        ParamNames.Y: y,
+        ParamNames.CLOSEST_OBJECTS: [0, 0],
+        ParamNames.CLOSEST_WAYPOINTS: list(closest_waypoints),
+        ParamNames.DISTANCE_FROM_CENTER: distance_from_center,
+        ParamNames.IS_CRASHED: status == "crashed",
+        ParamNames.IS_LEFT_OF_CENTER: is_left_of_center,
+        ParamNames.IS_OFFTRACK: status == "off_track",
+        ParamNames.IS_REVERSED: status == "reversed",
+        ParamNames.HEADING: float(row["yaw"]),
+        ParamNames.OBJECTS_DISTANCE: [],
+        ParamNames.OBJECTS_DISTANCE_FROM_CENTER: [],
+        ParamNames.OBJECTS_HEADING: [],
+        ParamNames.OBJECTS_LEFT_OF_CENTER: [],
+        ParamNames.OBJECTS_LOCATION: [],
+        ParamNames.OBJECTS_SPEED: [],
+        ParamNames.PROGRESS: float(row["progress"]),
+        ParamNames.SPEED: float(row["throttle"]),
+        ParamNames.STEERING_ANGLE: float(row["steer"]),
+        ParamNames.STEPS: float(row["steps"]),
+        ParamNames.TRACK_LENGTH: float(row["track_len"]),
+        ParamNames.TRACK_WIDTH: track_width,
+        ParamNames.WAYPOINTS: waypoints
+    }
+
+
+#
+# Each worker process builds the track geometry once, and then reuses one Framework for every episode
+#
+
+_worker_track = None
+_worker_framework = None
+
+
+def _initialize_worker(waypoints, track_width: float):
+    global _worker_track, _worker_framework
+    _worker_track = (waypoints, track_width)
+    _worker_framework = None
+
+
+def analyze_episode(file_name, rows):
+    global _worker_framework
+    (waypoints, track_width) = _worker_track
+
+    summary = {"file": file_name, "episode": int(rows[0]["episode"]), "steps": 0}
+    slides = []
+    skews = []
+    corner_cuttings = []
+    projected_distances = []
+    track_speeds = []
+    framework = _worker_framework
+
+    for row in rows:
+        params = get_params_from_trace_row(row, waypoints, track_width)
+        if framework is None:
+            framework = _worker_framework = Framework(params)
+        framework.process_params(params)
+
+        if framework.steps > 2:  # The framework starts each episode afresh on steps 1 and 2
+            slides.append(abs(framework.slide))
+            skews.append(abs(framework.skew))
+            corner_cuttings.append(framework.corner_cutting)
+            projected_distances.append(framework.projected_distance)
+            track_speeds.append(framework.track_speed)
+
+    summary["steps"] = framework.steps
+    summary["progress"] = framework.progress
+    summary["status"] = rows[-1].get("episode_status", "")
+    summary["time"] = framework.time
+    summary["total_distance"] = round(framework.total_distance, 3)
+    summary["max_slide"] = round(framework.max_slide, 2)
+    summary["max_skew"] = round(framework.max_skew, 2)
+    summary["mean_abs_slide"] = _get_rounded_mean(slides, 2)
+    summary["mean_abs_skew"] = _get_rounded_mean(skews, 2)
+    summary["mean_corner_cutting"] = _get_rounded_mean(corner_cuttings, 3)
+    summary["mean_projected_distance"] = _get_rounded_mean(projected_distances, 3)
+    summary["min_projected_distance"] = round(min(projected_distances), 3) if projected_distances else None
+    summary["mean_track_speed"] = _get_rounded_mean(track_speeds, 3)
+    summary["max_track_speed"] = round(max(track_speeds), 3) if track_speeds else None
+    summary["time_at_waypoint"] = framework.time_at_waypoint
+    return summary
+
+
+def _get_rounded_mean(values, digits: int):
+    if not values:
+        return None
+    return round(math.fsum(values) / len(values), digits)
+
+
+def analyze_logs(track_file, log_files, workers: int = None, max_pending_episodes: int = None):
+    (waypoints, track_width) = load_track(track_file)
+    workers = workers or os.cpu_count() or 1
+
+    # Only read ahead a little, so that memory use stays flat however large the logs are
+    max_pending_episodes = max_pending_episodes or workers * 4
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker,
+                             initargs=(waypoints, track_width)) as executor:
+        pending = set()
+        for file_name, rows in read_episodes(log_files):
+            if len(pending) >= max_pending_episodes:
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(analyze_episode, file_name, rows))
+
+        for future in pending:
+            yield future.result()
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Calculate framework attributes for DeepRacer simulation traces")
+    parser.add_argument("track_file")
+    parser.add_argument("log_files", nargs="+")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default is one per CPU)")
+    parser.add_argument("--output", help="Write the per-episode JSON lines to this file instead of stdout")
+    args = parser.parse_args(arguments)
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for summary in analyze_logs(args.track_file, args.log_files, args.workers):
+            output.write(json.dumps(summary) + "\n")
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
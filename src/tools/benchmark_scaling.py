@@ -0,0 +1,407 @@
+#
+# DeepRacer Framework - Measure how the time taken grows with the number of waypoints, and check it against a baseline
+#
+# Usage:  python -m src.tools.benchmark_scaling [--sizes 100,300,1000,3000,10000] [--output RESULTS.json]
+#                 [--baseline BASELINE.json] [--save-baseline BASELINE.json] [--tolerance FRACTION]
+#                 [--exponent-tolerance AMOUNT]
+#
+# Synthetic tracks (see synthetic_tracks) are made at each size in two series: "density" keeps the track the same
+# length with the waypoints closer together, and "length" keeps the waypoints the same distance apart on ever longer
+# tracks. Both have a repeated waypoint every so often, as well as the usual repeat of the first waypoint at the end.
+#
+# Every public Framework method and the geometry primitives are timed on each track (best of a few repeats, in
+# nanoseconds per call, and per step for process_params() and process_batch()). Each repeat is also timed relative
+# to a fixed piece of plain Python straight afterwards, so that the comparisons still hold when the machine speeds up
+# or slows down. The scaling exponent of each is the slope of log(relative time) against log(waypoints), so about 0
+# means constant time and 1 means linear. Framework.log() and print_debug() are timed with the default telemetry
+# settings, so they include formatting and writing their text (to the null device), and print_debug() grows with the
+# number of waypoints because time_at_waypoint has a value for every waypoint.
+#
+# With --baseline, the exit status is 1 if anything is relatively slower than the baseline by more than the tolerance
+# (plus a microsecond, to allow for timer noise on the quickest calls), or if its exponent has grown by more than the
+# exponent tolerance, and it stays that way when timed again. Timings are only comparable on the same machine (and
+# Python version), so save a baseline of your own before making changes.
+#
+# The memory allocated at once by process_params() in each step of an episode (after the first few steps) is also
+# traced on each track that has a fixed budget in STEP_ALLOCATION_BUDGETS, and the exit status is 1 if the median or
+# the largest is over its budget, with or without a baseline. Unlike timings, these are the same on any machine (for
+# the same Python version), so the budgets are fixed numbers a little above what each track needs now; make sure that
+# any change to them is intended.
+#
+
+import argparse
+import contextlib
+import gc
+import inspect
+import json
+import math
+import os
+import statistics
+import sys
+import time
+
+from src.deep_racer_framework import (FRAMEWORK_VERSION, Framework, ParamNames, TrackCorners, TrackDistances,
+                                      TrackEdgeArrays, WaypointGrid, get_bearing_between_points,
+                                      get_cached_processed_waypoints, get_cached_track_corners,
+                                      get_distance_between_points, get_distance_from_line_segment, get_edge_point,
+                                      get_intersection_of_two_lines, get_point_at_bearing, get_processed_waypoints,
+                                      get_ray_hit_distance, get_track_hash, get_turn_between_directions,
+                                      is_heading_between_points, is_point_between, np)
+from src.tools.replay_episodes import replay
+from src.tools.synthetic_tracks import make_params_along_track, make_synthetic_track
+
+DEFAULT_SIZES = (100, 300, 1000, 3000, 10000)
+TRACK_WIDTH = 1.066
+DENSITY_TRACK_LENGTH = 60.0
+LENGTH_WAYPOINT_SPACING = 0.3
+DUPLICATE_EVERY = 25
+EPISODE_STEPS = 150
+
+MIN_SECONDS_PER_REPEAT = 0.02
+MIN_SECONDS_PER_REFERENCE = 0.005
+REPEATS = 5
+RECHECKS = 2
+ABSOLUTE_SLACK_NS = 1000
+
+# Bytes allocated at once by process_params() in one step, as (median, largest) for each track size, measured with
+# CPython 3.11 (with or without NumPy)
+STEP_ALLOCATION_BUDGETS = {
+    "density": {100: (512, 704), 300: (768, 1152), 1000: (1088, 1280), 3000: (1280, 1408), 10000: (1344, 1408)},
+    "length": {100: (512, 576), 300: (768, 1216), 1000: (768, 1216), 3000: (896, 1216), 10000: (1024, 1216)}
+}
+
+
+def make_benchmark_track(series: str, size: int):
+    length = DENSITY_TRACK_LENGTH if series == "density" else LENGTH_WAYPOINT_SPACING * size
+    corners = max(4, int(round(length / 15)))
+    return make_synthetic_track(length, size, corners, 0.3, DUPLICATE_EVERY)
+
+
+def _reference_workload(values):
+    total = 0.0
+    for (x, y) in values:
+        total += math.sqrt(x * x + y * y)
+    return total
+
+
+class ReferenceTimer:
+    # Plain Python arithmetic that does not depend on the framework at all, timed alongside every repeat of every
+    # benchmark to measure how quick the machine is being at that moment (which can change a lot from one second to
+    # the next on shared or throttled machines)
+
+    def __init__(self):
+        self._arguments = [([(float(i), float(i % 7)) for i in range(1000)],)]
+        self._loops = _get_loops_for_duration(_reference_workload, self._arguments, MIN_SECONDS_PER_REFERENCE)
+
+    def time_run(self):
+        # Nanoseconds for one run of the workload
+        return _time_loops(_reference_workload, self._arguments, self._loops) / self._loops
+
+
+def _time_loops(function, arguments, loops: int):
+    clock = time.perf_counter_ns
+    started = clock()
+    for _ in range(loops):
+        for a in arguments:
+            function(*a)
+    return clock() - started
+
+
+def _get_loops_for_duration(function, arguments, seconds: float):
+    loops = 1
+    while True:
+        elapsed = _time_loops(function, arguments, loops)
+        if elapsed >= seconds * 1e9 or loops >= 1 << 20:
+            return loops
+        loops *= 2 if elapsed <= 0 else max(2, min(100, int(seconds * 1e9 / elapsed) + 1))
+
+
+def time_calls(function, arguments, reference_timer: ReferenceTimer):
+    # Best of a few repeats, cycling through the given arguments (each a tuple), as nanoseconds per call, and the
+    # median of each repeat relative to a run of the reference workload timed straight after it (the median, since a
+    # pause in either one would otherwise skew the ratio)
+    loops = _get_loops_for_duration(function, arguments, MIN_SECONDS_PER_REPEAT)
+    calls = loops * len(arguments)
+    best = math.inf
+    ratios = []
+    for _ in range(REPEATS):
+        nanoseconds = _time_loops(function, arguments, loops) / calls
+        best = min(best, nanoseconds)
+        ratios.append(nanoseconds / reference_timer.time_run())
+    return best, statistics.median(ratios)
+
+
+def get_benchmarks(waypoints, params_sequence):
+    # Each benchmark is a function to call, a list of argument tuples, and how many steps each call represents
+    first_params = params_sequence[0]
+    track_width = first_params[ParamNames.TRACK_WIDTH]
+    framework = Framework(first_params)
+    for params in params_sequence:
+        framework.process_params(params)
+
+    points = [(p[ParamNames.X], p[ParamNames.Y]) for p in params_sequence]
+    headings = [p[ParamNames.HEADING] for p in params_sequence]
+    point_pairs = list(zip(points, points[len(points) // 2:] + points[:len(points) // 2]))
+    waypoint_count = len(waypoints)
+    waypoint_ids = [(i * 37) % waypoint_count for i in range(len(points))]
+    waypoint_id_pairs = [(a, (a + waypoint_count // 2) % waypoint_count) for a in waypoint_ids]
+    progresses = [p[ParamNames.PROGRESS] for p in params_sequence]
+    columns = {name: [p[name] for p in params_sequence] for name in first_params}
+    for name in (ParamNames.WAYPOINTS, ParamNames.TRACK_WIDTH, ParamNames.TRACK_LENGTH):
+        columns[name] = first_params[name]
+
+    def replay_episode():
+        for p in params_sequence:
+            framework.process_params(p)
+
+    track_hash = get_track_hash(waypoints, track_width)
+    processed_waypoints = get_cached_processed_waypoints(waypoints, track_width)
+    track_distances = TrackDistances(waypoints)
+    segments = [(w, waypoints[(i + 1) % waypoint_count]) for (i, w) in enumerate(waypoints[:len(points)])]
+    corners = [(waypoints[i - 1], waypoints[i], waypoints[(i + 1) % waypoint_count]) for i in waypoint_ids]
+    corners = [(a, b, c) for (a, b, c) in corners if a != b != c]   # Repeated waypoints are not corners
+    edges = [(w.left_safe, w.right_safe) for w in processed_waypoints[:len(points)]]
+
+    benchmarks = {
+        "Framework.__init__": (Framework, [(first_params,)], 1),
+        "Framework.process_params": (replay_episode, [()], len(params_sequence)),
+        "Framework.process_batch": (framework.process_batch, [(columns,)], len(params_sequence)),
+        "Framework.get_closest_waypoint_id": (framework.get_closest_waypoint_id, [(p,) for p in points], 1),
+        "Framework.get_waypoint_ids_before_and_after": (framework.get_waypoint_ids_before_and_after,
+                                                        [(p,) for p in points], 1),
+        "Framework.get_track_distance_between_waypoints": (framework.get_track_distance_between_waypoints,
+                                                           waypoint_id_pairs, 1),
+        "Framework.get_track_distance_between_points": (framework.get_track_distance_between_points, point_pairs, 1),
+        "Framework.get_track_distance_from_progress": (framework.get_track_distance_from_progress,
+                                                       [(p,) for p in progresses], 1),
+        "Framework.get_progress_from_track_distance": (framework.get_progress_from_track_distance,
+                                                       [(p / 100 * framework.track_length,) for p in progresses], 1),
+        "Framework.get_progress_at_point": (framework.get_progress_at_point, [(p,) for p in points], 1),
+        "Framework.get_point_at_progress": (framework.get_point_at_progress, [(p,) for p in progresses], 1),
+        "Framework.get_edge_distance_at_point": (framework.get_edge_distance_at_point, [(p,) for p in points], 1),
+        "Framework.is_point_on_track": (framework.is_point_on_track, [(p,) for p in points], 1),
+        "Framework.get_edge_distance_along_bearing": (framework.get_edge_distance_along_bearing,
+                                                      list(zip(points, headings)), 1),
+        "Framework.get_progress_speed": (framework.get_progress_speed, [(s,) for s in (1, 2, 5, 10)], 1),
+        "Framework.log": (framework.log, [("benchmark", 1.0)], 1),
+        "Framework.print_debug": (framework.print_debug, [()], 1),
+
+        "get_processed_waypoints": (get_processed_waypoints, [(waypoints, track_width)], 1),
+        "get_cached_processed_waypoints": (get_cached_processed_waypoints, [(waypoints, track_width)], 1),
+        "TrackDistances": (TrackDistances, [(waypoints,)], 1),
+        "TrackDistances.get_point_at_position": (track_distances.get_point_at_position,
+                                                 [(p / 100 * track_distances.total,) for p in progresses], 1),
+        "TrackCorners": (TrackCorners, [(
+            track_distances, waypoint_count, Framework.CORNER_LOOK_AHEAD_DISTANCES,
+            Framework.CORNER_SMOOTHING_DISTANCE, Framework.CORNER_MIN_CURVATURE)], 1),
+        "get_cached_track_corners": (get_cached_track_corners, [(
+            track_hash, track_distances, waypoint_count, Framework.CORNER_LOOK_AHEAD_DISTANCES,
+            Framework.CORNER_SMOOTHING_DISTANCE, Framework.CORNER_MIN_CURVATURE)], 1),
+        "WaypointGrid": (WaypointGrid, [(waypoints, WaypointGrid.get_cell_size(waypoints, track_distances.total,
+                                                                                track_width))], 1),
+        "get_track_hash": (get_track_hash, [(waypoints, track_width)], 1),
+
+        "get_distance_between_points": (get_distance_between_points, point_pairs, 1),
+        "get_bearing_between_points": (get_bearing_between_points, point_pairs, 1),
+        "get_turn_between_directions": (get_turn_between_directions, list(zip(headings, reversed(headings))), 1),
+        "is_point_between": (is_point_between, [(p, a, b) for (p, (a, b)) in zip(points, segments)], 1),
+        "is_heading_between_points": (is_heading_between_points,
+                                      [(p, h, left, right) for (p, h, (left, right)) in zip(points, headings, edges)],
+                                      1),
+        "get_ray_hit_distance": (get_ray_hit_distance,
+                                 [(p, get_point_at_bearing(p, h, 1.0), left, right)
+                                  for (p, h, (left, right)) in zip(points, headings, edges)], 1),
+        "get_distance_from_line_segment": (get_distance_from_line_segment,
+                                           [(p, a, b) for (p, (a, b)) in zip(points, segments)], 1),
+        "get_point_at_bearing": (get_point_at_bearing, [(p, h, 1.0) for (p, h) in zip(points, headings)], 1),
+        "get_intersection_of_two_lines": (get_intersection_of_two_lines,
+                                          [(p, get_point_at_bearing(p, h, 1.0), left, right)
+                                           for (p, h, (left, right)) in zip(points, headings, edges)], 1),
+        "get_edge_point": (get_edge_point, [(*c, 90, track_width / 2) for c in corners], 1),
+    }
+
+    if np is not None:
+        edge_arrays = TrackEdgeArrays(processed_waypoints)
+        start_ids = [p[ParamNames.CLOSEST_WAYPOINTS][1] for p in params_sequence]
+        benchmarks["TrackEdgeArrays"] = (TrackEdgeArrays, [(processed_waypoints,)], 1)
+        benchmarks["TrackEdgeArrays.get_first_exit_index"] = (edge_arrays.get_first_exit_index,
+                                                              list(zip(points, headings, start_ids)), 1)
+        benchmarks["TrackEdgeArrays.get_edge_distances"] = (edge_arrays.get_edge_distances, [
+            (p, [h - 30, h, h + 30], s) for (p, h, s) in zip(points, headings, start_ids)], 1)
+
+    return benchmarks
+
+
+def get_unbenchmarked_methods(benchmark_names):
+    public_methods = [name for (name, _) in inspect.getmembers(Framework, inspect.isfunction)
+                      if not name.startswith("_")]
+    return [name for name in public_methods if "Framework." + name not in benchmark_names]
+
+
+def get_scaling_exponent(sizes, nanoseconds):
+    # Least squares slope of log(time) against log(size)
+    points = [(math.log(s), math.log(t)) for (s, t) in zip(sizes, nanoseconds) if t > 0]
+    if len(points) < 2:
+        return 0.0
+    mean_x = sum(x for (x, _) in points) / len(points)
+    mean_y = sum(y for (_, y) in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for (x, _) in points)
+    return sum((x - mean_x) * (y - mean_y) for (x, y) in points) / spread if spread else 0.0
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, show_progress: bool = False, names=None):
+    timings = {}
+    relative_timings = {}
+    reference_timer = ReferenceTimer()
+    for series in ("density", "length"):
+        series_timings = timings[series] = {}
+        series_relative_timings = relative_timings[series] = {}
+        for size in sizes:
+            waypoints = make_benchmark_track(series, size)
+            params_sequence = make_params_along_track(waypoints, TRACK_WIDTH, EPISODE_STEPS)
+            benchmarks = get_benchmarks(waypoints, params_sequence)
+
+            # Anything printed (e.g. by log() and print_debug()) is thrown away, but still has to be written
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                with open(os.devnull, "w") as output, contextlib.redirect_stdout(output):
+                    for name, (function, arguments, steps_per_call) in benchmarks.items():
+                        if names is not None and name not in names:
+                            continue
+                        (nanoseconds, relative) = time_calls(function, arguments, reference_timer)
+                        series_timings.setdefault(name, []).append(round(nanoseconds / steps_per_call, 1))
+                        series_relative_timings.setdefault(name, []).append(round(relative / steps_per_call, 6))
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+            if show_progress:
+                print("Timed", series, size, file=sys.stderr)
+
+    return {
+        "framework_version": FRAMEWORK_VERSION,
+        "numpy": np is not None,
+        "sizes": list(sizes),
+        "nanoseconds": timings,
+        "relative": relative_timings,
+        "exponents": {series: {name: round(get_scaling_exponent(sizes, values), 3) for name, values in
+                               series_timings.items()} for series, series_timings in relative_timings.items()}
+    }
+
+
+def measure_step_allocations(sizes=DEFAULT_SIZES):
+    # The allocations of process_params() over an episode on each track that has a budget, as summarised by replay()
+    allocations = {}
+    for series, budgets in STEP_ALLOCATION_BUDGETS.items():
+        for size in sizes:
+            if size in budgets:
+                params_sequence = make_params_along_track(make_benchmark_track(series, size), TRACK_WIDTH,
+                                                          EPISODE_STEPS)
+                results = replay(params_sequence, lambda framework: 1.0, trace_allocations=True)
+                allocations.setdefault(series, {})[str(size)] = results["process_params_allocations"]
+    return allocations
+
+
+def get_allocation_overruns(allocations):
+    # A list of descriptions of every step allocation that is over its budget
+    overruns = []
+    for series, series_allocations in allocations.items():
+        for size, summary in series_allocations.items():
+            for (key, budget) in zip(("p50_bytes", "max_bytes"), STEP_ALLOCATION_BUDGETS[series][int(size)]):
+                if summary[key] > budget:
+                    overruns.append("{} process_params at {} waypoints: {} {} bytes per step, budget {}".format(
+                        series, size, key.split("_")[0], summary[key], budget))
+    return overruns
+
+
+def get_regressions(results, baseline, tolerance: float, exponent_tolerance: float):
+    # A list of (benchmark name, description) for everything that is slower than the baseline allows
+    regressions = []
+    for series, series_timings in results["nanoseconds"].items():
+        baseline_timings = baseline["nanoseconds"].get(series, {})
+        for name, values in series_timings.items():
+            if name not in baseline_timings:
+                continue
+            # Relative to the reference workload, so that a change in the speed of the machine cancels out
+            baseline_values = dict(zip(baseline["sizes"], baseline["relative"][series][name]))
+            for size, relative, nanoseconds in zip(results["sizes"], results["relative"][series][name], values):
+                baseline_relative = baseline_values.get(size)
+                if baseline_relative is None:
+                    continue
+                allowed = baseline_relative * nanoseconds / relative if relative > 0 else nanoseconds
+                if nanoseconds > allowed * (1 + tolerance) + ABSOLUTE_SLACK_NS:
+                    regressions.append((name, "{} {} at {} waypoints: {:.1f}us per call, baseline {:.1f}us".format(
+                        series, name, size, nanoseconds / 1000, allowed / 1000)))
+
+            # Exponents are only comparable over the same sizes
+            if results["sizes"] == baseline["sizes"]:
+                exponent = results["exponents"][series][name]
+                baseline_exponent = baseline["exponents"][series][name]
+                if exponent > baseline_exponent + exponent_tolerance:
+                    regressions.append((name, "{} {} scales as waypoints^{:.2f}, baseline waypoints^{:.2f}".format(
+                        series, name, exponent, baseline_exponent)))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Time the framework on synthetic tracks of increasing size")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="Numbers of waypoints, separated by commas (default %(default)s)")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument("--baseline", help="Compare with the results in this file, and fail on any regression")
+    parser.add_argument("--save-baseline", help="Write the results to this file, to use as a baseline later")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Allowed slowdown compared with the baseline, as a fraction (default 0.5)")
+    parser.add_argument("--exponent-tolerance", type=float, default=0.25,
+                        help="Allowed growth in each scaling exponent compared with the baseline (default 0.25)")
+    args = parser.parse_args(arguments)
+
+    sizes = tuple(sorted(int(s) for s in args.sizes.split(",")))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    results = run_benchmarks(sizes, show_progress=True)
+    results["step_allocations"] = measure_step_allocations(sizes)
+    unbenchmarked = get_unbenchmarked_methods(results["nanoseconds"]["density"])
+    if unbenchmarked:
+        print("WARNING - No benchmark for Framework." + ", Framework.".join(unbenchmarked), file=sys.stderr)
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    for file_name in (args.output, args.save_baseline):
+        if file_name:
+            with open(file_name, "w") as file:
+                file.write(text + "\n")
+
+    overruns = get_allocation_overruns(results["step_allocations"])
+    for overrun in overruns:
+        print("OVER BUDGET - " + overrun, file=sys.stderr)
+
+    if baseline is not None:
+        if baseline.get("numpy") != results["numpy"]:
+            print("WARNING - The baseline was made " + ("with" if baseline.get("numpy") else "without") + " NumPy",
+                  file=sys.stderr)
+        regressions = get_regressions(results, baseline, args.tolerance, args.exponent_tolerance)
+
+        # Only a regression if it happens every time, since a busy machine can slow down any one benchmark
+        for _ in range(RECHECKS):
+            if not regressions:
+                break
+            names = {name for (name, _) in regressions}
+            print("Timing again: " + ", ".join(sorted(names)), file=sys.stderr)
+            regressions = [(name, description) for (name, description) in get_regressions(
+                run_benchmarks(sizes, names=names), baseline, args.tolerance, args.exponent_tolerance)
+                           if name in names]
+
+        for (_, regression) in regressions:
+            print("REGRESSION - " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+    if overruns:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
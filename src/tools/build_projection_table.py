@@ -0,0 +1,177 @@
+#
+# DeepRacer Framework - Build a table of projections for one track, for Framework.PROJECTION_TABLE_FILE
+#
+# Usage:  python -m src.tools.build_projection_table TRACK_FILE OUTPUT_FILE [--position-step METERS]
+#                 [--offset-step METERS] [--heading-step DEGREES] [--max-heading DEGREES] [--workers N]
+#
+# The track file is either a DeepRacer track .npy file or a JSON file containing
+# {"waypoints": [[x, y], ...], "track_width": width}, the same as for analyze_sim_trace
+#
+# The projections are sampled at every combination of position along the track, offset from the center line (across
+# the whole width of the track) and heading relative to the track, using the usual calculation (so NumPy is needed).
+# Each cell of the table is also sampled at the middle of its edges and faces, to estimate how far the interpolation
+# could be wrong. Positions are shared out between worker processes. The table is written in a compact binary format
+# that the framework memory-maps, so one copy is shared by every process that uses it.
+#
+
+import argparse
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.deep_racer_framework import (Framework, ParamNames, ProjectionTable, TrackDistances, get_track_hash,
+                                      get_bearing_between_points, get_point_at_bearing)
+from src.tools.analyze_sim_trace import load_track
+
+
+#
+# Each worker process builds the track geometry once, and then reuses one Framework for every run of positions
+#
+
+_worker_track = None
+_worker_framework = None
+
+
+def _initialize_worker(waypoints, track_width: float):
+    global _worker_track, _worker_framework
+    _worker_track = (waypoints, track_width)
+    _worker_framework = None
+
+
+def calculate_samples(positions, offsets, headings):
+    # The projected distance, projected progress distance and finish left for every combination of the given
+    # positions, offsets and relative headings, as an array of shape (positions, offsets, headings, 3)
+    global _worker_framework
+    (waypoints, track_width) = _worker_track
+    track_distances = TrackDistances(waypoints)
+
+    columns = {name: [] for name in [ParamNames.X, ParamNames.Y, ParamNames.HEADING, ParamNames.CLOSEST_WAYPOINTS,
+                                     ParamNames.DISTANCE_FROM_CENTER, ParamNames.IS_LEFT_OF_CENTER]}
+    for position in positions:
+        before_id = track_distances.get_waypoint_id_at_position(position)
+        after_id = before_id + 1 if before_id < len(waypoints) - 1 else 0
+        track_bearing = get_bearing_between_points(waypoints[before_id], waypoints[after_id])
+        centre_point = track_distances.get_point_at_position(position)
+        for offset in offsets:
+            (x, y) = get_point_at_bearing(centre_point, track_bearing + 90, offset)
+            for heading in headings:
+                columns[ParamNames.X].append(x)
+                columns[ParamNames.Y].append(y)
+                columns[ParamNames.HEADING].append(track_bearing + heading)
+                columns[ParamNames.CLOSEST_WAYPOINTS].append((before_id, after_id))
+                columns[ParamNames.DISTANCE_FROM_CENTER].append(abs(offset))
+                columns[ParamNames.IS_LEFT_OF_CENTER].append(offset > 0)
+
+    # Every row is the first step of an episode, so the true bearing is just the heading
+    row_count = len(columns[ParamNames.X])
+    columns[ParamNames.STEPS] = [1] * row_count
+    columns[ParamNames.PROGRESS] = [0.0] * row_count
+    columns[ParamNames.TRACK_WIDTH] = track_width
+
+    if _worker_framework is None:
+        _worker_framework = Framework({ParamNames.WAYPOINTS: waypoints, ParamNames.TRACK_WIDTH: track_width,
+                                       ParamNames.TRACK_LENGTH: track_distances.total})
+    results = _worker_framework.process_batch(columns)
+
+    samples = np.stack((results["projected_distance"], results["projected_progress_distance"],
+                        results["projected_finish_left"]), axis=-1)
+    return samples.reshape(len(positions), len(offsets), len(headings), 3)
+
+
+def get_midpoints(values, axis: int):
+    # The values with the mean of each neighbouring pair inserted between them along one axis
+    values = np.moveaxis(values, axis, 0)
+    result = np.empty((2 * len(values) - 1,) + values.shape[1:])
+    result[::2] = values
+    result[1::2] = (values[:-1] + values[1:]) / 2
+    return np.moveaxis(result, 0, axis)
+
+
+def calculate_table_rows(positions, next_position: float, offsets, headings):
+    # The table values for the given positions, including an estimate of the interpolation error of each cell: the
+    # largest difference from the interpolation of its corners at the middle of every edge and face and the middle of
+    # the cell (it could still be larger in between). Cells that cross a waypoint (where the track bearing, and so
+    # the meaning of the relative heading, changes) or where the samples finish on different sides are never used
+    all_positions = list(positions) + [next_position]
+    samples = calculate_samples(get_midpoints(np.array(all_positions), 0).tolist(),
+                                get_midpoints(np.array(offsets), 0).tolist(),
+                                get_midpoints(np.array(headings), 0).tolist())
+    interpolated = samples[::2, ::2, ::2]
+    for axis in range(3):
+        interpolated = get_midpoints(interpolated, axis)
+
+    # Every sample in each cell, from its first corner to the opposite corner
+    shape = (len(positions), len(offsets) - 1, len(headings) - 1)
+    cell_samples = np.stack([samples[a:a + 2 * shape[0]:2, b:b + 2 * shape[1]:2, c:c + 2 * shape[2]:2]
+                             for a in (0, 1, 2) for b in (0, 1, 2) for c in (0, 1, 2)])
+    cell_interpolated = np.stack([interpolated[a:a + 2 * shape[0]:2, b:b + 2 * shape[1]:2, c:c + 2 * shape[2]:2]
+                                  for a in (0, 1, 2) for b in (0, 1, 2) for c in (0, 1, 2)])
+    errors = np.abs(cell_samples[..., :2] - cell_interpolated[..., :2]).max(axis=(0, -1))
+    is_same_finish = (cell_samples[..., 2] == cell_samples[0, ..., 2]).all(axis=0)
+
+    track_distances = TrackDistances(_worker_track[0])
+    waypoint_ids = [track_distances.get_waypoint_id_at_position(p) for p in all_positions]
+    is_within_segment = [waypoint_ids[i] == waypoint_ids[i + 1] and all_positions[i + 1] < track_distances.total
+                         for i in range(len(positions))]
+    is_usable = is_same_finish & np.array(is_within_segment)[:, np.newaxis, np.newaxis]
+
+    rows = np.full((len(positions), len(offsets), len(headings), ProjectionTable.VALUE_COUNT), np.inf)
+    rows[..., :3] = samples[:2 * len(positions):2, ::2, ::2]
+    rows[:, :-1, :-1, 3] = np.where(is_usable, errors, np.inf)
+    return rows
+
+
+def build_projection_table(waypoints, track_width: float, position_step: float = 0.05, offset_step: float = 0.05,
+                           heading_step: float = 2.0, max_heading: float = 60.0, workers: int = None,
+                           positions_per_task: int = 8):
+    track_length = TrackDistances(waypoints).total
+    position_count = max(1, int(math.ceil(track_length / position_step)))
+    max_offset = track_width / 2
+    offset_count = max(2, int(math.ceil(2 * max_offset / offset_step)) + 1)
+    heading_count = max(2, int(math.ceil(2 * max_heading / heading_step)) + 1)
+
+    values = np.zeros((position_count, offset_count, heading_count, ProjectionTable.VALUE_COUNT), dtype=np.float32)
+    table = ProjectionTable(get_track_hash(waypoints, track_width), track_length, max_offset, max_heading, values)
+    (positions, offsets, headings) = table.get_axes()
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, initializer=_initialize_worker,
+                             initargs=(waypoints, track_width)) as executor:
+        futures = {}
+        for first in range(0, position_count, positions_per_task):
+            task_positions = positions[first:first + positions_per_task]
+            next_position = first + len(task_positions)
+            next_position = positions[next_position] if next_position < position_count else track_length
+            futures[first] = executor.submit(calculate_table_rows, task_positions, next_position, offsets, headings)
+        for first, future in futures.items():
+            rows = future.result()
+            values[first:first + len(rows)] = rows
+
+    return table
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Build a table of projections for Framework.PROJECTION_TABLE_FILE")
+    parser.add_argument("track_file")
+    parser.add_argument("output_file")
+    parser.add_argument("--position-step", type=float, default=0.05, help="Meters along the track (default 0.05)")
+    parser.add_argument("--offset-step", type=float, default=0.05, help="Meters across the track (default 0.05)")
+    parser.add_argument("--heading-step", type=float, default=2.0, help="Degrees (default 2)")
+    parser.add_argument("--max-heading", type=float, default=60.0,
+                        help="Largest heading either side of the track bearing in degrees (default 60)")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default is one per CPU)")
+    args = parser.parse_args(arguments)
+
+    (waypoints, track_width) = load_track(args.track_file)
+    table = build_projection_table(waypoints, track_width, args.position_step, args.offset_step, args.heading_step,
+                                   args.max_heading, args.workers)
+    table.write(args.output_file)
+
+    (position_count, offset_count, heading_count) = table.values.shape[:3]
+    print("Wrote", position_count * offset_count * heading_count, "samples to", args.output_file, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#
+# DeepRacer Framework - Compare many reward functions on the same recorded episodes, in a single pass
+#
+# Usage:  python -m src.tools.compare_rewards EPISODES_FILE --reward MODULE:FUNCTION [--reward MODULE:FUNCTION ...]
+#                 [--lazy] [--workers N] [--output RESULTS.json]
+#
+# The episodes file is the same as for replay_episodes. Each reward function takes a Framework (like get_reward), and
+# MODULE:FUNCTION,FUNCTION,... names several functions in the same module.
+#
+# The framework processes the params for each step just once, and then every reward function is called on the same
+# Framework, so the framework's work does not grow with the number of reward functions (with --lazy, any attribute
+# that only some of the reward functions use is still only calculated once per step). With --workers, the episodes are
+# shared out between a pool of worker processes, each with its own Framework.
+#
+# A summary of the rewards from each function is printed as JSON, and --output also writes every reward for every step.
+#
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import math
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from src.deep_racer_framework import Framework, ParamNames
+from src.tools.replay_episodes import get_percentile, load_params_sequence
+
+
+def load_reward_functions(names):
+    # A dict of the reward functions, named MODULE:FUNCTION, in the order given
+    reward_functions = {}
+    for name in names:
+        (module_name, function_names) = name.split(":")
+        module = importlib.import_module(module_name)
+        for function_name in function_names.split(","):
+            reward_functions[module_name + ":" + function_name] = getattr(module, function_name)
+    return reward_functions
+
+
+def split_episodes(params_sequence):
+    # Lists of params, one list per episode, which starts again whenever the steps go back (as in replay_episodes)
+    episodes = []
+    previous_steps = None
+    for params in params_sequence:
+        steps = params[ParamNames.STEPS]
+        if previous_steps is None or steps <= previous_steps:
+            episodes.append([])
+        episodes[-1].append(params)
+        previous_steps = steps
+    return episodes
+
+
+#
+# Each worker process (or just this process, without a pool) reuses one Framework for every episode
+#
+
+_worker_reward_functions = None
+_worker_framework = None
+
+
+def _initialize_worker(reward_functions, lazy_calculations: bool):
+    global _worker_reward_functions, _worker_framework
+    _worker_reward_functions = reward_functions
+    _worker_framework = None
+    Framework.LAZY_CALCULATIONS = lazy_calculations
+
+
+def evaluate_episodes(episodes):
+    # The rewards from every reward function for every step of the episodes, and the time taken by the framework and
+    # by each reward function (in nanoseconds)
+    global _worker_framework
+    reward_functions = list(_worker_reward_functions.values())
+    rewards = [[] for _ in reward_functions]
+    reward_nanoseconds = [0] * len(reward_functions)
+    framework_nanoseconds = 0
+    framework = _worker_framework
+    clock = time.perf_counter_ns
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for episode in episodes:
+            for params in episode:
+                started = clock()
+                if framework is None:
+                    framework = _worker_framework = Framework(params)
+                framework.process_params(params)
+                finished = clock()
+                framework_nanoseconds += finished - started
+
+                for i, get_reward in enumerate(reward_functions):
+                    started = finished
+                    rewards[i].append(float(get_reward(framework)))
+                    finished = clock()
+                    reward_nanoseconds[i] += finished - started
+            framework.telemetry.flush()
+
+    return rewards, framework_nanoseconds, reward_nanoseconds
+
+
+def evaluate_rewards(params_sequence, reward_functions, lazy_calculations: bool = False, workers: int = None,
+                     episodes_per_task: int = 8):
+    # Evaluates the reward functions (a dict of name to function) on every step, with the framework's work done once
+    # per step, and returns a dict with the rewards from each function ("rewards", one list per function name, in step
+    # order), the episode length of each episode ("episode_steps") and the time taken ("framework_seconds", and
+    # "reward_seconds" for each function)
+    episodes = split_episodes(params_sequence)
+    tasks = [episodes[i:i + episodes_per_task] for i in range(0, len(episodes), episodes_per_task)]
+
+    if workers and workers > 1:
+        tasks = [_share_track(task) for task in tasks]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker,
+                                 initargs=(reward_functions, lazy_calculations)) as executor:
+            task_results = list(executor.map(evaluate_episodes, tasks))
+    else:
+        was_lazy = Framework.LAZY_CALCULATIONS
+        _initialize_worker(reward_functions, lazy_calculations)
+        try:
+            task_results = [evaluate_episodes(task) for task in tasks]
+        finally:
+            Framework.LAZY_CALCULATIONS = was_lazy
+
+    names = list(reward_functions)
+    rewards = {name: [] for name in names}
+    reward_nanoseconds = dict.fromkeys(names, 0)
+    framework_nanoseconds = 0
+    for (task_rewards, task_framework_nanoseconds, task_reward_nanoseconds) in task_results:
+        framework_nanoseconds += task_framework_nanoseconds
+        for i, name in enumerate(names):
+            rewards[name].extend(task_rewards[i])
+            reward_nanoseconds[name] += task_reward_nanoseconds[i]
+
+    return {
+        "rewards": rewards,
+        "episode_steps": [len(episode) for episode in episodes],
+        "framework_seconds": round(framework_nanoseconds / 1e9, 6),
+        "reward_seconds": {name: round(reward_nanoseconds[name] / 1e9, 6) for name in names}
+    }
+
+
+def _share_track(episodes):
+    # Copies of the params that all refer to the same waypoints list, so that it is only sent to a worker once per task
+    # (params loaded from a file each have their own copy)
+    waypoints = episodes[0][0][ParamNames.WAYPOINTS]
+    return [[dict(params, waypoints=waypoints) if params[ParamNames.WAYPOINTS] == waypoints else params
+             for params in episode] for episode in episodes]
+
+
+def get_reward_summary(rewards, episode_steps):
+    sorted_rewards = sorted(rewards)
+    count = len(sorted_rewards)
+    episode_totals = []
+    first = 0
+    for steps in episode_steps:
+        episode_totals.append(math.fsum(rewards[first:first + steps]))
+        first += steps
+
+    return {
+        "count": count,
+        "mean": round(math.fsum(sorted_rewards) / count, 6) if count else None,
+        "stdev": round(statistics.pstdev(sorted_rewards), 6) if count else None,
+        "min": sorted_rewards[0] if count else None,
+        "p50": get_percentile(sorted_rewards, 50) if count else None,
+        "p95": get_percentile(sorted_rewards, 95) if count else None,
+        "max": sorted_rewards[-1] if count else None,
+        "mean_episode_total": round(math.fsum(episode_totals) / len(episode_totals), 6) if episode_totals else None
+    }
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Compare reward functions on the same recorded DeepRacer params")
+    parser.add_argument("episodes_file")
+    parser.add_argument("--reward", action="append", required=True,
+                        help="Reward function(s) taking a Framework, as MODULE:FUNCTION[,FUNCTION...] (repeatable)")
+    parser.add_argument("--lazy", action="store_true", help="Use Framework.LAZY_CALCULATIONS")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes (default 1, just this process; 0 for one per CPU)")
+    parser.add_argument("--output", help="Also write the summary, with every reward for every step, to this file")
+    args = parser.parse_args(arguments)
+
+    reward_functions = load_reward_functions(args.reward)
+    params_sequence = load_params_sequence(args.episodes_file)
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+
+    started = time.perf_counter()
+    evaluation = evaluate_rewards(params_sequence, reward_functions, args.lazy, workers)
+    elapsed = time.perf_counter() - started
+
+    results = {
+        "episodes_file": args.episodes_file,
+        "steps": len(params_sequence),
+        "episodes": len(evaluation["episode_steps"]),
+        "workers": workers,
+        "elapsed_seconds": round(elapsed, 6),
+        "framework_seconds": evaluation["framework_seconds"],
+        "rewards": {name: dict(get_reward_summary(rewards, evaluation["episode_steps"]),
+                               seconds=evaluation["reward_seconds"][name])
+                    for name, rewards in evaluation["rewards"].items()}
+    }
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        results["episode_steps"] = evaluation["episode_steps"]
+        for name, rewards in evaluation["rewards"].items():
+            results["rewards"][name]["series"] = rewards
+        with open(args.output, "w") as file:
+            file.write(json.dumps(results) + "\n")
+
+
+if __name__ == "__main__":
+    main()
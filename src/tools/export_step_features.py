@@ -0,0 +1,90 @@
+#
+# DeepRacer Framework - Export every per-step attribute of recorded episodes as memory-mappable typed columns
+#
+# Usage:  python -m src.tools.export_step_features EPISODES_FILE OUTPUT_DIRECTORY [--racing-line]
+#                 [--lidar-angles A,B,...]
+#
+# The episodes file is the same as for replay_episodes (the output of simulate_episodes works too). Each step is
+# processed by the framework, and the attributes with a column type in Framework.STEP_FEATURE_FIELDS are written to
+# the output directory, one file of fixed-width values per attribute, once per episode. More episodes can be added to the same directory
+# later, as long as the columns are the same.
+#
+# To load the columns (e.g. in a notebook), without parsing any text:
+#
+#     from src.deep_racer_framework import read_step_features
+#     columns = read_step_features("OUTPUT_DIRECTORY")
+#     columns["slide"], columns["front_object_id"], columns["just_passed_waypoint_ids_offsets"], ...
+#
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+from src.deep_racer_framework import Framework, read_step_features
+from src.tools.replay_episodes import load_params_sequence
+
+
+def export_step_features(params_sequence, directory: str, racing_line: bool = False, lidar_angles=()):
+    # Returns the number of steps written, or None if the directory already holds different columns
+    settings = (Framework.STEP_FEATURES_DIRECTORY, Framework.RACING_LINE, Framework.LIDAR_ANGLES)
+    Framework.STEP_FEATURES_DIRECTORY = directory
+    Framework.RACING_LINE = racing_line
+    Framework.LIDAR_ANGLES = tuple(lidar_angles)
+    try:
+        framework = None
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            for params in params_sequence:
+                if framework is None:
+                    framework = Framework(params)
+                    if framework.step_features is None:
+                        break
+                framework.process_params(params)
+            if framework is not None and framework.step_features is not None:
+                framework.step_features.flush()
+    finally:
+        (Framework.STEP_FEATURES_DIRECTORY, Framework.RACING_LINE, Framework.LIDAR_ANGLES) = settings
+
+    if framework is None or framework.step_features is None:
+        print(output.getvalue().strip(), file=sys.stderr)
+        return None
+    return len(params_sequence)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Export the framework's per-step attributes as typed columns")
+    parser.add_argument("episodes_file")
+    parser.add_argument("output_directory")
+    parser.add_argument("--racing-line", action="store_true",
+                        help="Include distance_from_racing_line and racing_line_bearing (needs NumPy)")
+    parser.add_argument("--lidar-angles", default="",
+                        help="Angles for lidar_distances, comma separated (default none)")
+    args = parser.parse_args(arguments)
+
+    params_sequence = load_params_sequence(args.episodes_file)
+    lidar_angles = [float(angle) for angle in args.lidar_angles.split(",") if angle]
+
+    started = time.perf_counter()
+    step_count = export_step_features(params_sequence, args.output_directory, args.racing_line, lidar_angles)
+    elapsed = time.perf_counter() - started
+    if step_count is None:
+        sys.exit(1)
+
+    columns = read_step_features(args.output_directory)
+    print(json.dumps({
+        "output_directory": args.output_directory,
+        "steps_written": step_count,
+        "steps_in_directory": len(columns["steps"]),
+        "episodes_in_directory": int(columns["episode"][-1]) + 1 if len(columns["episode"]) else 0,
+        "columns": len(columns),
+        "bytes": sum(os.path.getsize(os.path.join(args.output_directory, name))
+                     for name in os.listdir(args.output_directory)),
+        "elapsed_seconds": round(elapsed, 6)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#
+# DeepRacer Framework - Replay recorded episodes and measure the time taken per step
+#
+# Usage:  python -m src.tools.replay_episodes EPISODES_FILE [--reward MODULE:FUNCTION] [--output RESULTS.json]
+#
+# The episodes file contains the params for each step, in order, either as JSON lines (one params dict per line),
+# as a JSON list of params dicts, or as a Python literal list of dicts (the format shown in notes/sample_params.txt)
+#
+# With --max-step-allocation BYTES, the memory allocated by process_params() is also traced (with tracemalloc) for
+# every step after the start of each episode, and the exit status is 1 if any step allocates more than the budget
+# at once. The timings are much slower while tracing, so check allocations and timings in separate runs.
+#
+
+import argparse
+import ast
+import contextlib
+import importlib
+import io
+import json
+import sys
+import time
+import tracemalloc
+
+from src.deep_racer_framework import Framework, FRAMEWORK_VERSION, ParamNames
+
+
+def load_params_sequence(file_name):
+    with open(file_name) as file:
+        text = file.read().strip()
+
+    if not text:
+        return []
+    try:
+        if text.startswith("["):
+            return json.loads(text)
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    except ValueError:
+        params = ast.literal_eval(text)
+        if isinstance(params, dict):
+            return [params]
+        return list(params)
+
+
+def load_reward_function(name):
+    (module_name, function_name) = name.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def get_percentile(sorted_values, percent: float):
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(percent / 100 * len(sorted_values) + 0.4999)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def get_timing_summary(nanoseconds):
+    sorted_values = sorted(nanoseconds)
+    count = len(sorted_values)
+    return {
+        "count": count,
+        "mean_us": round(sum(sorted_values) / count / 1000, 3) if count else 0.0,
+        "p50_us": round(get_percentile(sorted_values, 50) / 1000, 3),
+        "p95_us": round(get_percentile(sorted_values, 95) / 1000, 3),
+        "p99_us": round(get_percentile(sorted_values, 99) / 1000, 3),
+        "max_us": round(sorted_values[-1] / 1000, 3) if count else 0.0
+    }
+
+
+def get_allocation_summary(peak_bytes, retained_bytes):
+    sorted_values = sorted(peak_bytes)
+    count = len(sorted_values)
+    return {
+        "steps": count,
+        "p50_bytes": get_percentile(sorted_values, 50),
+        "p99_bytes": get_percentile(sorted_values, 99),
+        "max_bytes": sorted_values[-1] if count else 0,
+        "retained_bytes": sum(retained_bytes)
+    }
+
+
+def replay(params_sequence, get_reward, repeats: int = 1, quiet: bool = True, trace_allocations: bool = False):
+    stage_timings = {"process_params": [], "get_reward": [], "total": []}
+    allocation_peaks = []
+    allocations_retained = []
+    episodes = 0
+    framework = None
+    previous_steps = None
+
+    output = io.StringIO() if quiet else sys.stdout
+    clock = time.perf_counter_ns
+
+    if trace_allocations:
+        tracemalloc.start()
+    with contextlib.redirect_stdout(output):
+        started = clock()
+        for _ in range(repeats):
+            for params in params_sequence:
+                steps = params[ParamNames.STEPS]
+                if previous_steps is None or steps <= previous_steps:
+                    episodes += 1
+                previous_steps = steps
+
+                step_started = clock()
+                if framework is None:
+                    framework = Framework(params)
+                if trace_allocations:
+                    tracemalloc.reset_peak()
+                    allocated_before = tracemalloc.get_traced_memory()[0]
+                framework.process_params(params)
+                if trace_allocations and steps > 2:
+                    (allocated, allocated_peak) = tracemalloc.get_traced_memory()
+                    allocation_peaks.append(allocated_peak - allocated_before)
+                    allocations_retained.append(allocated - allocated_before)
+                if framework.instrumentation:
+                    framework.instrumentation.start_stage("get_reward")
+                reward_started = clock()
+                get_reward(framework)
+                step_finished = clock()
+
+                stage_timings["process_params"].append(reward_started - step_started)
+                stage_timings["get_reward"].append(step_finished - reward_started)
+                stage_timings["total"].append(step_finished - step_started)
+
+                if framework.instrumentation:
+                    framework.instrumentation.end_step()
+                    for stage, nanoseconds in framework.instrumentation.last_step_timings.items():
+                        if stage != "total":
+                            stage_timings.setdefault("instrumented." + stage, []).append(nanoseconds)
+
+                if quiet:
+                    output.seek(0)
+                    output.truncate()
+        elapsed = clock() - started
+    if trace_allocations:
+        tracemalloc.stop()
+
+    total_steps = len(stage_timings["total"])
+    results = {
+        "framework_version": FRAMEWORK_VERSION,
+        "lazy_calculations": Framework.LAZY_CALCULATIONS,
+        "instrumentation": Framework.INSTRUMENTATION,
+        "steps": total_steps,
+        "episodes": episodes,
+        "elapsed_seconds": round(elapsed / 1e9, 6),
+        "steps_per_second": round(total_steps / (elapsed / 1e9), 1) if elapsed else 0.0,
+        "stages": {name: get_timing_summary(values) for name, values in stage_timings.items()}
+    }
+    if trace_allocations:
+        results["process_params_allocations"] = get_allocation_summary(allocation_peaks, allocations_retained)
+    return results
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Replay recorded DeepRacer params and time each step")
+    parser.add_argument("episodes_file")
+    parser.add_argument("--reward", default="src.deep_racer_framework:get_reward",
+                        help="Reward function taking a Framework, as MODULE:FUNCTION")
+    parser.add_argument("--repeats", type=int, default=1, help="Number of times to replay the whole file")
+    parser.add_argument("--lazy", action="store_true", help="Use Framework.LAZY_CALCULATIONS")
+    parser.add_argument("--instrument", action="store_true",
+                        help="Use Framework.INSTRUMENTATION to also time each stage within each step")
+    parser.add_argument("--show-output", action="store_true", help="Do not hide anything printed at each step")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument("--max-step-allocation", type=int, metavar="BYTES",
+                        help="Trace memory allocated by process_params(), and fail if a step allocates more than this")
+    args = parser.parse_args(arguments)
+
+    Framework.LAZY_CALCULATIONS = args.lazy
+    Framework.INSTRUMENTATION = args.instrument
+    results = replay(load_params_sequence(args.episodes_file), load_reward_function(args.reward),
+                     args.repeats, not args.show_output, args.max_step_allocation is not None)
+    results["reward"] = args.reward
+    results["episodes_file"] = args.episodes_file
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+
+    if args.max_step_allocation is not None:
+        max_bytes = results["process_params_allocations"]["max_bytes"]
+        if max_bytes > args.max_step_allocation:
+            print("process_params() allocated", max_bytes, "bytes in one step, over the budget of",
+                  args.max_step_allocation, file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+#
+# DeepRacer Framework - Simulate cars driving around a track, to make params for testing reward functions locally
+#
+# Usage:  python -m src.tools.simulate_episodes TRACK_FILE [--episodes N] [--max-steps N] [--boxes N] [--bots N]
+#                 [--bot-speed MPS] [--seed N] [--output EPISODES_FILE] [--reward MODULE:FUNCTION]
+#
+# The track file is either a DeepRacer track .npy file or a JSON file containing
+# {"waypoints": [[x, y], ...], "track_width": width}, the same as for analyze_sim_trace (or see synthetic_tracks)
+#
+# Each car is a simple kinematic bicycle model, driven by a rough pure pursuit driver choosing from a discrete action
+# space, with some steering noise so that cars sometimes leave the track or hit an object. Objects are boxes standing
+# still either side of the center line, or bot cars driving along it. Every episode ends when the car completes a lap,
+# goes off the track, crashes, turns around, or reaches the maximum number of steps.
+#
+# All the episodes are simulated side by side with NumPy, which is what makes it quick (hundreds of thousands of steps
+# per second), and the results are columns of params (one value per step), ready for Framework.process_batch(), or
+# turned into the usual params dicts with every key in ParamNames. With --output, the params are written as JSON lines
+# (the episodes file format for replay_episodes). With --reward, the reward function (taking params, e.g. the usual
+# reward_function) is called for every step, and the time taken for the simulation and the reward function is
+# reported as JSON.
+#
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import math
+import time
+
+import numpy as np
+
+from src.deep_racer_framework import Framework, ParamNames, RealWorld, get_angles_in_proper_range
+from src.tools.analyze_sim_trace import load_track
+
+# Pairs of (steering angle, speed), like the default discrete action space in the DeepRacer console
+DEFAULT_ACTION_SPACE = tuple((steering_angle, speed) for steering_angle in (-30.0, -15.0, 0.0, 15.0, 30.0)
+                             for speed in (1.0, 2.0, 3.0))
+
+
+class SimulatedObject:
+    def __init__(self, track_position: float, offset: float = 0.0, speed: float = 0.0):
+        # Meters along the center line from the first waypoint, meters to the left (negative for the right) of the
+        # center line, and meters per second along the track (zero for a box, which never moves)
+        self.track_position = track_position
+        self.offset = offset
+        self.speed = speed
+
+
+def make_objects(track_length: float, box_count: int = 0, bot_count: int = 0, bot_speed: float = 1.0,
+                 box_offset: float = 0.3):
+    # Boxes and bots spread evenly round the track, with the boxes alternately left and right of the center line and
+    # the bots driving along it, in order of position along the track (as in DeepRacer)
+    kinds = sorted([((i + 0.5) / box_count, "box") for i in range(box_count)] +
+                   [((i + 0.5) / bot_count, "bot") for i in range(bot_count)])
+    objects = []
+    for i, (_, kind) in enumerate(kinds):
+        position = (i + 0.5) * track_length / len(kinds)
+        if kind == "box":
+            objects.append(SimulatedObject(position, box_offset if len(objects) % 2 == 0 else -box_offset))
+        else:
+            objects.append(SimulatedObject(position, 0.0, bot_speed))
+    return objects
+
+
+class CarSimulator:
+    # Distance between the axles, for the bicycle model (the framework only knows the overall length of the car)
+    WHEELBASE = RealWorld.VEHICLE_LENGTH
+
+    # Fraction of the difference between the current speed and the action speed that is made up at each step
+    SPEED_RESPONSE = 0.3
+
+    # The car slides outwards in corners, by this many degrees per m/s/s of lateral acceleration (up to the max)
+    SLIDE_PER_LATERAL_ACCELERATION = 1.0
+    MAX_SLIDE = 30.0
+
+    # How the driver of each car steers: aiming for a point on the center line this far ahead (meters, chosen at
+    # random for each episode), with this much random steering noise (standard deviation in degrees)
+    LOOK_AHEAD_RANGE = (0.6, 1.4)
+    STEERING_NOISE = 6.0
+
+    # When the next object ahead is this close (meters along the track), the driver aims to pass it this far from the
+    # center line (as a fraction of the track width), on the other side from the object (or the left of a bot car)
+    AVOID_DISTANCE = 2.0
+    AVOID_OFFSET = 0.375
+
+    # Objects this close (center to center) are a crash, and are in camera if this near and within this angle
+    CRASH_DISTANCE = Framework.COLLISION_DISTANCE
+    CAMERA_RANGE = 3.0
+    CAMERA_HALF_ANGLE = 60.0
+
+    # Number of track segments checked around each car at each step, to find the nearest part of the track
+    SEGMENT_SEARCH_WINDOW = 8
+
+    def __init__(self, waypoints, track_width: float, objects=(), action_space=DEFAULT_ACTION_SPACE, seed=None):
+        self.waypoints = waypoints
+        self.track_width = track_width
+        self.objects = list(objects)
+        self._random = np.random.default_rng(seed)
+
+        # Segments from each waypoint to the next, including the last back to the first (zero length if repeated)
+        points = np.array(waypoints, dtype=float)
+        self._start_x = points[:, 0]
+        self._start_y = points[:, 1]
+        self._segment_x = np.roll(self._start_x, -1) - self._start_x
+        self._segment_y = np.roll(self._start_y, -1) - self._start_y
+        self._segment_lengths = np.hypot(self._segment_x, self._segment_y)
+        with np.errstate(divide="ignore"):
+            self._inverse_squared_lengths = np.where(self._segment_lengths > 0, 1 / self._segment_lengths ** 2, 0.0)
+        self._segment_bearings = np.degrees(np.arctan2(self._segment_y, self._segment_x))
+        self._cumulative = np.concatenate(([0.0], np.cumsum(self._segment_lengths)))
+        self.track_length = float(self._cumulative[-1])
+
+        # For a segment with no length, the bearing of the next segment that has some
+        for i in reversed(range(2 * len(waypoints))):
+            i %= len(waypoints)
+            if self._segment_lengths[i] == 0.0:
+                self._segment_bearings[i] = self._segment_bearings[(i + 1) % len(waypoints)]
+
+        self._action_steering_angles = np.array([a[0] for a in action_space], dtype=float)
+        self._action_speeds = np.array([a[1] for a in action_space], dtype=float)
+        self._max_steering_angle = max(1.0, float(np.abs(self._action_steering_angles).max()))
+        self._max_speed = float(self._action_speeds.max())
+        self._min_speed = float(self._action_speeds.min())
+
+    def get_point_and_bearing_at_positions(self, positions, offsets=0.0):
+        # Points on the track at the given track positions (and offsets to the left of the center line)
+        positions = np.mod(positions, self.track_length)
+        ids = np.minimum(np.searchsorted(self._cumulative, positions, side="right") - 1, len(self.waypoints) - 1)
+        fractions = (positions - self._cumulative[ids]) * np.where(
+            self._segment_lengths[ids] > 0, 1 / np.maximum(self._segment_lengths[ids], 1e-12), 0.0)
+        bearings = self._segment_bearings[ids]
+        radians = np.radians(bearings + 90)
+        x = self._start_x[ids] + fractions * self._segment_x[ids] + offsets * np.cos(radians)
+        y = self._start_y[ids] + fractions * self._segment_y[ids] + offsets * np.sin(radians)
+        return x, y, bearings, ids
+
+    def _find_segments(self, x, y, segment_ids):
+        # Nearest segment to each point, searching forwards (and a little backwards) from each previous segment, and
+        # again while the nearest is at the far end of the window, for cars that pass several waypoints in one step
+        segment_count = len(self.waypoints)
+        offsets = np.arange(-2, self.SEGMENT_SEARCH_WINDOW - 2)
+        while True:
+            ids = (segment_ids[:, None] + offsets) % segment_count
+            fractions = np.clip(((x[:, None] - self._start_x[ids]) * self._segment_x[ids] +
+                                 (y[:, None] - self._start_y[ids]) * self._segment_y[ids]) *
+                                self._inverse_squared_lengths[ids], 0.0, 1.0)
+            distances = np.hypot(self._start_x[ids] + fractions * self._segment_x[ids] - x[:, None],
+                                 self._start_y[ids] + fractions * self._segment_y[ids] - y[:, None])
+            nearest = np.argmin(distances, axis=1)
+            rows = np.arange(len(x))
+            segment_ids = ids[rows, nearest]
+            if not np.any(nearest == len(offsets) - 1):
+                break
+
+        fractions = fractions[rows, nearest]
+        distances = distances[rows, nearest]
+        crosses = (self._segment_x[segment_ids] * (y - self._start_y[segment_ids]) -
+                   self._segment_y[segment_ids] * (x - self._start_x[segment_ids]))
+        positions = self._cumulative[segment_ids] + fractions * self._segment_lengths[segment_ids]
+        return segment_ids, positions, distances, crosses > 0
+
+    def simulate(self, episode_count: int, max_steps: int = 1000, start_positions=None):
+        # Simulates the episodes side by side, and returns columns of params (each per-step param is an array with
+        # one row per step, episode after episode), plus "episode" (numbered from zero) and "status" for each step
+        if start_positions is None:
+            start_positions = np.zeros(episode_count)
+        start_positions = np.mod(np.asarray(start_positions, dtype=float), self.track_length)
+        random = self._random
+        dt = 1 / RealWorld.STEPS_PER_SECOND
+
+        # Only the cars that are still running are kept, with the episode that each one belongs to
+        car_ids = np.arange(episode_count)
+        look_aheads = random.uniform(*self.LOOK_AHEAD_RANGE, episode_count)
+        (x, y, heading, segment_ids) = self.get_point_and_bearing_at_positions(start_positions)
+        speed = np.zeros(episode_count)
+        travelled = np.zeros(episode_count)
+        previous_positions = start_positions
+
+        object_start_positions = np.array([o.track_position for o in self.objects], dtype=float)
+        object_offsets = np.array([o.offset for o in self.objects], dtype=float)
+        object_speeds = np.array([o.speed for o in self.objects], dtype=float)
+        avoid_offsets = np.where(object_offsets > 0, -1.0, 1.0) * self.AVOID_OFFSET * self.track_width
+
+        steps = []
+        for step in range(1, max_steps + 1):
+            cars = len(car_ids)
+            (segment_ids, positions, distances_from_center, is_left) = self._find_segments(x, y, segment_ids)
+            step_track_distance = np.mod(positions - previous_positions + self.track_length / 2,
+                                         self.track_length) - self.track_length / 2
+            travelled = travelled + step_track_distance if step > 1 else travelled
+            previous_positions = positions
+            progress = np.clip(travelled / self.track_length * 100, 0.0, 100.0)
+
+            # Objects, and which are just behind and just in front of each car (along the track)
+            object_positions = np.mod(object_start_positions + object_speeds * (step - 1) * dt, self.track_length)
+            (object_x, object_y, object_headings, _) = self.get_point_and_bearing_at_positions(
+                object_positions, object_offsets)
+            target_offsets = 0.0
+            if len(self.objects) > 0:
+                object_distances = np.hypot(object_x - x[:, None], object_y - y[:, None])
+                ahead = np.mod(object_positions - positions[:, None], self.track_length)
+                closest_objects = np.stack((np.argmax(ahead, axis=1), np.argmin(ahead, axis=1)), axis=1)
+                object_bearings = np.degrees(np.arctan2(object_y - y[:, None], object_x - x[:, None]))
+                is_in_view = np.abs(get_angles_in_proper_range(object_bearings - heading[:, None])) <= \
+                    self.CAMERA_HALF_ANGLE
+                is_crashed = np.any(object_distances < self.CRASH_DISTANCE, axis=1)
+                object_in_camera = np.any((object_distances < self.CAMERA_RANGE) & is_in_view, axis=1)
+
+                # The driver moves over to pass the object in front, on whichever side it is not
+                front_ids = closest_objects[:, 1]
+                target_offsets = np.where(ahead[np.arange(cars), front_ids] < self.AVOID_DISTANCE,
+                                          avoid_offsets[front_ids], 0.0)
+            else:
+                closest_objects = np.zeros((cars, 2), dtype=int)
+                is_crashed = np.zeros(cars, dtype=bool)
+                object_in_camera = np.zeros(cars, dtype=bool)
+
+            # All wheels are on the track until the side of the car crosses the edge, and the car is off the track
+            # once the whole car is across it, which is the same as the framework's safe edge
+            all_wheels_on_track = distances_from_center + RealWorld.VEHICLE_WIDTH / 2 <= self.track_width / 2
+            is_offtrack = distances_from_center - RealWorld.SAFE_CAR_OVERHANG > self.track_width / 2
+            is_reversed = np.abs(get_angles_in_proper_range(heading - self._segment_bearings[segment_ids])) > 90
+            is_complete_lap = progress >= 100.0
+
+            # The driver aims for a point ahead on the track (pure pursuit), then takes the nearest action
+            (target_x, target_y, _, _) = self.get_point_and_bearing_at_positions(positions + look_aheads,
+                                                                                  target_offsets)
+            alpha = np.radians(get_angles_in_proper_range(
+                np.degrees(np.arctan2(target_y - y, target_x - x)) - heading))
+            wanted_steering_angle = np.degrees(np.arctan(2 * self.WHEELBASE * np.sin(alpha) / look_aheads))
+            wanted_steering_angle += random.normal(0.0, self.STEERING_NOISE, cars)
+            wanted_speed = self._max_speed - (self._max_speed - self._min_speed) * np.minimum(
+                1.0, np.abs(wanted_steering_angle) / self._max_steering_angle)
+            actions = np.argmin(((wanted_steering_angle[:, None] - self._action_steering_angles) /
+                                 self._max_steering_angle) ** 2 +
+                                ((wanted_speed[:, None] - self._action_speeds) / self._max_speed) ** 2, axis=1)
+            action_steering_angle = self._action_steering_angles[actions]
+            action_speed = self._action_speeds[actions]
+
+            steps.append({
+                "car_ids": car_ids, "x": x, "y": y, "heading": heading, "segment_ids": segment_ids,
+                "positions": positions, "distances_from_center": distances_from_center, "is_left": is_left,
+                "progress": progress, "all_wheels_on_track": all_wheels_on_track, "is_offtrack": is_offtrack,
+                "is_crashed": is_crashed, "is_reversed": is_reversed, "is_complete_lap": is_complete_lap,
+                "closest_objects": closest_objects, "object_in_camera": object_in_camera,
+                "steering_angle": action_steering_angle, "speed": action_speed, "object_x": object_x,
+                "object_y": object_y, "object_headings": object_headings, "object_positions": object_positions
+            })
+
+            # Cars that finished their episode at this step take no further part
+            is_running = ~(is_offtrack | is_crashed | is_reversed | is_complete_lap)
+            if not np.all(is_running):
+                (car_ids, look_aheads, x, y, heading, speed, travelled, previous_positions, segment_ids,
+                 action_steering_angle, action_speed) = (
+                    a[is_running] for a in (car_ids, look_aheads, x, y, heading, speed, travelled, previous_positions,
+                                            segment_ids, action_steering_angle, action_speed))
+                if len(car_ids) == 0:
+                    break
+
+            # Then the cars move, with a kinematic bicycle model that slides outwards a little in corners
+            speed = speed + (action_speed - speed) * self.SPEED_RESPONSE
+            tan_steering = np.tan(np.radians(action_steering_angle))
+            slide = np.clip(speed * speed * tan_steering / self.WHEELBASE * self.SLIDE_PER_LATERAL_ACCELERATION,
+                            -self.MAX_SLIDE, self.MAX_SLIDE)
+            radians = np.radians(heading - slide)
+            x = x + speed * np.cos(radians) * dt
+            y = y + speed * np.sin(radians) * dt
+            heading = get_angles_in_proper_range(heading + np.degrees(speed / self.WHEELBASE * tan_steering * dt))
+
+        return self._get_columns(steps)
+
+    def _get_columns(self, steps):
+        # From the cars running at each step, to rows ordered by episode and then by step
+        step_ids = np.concatenate([np.full(len(s["car_ids"]), i) for (i, s) in enumerate(steps)])
+        car_ids = np.concatenate([s["car_ids"] for s in steps])
+        order = np.lexsort((step_ids, car_ids))
+        (car_ids, step_ids) = (car_ids[order], step_ids[order])
+
+        def join(name):
+            return np.concatenate([s[name] for s in steps])[order]
+
+        def join_objects(name):
+            return np.stack([s[name] for s in steps])[step_ids]
+
+        segment_ids = join("segment_ids")
+        next_ids = np.where(segment_ids < len(self.waypoints) - 1, segment_ids + 1, 0)
+        status = np.full(len(car_ids), "in_progress", dtype=object)
+        for name, value in (("is_complete_lap", "lap_complete"), ("is_reversed", "reversed"),
+                            ("is_crashed", "crashed"), ("is_offtrack", "off_track")):
+            status[join(name)] = value
+
+        row_count = len(car_ids)
+        object_count = len(self.objects)
+        object_offsets = np.array([o.offset for o in self.objects], dtype=float)
+        object_speeds = np.array([o.speed for o in self.objects], dtype=float)
+
+        return {
+            "episode": car_ids,
+            "status": status,
+            ParamNames.ALL_WHEELS_ON_TRACK: join("all_wheels_on_track"),
+            ParamNames.X: join("x"),
+            ParamNames.Y: join("y"),
+            ParamNames.CLOSEST_OBJECTS: join("closest_objects"),
+            ParamNames.CLOSEST_WAYPOINTS: np.stack((segment_ids, next_ids), axis=1),
+            ParamNames.DISTANCE_FROM_CENTER: join("distances_from_center"),
+            ParamNames.IS_CRASHED: join("is_crashed"),
+            ParamNames.IS_LEFT_OF_CENTER: join("is_left"),
+            ParamNames.IS_OFFTRACK: join("is_offtrack"),
+            ParamNames.IS_REVERSED: join("is_reversed"),
+            ParamNames.HEADING: join("heading"),
+            ParamNames.OBJECTS_DISTANCE: join_objects("object_positions"),
+            ParamNames.OBJECTS_DISTANCE_FROM_CENTER: np.broadcast_to(np.abs(object_offsets), (row_count, object_count)),
+            ParamNames.OBJECTS_HEADING: join_objects("object_headings"),
+            ParamNames.OBJECTS_LEFT_OF_CENTER: np.broadcast_to(object_offsets > 0, (row_count, object_count)),
+            ParamNames.OBJECTS_LOCATION: np.stack((join_objects("object_x"), join_objects("object_y")), axis=2),
+            ParamNames.OBJECTS_SPEED: np.broadcast_to(object_speeds, (row_count, object_count)),
+            ParamNames.OBJECT_IN_CAMERA: join("object_in_camera"),
+            ParamNames.PROGRESS: join("progress"),
+            ParamNames.PROJECTION_DISTANCE: join("positions"),
+            ParamNames.SPEED: join("speed"),
+            ParamNames.STEERING_ANGLE: join("steering_angle"),
+            ParamNames.STEPS: step_ids + 1,
+            ParamNames.TRACK_LENGTH: self.track_length,
+            ParamNames.TRACK_WIDTH: self.track_width,
+            ParamNames.WAYPOINTS: self.waypoints
+        }
+
+
+def get_params_sequence(columns):
+    # The usual params dicts, one per step, from the columns returned by CarSimulator.simulate()
+    track_values = {name: columns[name] for name in (ParamNames.TRACK_LENGTH, ParamNames.TRACK_WIDTH,
+                                                     ParamNames.WAYPOINTS)}
+    step_columns = {name: values.tolist() for name, values in columns.items()
+                    if name not in track_values and name not in ("episode", "status")}
+    step_columns[ParamNames.OBJECTS_LOCATION] = [[tuple(location) for location in locations]
+                                                 for locations in step_columns[ParamNames.OBJECTS_LOCATION]]
+    step_columns[ParamNames.STEPS] = [float(s) for s in step_columns[ParamNames.STEPS]]
+
+    names = list(step_columns)
+    for values in zip(*step_columns.values()):
+        params = dict(zip(names, values))
+        params.update(track_values)
+        yield params
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Simulate cars driving around a track, and make their params")
+    parser.add_argument("track_file")
+    parser.add_argument("--episodes", type=int, default=100, help="Number of episodes (default 100)")
+    parser.add_argument("--max-steps", type=int, default=1000, help="Maximum steps per episode (default 1000)")
+    parser.add_argument("--boxes", type=int, default=0, help="Number of boxes standing still on the track")
+    parser.add_argument("--bots", type=int, default=0, help="Number of bot cars driving along the center line")
+    parser.add_argument("--bot-speed", type=float, default=1.0, help="Meters per second (default 1)")
+    parser.add_argument("--spread-starts", action="store_true",
+                        help="Start the episodes spread evenly round the track, rather than all at the first waypoint")
+    parser.add_argument("--seed", type=int, help="Seed for the random steering noise, to repeat a simulation")
+    parser.add_argument("--output", help="Write the params as JSON lines to this file")
+    parser.add_argument("--reward", help="Call this reward function (taking params) for every step, as MODULE:FUNCTION")
+    args = parser.parse_args(arguments)
+
+    (waypoints, track_width) = load_track(args.track_file)
+    simulator = CarSimulator(waypoints, track_width, seed=args.seed)
+    simulator.objects = make_objects(simulator.track_length, args.boxes, args.bots, args.bot_speed)
+    start_positions = None
+    if args.spread_starts:
+        start_positions = np.arange(args.episodes) * simulator.track_length / args.episodes
+
+    started = time.perf_counter()
+    columns = simulator.simulate(args.episodes, args.max_steps, start_positions)
+    simulated = time.perf_counter()
+    step_count = len(columns[ParamNames.X])
+
+    final_rows = np.nonzero(np.diff(columns["episode"], append=-1) != 0)[0]
+    results = {
+        "steps": step_count,
+        "episodes": len(final_rows),
+        "simulation_seconds": round(simulated - started, 6),
+        "simulated_steps_per_second": round(step_count / (simulated - started), 1),
+        "mean_steps": round(step_count / max(1, len(final_rows)), 1),
+        "mean_final_progress": round(float(np.mean(columns[ParamNames.PROGRESS][final_rows])), 2),
+        "status": {str(s): int(n) for (s, n) in zip(*np.unique(columns["status"][final_rows], return_counts=True))}
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            for params in get_params_sequence(columns):
+                file.write(json.dumps(params) + "\n")
+
+    if args.reward:
+        (module_name, function_name) = args.reward.split(":")
+        reward_function = getattr(importlib.import_module(module_name), function_name)
+        params_sequence = list(get_params_sequence(columns))
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            rewards = [reward_function(params) for params in params_sequence]
+            elapsed = time.perf_counter() - started
+        results["reward_seconds"] = round(elapsed, 6)
+        results["reward_steps_per_second"] = round(step_count / elapsed, 1) if elapsed else 0.0
+        results["mean_reward"] = round(math.fsum(rewards) / len(rewards), 4) if rewards else None
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
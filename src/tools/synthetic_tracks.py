@@ -0,0 +1,136 @@
+#
+# DeepRacer Framework - Make synthetic closed tracks, and params for driving around them
+#
+# Usage:  python -m src.tools.synthetic_tracks OUTPUT_FILE [--length METERS] [--waypoints N] [--corners N]
+#                 [--corner-depth FRACTION] [--track-width METERS] [--duplicate-every N] [--no-repeat-first]
+#
+# The track is written as a JSON file containing {"waypoints": [[x, y], ...], "track_width": width}, the same as
+# for analyze_sim_trace and build_projection_table
+#
+# Each track is a circle that bulges in and out to make the requested number of corners (more corner depth makes the
+# corners sharper), with the waypoints evenly spaced along it. Like the real tracks, the last waypoint repeats the
+# first (unless --no-repeat-first), and waypoints can also be repeated in place every so often, which the framework
+# must cope with just as it does for the odd repeated waypoint in the real tracks.
+#
+
+import argparse
+import json
+import math
+import sys
+from bisect import bisect_right
+
+from src.deep_racer_framework import (ParamNames, RealWorld, TrackDistances, get_angle_in_proper_range,
+                                      get_bearing_between_points, get_point_at_bearing)
+
+
+def make_synthetic_track(length: float = 60.0, waypoint_count: int = 200, corners: int = 4,
+                         corner_depth: float = 0.3, duplicate_every: int = 0, repeat_first: bool = True):
+    assert length > 0.0 and waypoint_count >= 4 and 0.0 <= corner_depth < 1.0
+
+    # Trace the outline finely first, so that the waypoints can be spaced evenly by distance rather than by angle
+    sample_count = max(4096, 8 * waypoint_count)
+    outline = []
+    for i in range(sample_count + 1):
+        angle = 2 * math.pi * i / sample_count
+        radius = 1.0 + corner_depth * math.sin(corners * angle)
+        outline.append((radius * math.cos(angle), radius * math.sin(angle)))
+    cumulative = [0.0]
+    for i in range(1, len(outline)):
+        cumulative.append(cumulative[-1] + math.dist(outline[i - 1], outline[i]))
+    scale = length / cumulative[-1]
+
+    body_count = waypoint_count - (1 if repeat_first else 0)
+    distinct_count = body_count - (body_count // (duplicate_every + 1) if duplicate_every > 0 else 0)
+    waypoints = []
+    for i in range(distinct_count):
+        position = cumulative[-1] * i / distinct_count
+        j = min(bisect_right(cumulative, position), len(outline) - 1)
+        fraction = (position - cumulative[j - 1]) / (cumulative[j] - cumulative[j - 1])
+        ((before_x, before_y), (after_x, after_y)) = (outline[j - 1], outline[j])
+        point = (scale * (before_x + fraction * (after_x - before_x)),
+                 scale * (before_y + fraction * (after_y - before_y)))
+        waypoints.append(point)
+        if duplicate_every > 0 and i % duplicate_every == duplicate_every - 1 and len(waypoints) < body_count:
+            waypoints.append(point)
+
+    # Cutting across the curves makes the track a little short, so stretch it to exactly the requested length
+    stretch = length / sum(math.dist(waypoints[i - 1], waypoints[i]) for i in range(len(waypoints)))
+    waypoints = [(x * stretch, y * stretch) for (x, y) in waypoints]
+    if repeat_first:
+        waypoints.append(waypoints[0])
+    return waypoints
+
+
+def make_params_along_track(waypoints, track_width: float, step_count: int, speed: float = 2.0,
+                            weave: float = 0.25, start_position: float = 0.0):
+    # Params for one episode of steps around the track, weaving either side of the center line (up to the given
+    # fraction of the track width) and pointing a little each way, as a list of params dicts
+    track_distances = TrackDistances(waypoints)
+    track_length = track_distances.total
+    step_distance = speed / RealWorld.STEPS_PER_SECOND
+
+    params_sequence = []
+    for step in range(1, step_count + 1):
+        travelled = (step - 1) * step_distance
+        position = track_distances.get_wrapped_position(start_position + travelled)
+        before_id = track_distances.get_waypoint_id_at_position(position)
+        after_id = before_id + 1 if before_id < len(waypoints) - 1 else 0
+        track_bearing = get_bearing_between_points(
+            track_distances.get_point_at_position(track_distances.get_wrapped_position(position - 0.05)),
+            track_distances.get_point_at_position(track_distances.get_wrapped_position(position + 0.05)))
+        offset = weave * track_width * math.sin(step / 10)
+        (x, y) = get_point_at_bearing(track_distances.get_point_at_position(position), track_bearing + 90, offset)
+
+        params_sequence.append({
+            ParamNames.ALL_WHEELS_ON_TRACK: abs(offset) < track_width / 2,
+            ParamNames.X: x,
+            ParamNames.Y: y,
+            ParamNames.CLOSEST_OBJECTS: [0, 0],
+            ParamNames.CLOSEST_WAYPOINTS: [before_id, after_id],
+            ParamNames.DISTANCE_FROM_CENTER: abs(offset),
+            ParamNames.IS_CRASHED: False,
+            ParamNames.IS_LEFT_OF_CENTER: offset > 0,
+            ParamNames.IS_OFFTRACK: False,
+            ParamNames.IS_REVERSED: False,
+            ParamNames.HEADING: get_angle_in_proper_range(track_bearing + 10 * math.cos(step / 10)),
+            ParamNames.OBJECTS_DISTANCE: [],
+            ParamNames.OBJECTS_DISTANCE_FROM_CENTER: [],
+            ParamNames.OBJECTS_HEADING: [],
+            ParamNames.OBJECTS_LEFT_OF_CENTER: [],
+            ParamNames.OBJECTS_LOCATION: [],
+            ParamNames.OBJECTS_SPEED: [],
+            ParamNames.PROGRESS: min(100.0, 100 * travelled / track_length),
+            ParamNames.SPEED: speed,
+            ParamNames.STEERING_ANGLE: round(-10 * math.sin(step / 10) / 5) * 5,
+            ParamNames.STEPS: float(step),
+            ParamNames.TRACK_LENGTH: track_length,
+            ParamNames.TRACK_WIDTH: track_width,
+            ParamNames.WAYPOINTS: waypoints
+        })
+    return params_sequence
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Make a synthetic closed track")
+    parser.add_argument("output_file")
+    parser.add_argument("--length", type=float, default=60.0, help="Meters around the center line (default 60)")
+    parser.add_argument("--waypoints", type=int, default=200, help="Number of waypoints (default 200)")
+    parser.add_argument("--corners", type=int, default=4, help="Number of bulges around the track (default 4)")
+    parser.add_argument("--corner-depth", type=float, default=0.3,
+                        help="How far the bulges go in and out, as a fraction of the radius (default 0.3)")
+    parser.add_argument("--track-width", type=float, default=1.066, help="Meters (default 1.066)")
+    parser.add_argument("--duplicate-every", type=int, default=0,
+                        help="Repeat every Nth waypoint in place (default 0, never)")
+    parser.add_argument("--no-repeat-first", action="store_true",
+                        help="Do not repeat the first waypoint at the end of the track")
+    args = parser.parse_args(arguments)
+
+    waypoints = make_synthetic_track(args.length, args.waypoints, args.corners, args.corner_depth,
+                                     args.duplicate_every, not args.no_repeat_first)
+    with open(args.output_file, "w") as file:
+        json.dump({"waypoints": waypoints, "track_width": args.track_width}, file)
+    print("Wrote", len(waypoints), "waypoints to", args.output_file, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()